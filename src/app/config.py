@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Copy this file to 'config.py' and make necessary changes for your local setup.
+import os
+
+
+# Add the converters module to the python path
+import sys
+sys.path.append("wp4-converters/src")
+
+# Path to a directory where temporary files can be written
+# (must be read/writable by the user that owns of the server process)
+TEMP_PATH = os.getenv('TEMP_PATH') or "/tmp"
+
+# Base URI for resources
+QBR_BASE = os.getenv('QBR_BASE') or "http://data.socialhistory.org/resource/"
+
+# Base URI for vocabulary
+QBRV_BASE = os.getenv('QBRV_BASE') or "http://data.socialhistory.org/vocab/"
+
+# Named graph with the catalog of the datasets, dimensions and code lists in the store (see util/catalog.py)
+CATALOG_GRAPH = os.getenv('CATALOG_GRAPH') or QBR_BASE + 'catalog'
+# Named graph with the transitive members (skos:member+) of all collections in the store
+MEMBERSHIP_GRAPH = os.getenv('MEMBERSHIP_GRAPH') or QBR_BASE + 'membership'
+
+# SPARQL Endpoint Configuration
+ENDPOINT_URL = os.getenv('ENDPOINT_URL') or '<URL OF SPARQL ENDPOINT>'
+UPDATE_URL = os.getenv('UPDATE_URL') or '<URL OF SPARQL UPDATE ENDPOINT>'
+
+# Virtuoso specific stuff
+CRUD_URL = os.getenv('CRUD_URL') or '<CRUD URL>'
+from requests.auth import HTTPDigestAuth
+CRUD_USER = os.getenv('CRUD_USER') or '<USER>'
+CRUD_PASS = os.getenv('CRUD_PASS') or '<PASS>'
+CRUD_AUTH = HTTPDigestAuth(CRUD_USER, CRUD_PASS)
+
+# Connection pool shared by the SPARQL query, update and CRUD endpoints
+# (maximum number of keep-alive connections per endpoint host)
+SPARQL_POOL_SIZE = int(os.getenv('SPARQL_POOL_SIZE') or 10)
+# Connect and read timeouts (in seconds) for calls to the endpoints
+SPARQL_CONNECT_TIMEOUT = float(os.getenv('SPARQL_CONNECT_TIMEOUT') or 5)
+SPARQL_READ_TIMEOUT = float(os.getenv('SPARQL_READ_TIMEOUT') or 120)
+# Number of retries for failed connections, and the backoff factor (in seconds)
+# between them: retries wait backoff * (2 ^ (retry - 1)) seconds
+SPARQL_RETRIES = int(os.getenv('SPARQL_RETRIES') or 3)
+SPARQL_BACKOFF = float(os.getenv('SPARQL_BACKOFF') or 0.5)
+
+# Cache for the results of frequently used SPARQL SELECT queries: the time-to-live
+# (in seconds) and the maximum size of all cached responses taken together (in bytes)
+SPARQL_CACHE_TTL = int(os.getenv('SPARQL_CACHE_TTL') or 300)
+SPARQL_CACHE_SIZE = int(os.getenv('SPARQL_CACHE_SIZE') or 64 * 1024 * 1024)
+
+# SPARQL calls that take longer than this (in seconds) are logged, and the last
+# SPARQL_SLOW_LOG_SIZE of them are listed by /sparql/stats
+SPARQL_SLOW_QUERY = float(os.getenv('SPARQL_SLOW_QUERY') or 1.0)
+SPARQL_SLOW_LOG_SIZE = int(os.getenv('SPARQL_SLOW_LOG_SIZE') or 100)
+
+# Number of results fetched per request when paging through large SPARQL results
+# (should not exceed the maximum result set size of the endpoint, 10000 for Virtuoso by default)
+SPARQL_PAGE_SIZE = int(os.getenv('SPARQL_PAGE_SIZE') or 10000)
+
+# Deadline (in seconds) for independent queries that are sent to one or more endpoints at the same time
+FAN_OUT_TIMEOUT = float(os.getenv('FAN_OUT_TIMEOUT') or 60)
+
+# Maximum number of URIs checked by a single (VALUES-based) existence query
+SPARQL_VALUES_SIZE = int(os.getenv('SPARQL_VALUES_SIZE') or 200)
+
+# Maximum number of triples and bytes in a single INSERT DATA update (see sparql_client.make_update)
+UPDATE_BATCH_TRIPLES = int(os.getenv('UPDATE_BATCH_TRIPLES') or 10000)
+UPDATE_BATCH_BYTES = int(os.getenv('UPDATE_BATCH_BYTES') or 4 * 1024 * 1024)
+
+# Bulk loading of N-Triples/N-Quads through the CRUD endpoint: the maximum number of triples
+# and bytes per chunk, the number of chunks uploaded in parallel, the number of retries for a
+# failed chunk, and whether chunks are sent gzip-compressed (the endpoint must support this).
+# Blank nodes are replaced by IRIs under BULK_SKOLEM_BASE, as they cannot be shared between chunks
+# (nor between the batches of INSERT DATA updates, see sparql_client.make_quad_update)
+BULK_CHUNK_TRIPLES = int(os.getenv('BULK_CHUNK_TRIPLES') or 50000)
+BULK_CHUNK_BYTES = int(os.getenv('BULK_CHUNK_BYTES') or 16 * 1024 * 1024)
+BULK_PARALLEL = int(os.getenv('BULK_PARALLEL') or 4)
+BULK_RETRIES = int(os.getenv('BULK_RETRIES') or 3)
+BULK_GZIP = (os.getenv('BULK_GZIP') or 'false').lower() in ('1', 'true', 'yes')
+BULK_SKOLEM_BASE = os.getenv('BULK_SKOLEM_BASE') or 'http://data.socialhistory.org/.well-known/genid/'
+
+# Linked Data crawler used to resolve unknown variable definitions: the number of documents
+# fetched concurrently, the maximum number of concurrent requests to (and the minimum delay in
+# seconds between requests to) a single host, the time budget (in seconds) for resolving a URI,
+# and how long (in seconds) documents that could not be retrieved are skipped.
+CRAWLER_CONCURRENCY = int(os.getenv('CRAWLER_CONCURRENCY') or 8)
+CRAWLER_PER_HOST = int(os.getenv('CRAWLER_PER_HOST') or 2)
+CRAWLER_DELAY = float(os.getenv('CRAWLER_DELAY') or 0.1)
+CRAWLER_BUDGET = float(os.getenv('CRAWLER_BUDGET') or 30)
+CRAWLER_FAILURE_TTL = int(os.getenv('CRAWLER_FAILURE_TTL') or 3600)
+
+# Local copy of the Linked Statistical Data dimensions, the service it is refreshed from,
+# and how often (in seconds) to check the service for changes
+LSD_DIMENSIONS_FILE = os.getenv('LSD_DIMENSIONS_FILE') or 'metadata/dimensions.json'
+LSD_DIMENSIONS_URL = os.getenv('LSD_DIMENSIONS_URL') or 'http://amp.ops.few.vu.nl/data.json'
+LSD_REFRESH_INTERVAL = int(os.getenv('LSD_REFRESH_INTERVAL') or 7 * 24 * 3600)
+
+# Local copy of the SKOS schemes from the LOD cloud and HISCO, and how old it may get (in seconds)
+# before it is rebuilt; and how often (in seconds) the catalog of those and the CSDH schemes is rebuilt
+SCHEMES_FILE = os.getenv('SCHEMES_FILE') or 'metadata/schemes.json'
+SCHEMES_MAX_AGE = int(os.getenv('SCHEMES_MAX_AGE') or 7 * 24 * 3600)
+SCHEME_CATALOG_MAX_AGE = int(os.getenv('SCHEME_CATALOG_MAX_AGE') or 300)
+
+# Local SQLite store of external vocabularies such as HISCO (see util/vocabulary.py and manage.py)
+VOCABULARY_FILE = os.getenv('VOCABULARY_FILE') or 'metadata/vocabulary.db'
+
+# Cache of the concepts per scheme (for /community/concepts): how old (in seconds) the concepts of a
+# scheme may get before they are reloaded in the background, the maximum size of the cache (in bytes),
+# the schemes (comma separated URIs) that are loaded in advance when the API starts, and the number of
+# most requested schemes that are reloaded right away (rather than on the next request) when a dataset
+# changes them, out of the (at most) CONCEPT_REQUESTS_SIZE schemes of which the requests are counted
+CONCEPT_CACHE_MAX_AGE = int(os.getenv('CONCEPT_CACHE_MAX_AGE') or 24 * 3600)
+CONCEPT_CACHE_SIZE = int(os.getenv('CONCEPT_CACHE_SIZE') or 128 * 1024 * 1024)
+CONCEPT_PREFETCH = [uri for uri in (os.getenv('CONCEPT_PREFETCH') or '').split(',') if uri]
+CONCEPT_PREFETCH_TOP = int(os.getenv('CONCEPT_PREFETCH_TOP') or 10)
+CONCEPT_REQUESTS_SIZE = int(os.getenv('CONCEPT_REQUESTS_SIZE') or 1000)
+
+# Cache of variable definitions (for /community/definition and /community/definitions): the
+# time-to-live (in seconds), the maximum number of definitions, and the maximum number of
+# variables in a single /community/definitions request
+DEFINITION_CACHE_TTL = int(os.getenv('DEFINITION_CACHE_TTL') or 3600)
+DEFINITION_CACHE_SIZE = int(os.getenv('DEFINITION_CACHE_SIZE') or 100000)
+DEFINITIONS_MAX = int(os.getenv('DEFINITIONS_MAX') or 2000)
+
+# Number of distinct strings of which the baked IRI is remembered, and the maximum number of IRIs per /iri request
+IRI_MEMO_SIZE = int(os.getenv('IRI_MEMO_SIZE') or 100000)
+IRI_BATCH_MAX = int(os.getenv('IRI_BATCH_MAX') or 10000)
+
+# Number of background jobs (e.g. dataset deletions) that run at the same time, and of finished jobs kept
+JOB_WORKERS = int(os.getenv('JOB_WORKERS') or 2)
+JOB_HISTORY = int(os.getenv('JOB_HISTORY') or 1000)
+# Maximum number of triples removed per update when clearing a graph
+CLEAR_CHUNK_SIZE = int(os.getenv('CLEAR_CHUNK_SIZE') or 100000)
+
+# Whether /dataset/submit only publishes the changes to the data structure definition when the same version
+# of the source file was submitted before (can be overridden per request with `diff`)
+SUBMIT_DIFF = (os.getenv('SUBMIT_DIFF') or 'false').lower() in ('1', 'true', 'yes')
+
+# Dataverse configuration
+DATAVERSE_HOST = os.getenv('DATAVERSE_HOST') or '<DATAVERSE_HOST>'  # e.g. dataverse.harvard.edu (without the http:// bit)
+DATAVERSE_TOKEN = os.getenv('DATAVERSE_TOKEN') or '<API TOKEN>'  # The API token key for connecting to dataverse
+
+# Is the API running behind a proxy?
+BEHIND_PROXY = os.getenv('BEHIND_PROXY') or False
+
+# Should the API log at DEBUG level?
+DEBUG = os.getenv('DEBUG') or True
+
+# Stardog specific stuff
+# (these are the default settings for HTTP Basic authenticating)
+REASONING_TYPE = 'NONE'
+AUTH = ('admin', 'admin')
+
+# Respond to GitHub webhooks
+FOLLOW_GITHUB = os.getenv('FOLLOW_GITHUB') or True
+FOLLOW_REPO = os.getenv('FOLLOW_REPO') or 'https://github.com/CLARIAH/wp4-datalegend-api'
+FOLLOW_REF = os.getenv('FOLLOW_REF') or 'refs/heads/master'
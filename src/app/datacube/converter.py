@@ -1,6 +1,13 @@
 from rdflib import Dataset, Namespace, Literal, URIRef, RDF, RDFS, XSD
+from rdflib.graph import DATASET_DEFAULT_GRAPH_ID
+from cStringIO import StringIO
 import datetime
-import iribaker
+import multiprocessing
+from gevent import monkey
+
+import app.util.iri as ib
+
+import writer
 
 QBRV = Namespace('http://data.socialhistory.org/vocab/')
 QBR = Namespace('http://data.socialhistory.org/resource/')
@@ -11,6 +18,30 @@ PROV = Namespace('http://www.w3.org/ns/prov#')
 NP = Namespace('http://www.nanopub.org/nschema#')
 FOAF = Namespace('http://xmlns.com/foaf/0.1/')
 
+# The terms generated for every value of a variable, created once: looking them up in the namespaces every time
+# takes about as long as the rest of variable_triples, and the worker processes of assertion_triples send the
+# same object only once per variable (rather than a copy per statement)
+RDF_TYPE = RDF.type
+RDFS_LABEL = RDFS.label
+SKOS_CONCEPT = SKOS['Concept']
+SKOS_PREF_LABEL = SKOS['prefLabel']
+SKOS_MEMBER = SKOS['member']
+SKOS_EXACT_MATCH = SKOS['exactMatch']
+
+# The predicates of the statements that assertion_triples generates, and the classes of its rdf:type statements:
+# data_structure_delta leaves the other statements in an assertion graph (such as the observations that the
+# converter adds) alone
+STRUCTURE_PREDICATES = frozenset([RDF.type, RDFS.label, RDFS.comment, RDFS.subPropertyOf, QB['structure'],
+                                  QB['component'], QB['dimension'], QB['measure'], QB['attribute'], QB['codeList'],
+                                  PROV['wasDerivedFrom'], SKOS['prefLabel'], SKOS['member'], SKOS['exactMatch']])
+STRUCTURE_CLASSES = frozenset([QB['DataSet'], QB['DataStructureDefinition'], QB['DimensionProperty'],
+                               QB['CodedProperty'], QB['MeasureProperty'], QB['AttributeProperty'],
+                               SKOS['Collection'], SKOS['Concept']])
+
+# The prefixes used in the serializations of nanopublications
+NAMESPACES = [('qbrv', QBRV), ('qbr', QBR), ('qb', QB), ('skos', SKOS), ('prov', PROV), ('np', NP), ('foaf', FOAF),
+              ('rdf', RDF), ('rdfs', RDFS), ('xsd', XSD)]
+
 
 def safe_url(NS, local):
     """Generates a URIRef from the namespace + local part that is safe for
@@ -20,7 +51,7 @@ def safe_url(NS, local):
     NS      -- a @Namespace object
     local   -- the local name of the resource
     """
-    return URIRef(iribaker.to_iri(NS[local]))
+    return URIRef(ib.to_iri(NS[local]))
 
 
 def get_base_uri(dataset):
@@ -31,17 +62,18 @@ def get_value_uri(dataset, variable, value):
     """Generates a variable value IRI for a given combination of dataset, variable and value"""
     BASE = get_base_uri(dataset)
 
-    return iribaker.to_iri(BASE['code/' + variable + '/' + value])
+    return ib.to_iri(BASE['code/' + variable + '/' + value])
 
 
 def get_variable_uri(dataset, variable):
     """Generates a variable IRI for a given combination of dataset and variable"""
     BASE = get_base_uri(dataset)
 
-    return iribaker.to_iri(BASE[variable])
+    return ib.to_iri(BASE[variable])
 
 
-def data_structure_definition(profile, dataset_name, dataset_base_uri, variables, source_path, source_hash):
+def data_structure_definition(profile, dataset_name, dataset_base_uri, variables, source_path, source_hash,
+                              timestamp=None, processes=1):
     """Converts the dataset + variables to a set of rdflib Graphs (a nanopublication with provenance annotations)
     that contains the data structure definition (from the DataCube vocabulary) and
     the mappings to external datasets.
@@ -52,24 +84,53 @@ def data_structure_definition(profile, dataset_name, dataset_base_uri, variables
     profile     -- the Google signin profile
     source_path -- the path to the dataset file that was annotated
     source_hash -- the Git hash of the dataset file version of the dataset
+    timestamp   -- the time of publication (a datetime, defaults to now)
+    processes   -- the number of worker processes that generate the triples of the variables (see
+                   assertion_triples), for datasets with many (coded) variables
 
     :returns: an RDF graph store containing a nanopublication
     """
-    BASE = Namespace('{}/'.format(dataset_base_uri))
-    dataset_uri = URIRef(dataset_base_uri)
-
     # Initialize a conjunctive graph for the whole lot
     rdf_dataset = Dataset()
-    rdf_dataset.bind('qbrv', QBRV)
-    rdf_dataset.bind('qbr', QBR)
-    rdf_dataset.bind('qb', QB)
-    rdf_dataset.bind('skos', SKOS)
-    rdf_dataset.bind('prov', PROV)
-    rdf_dataset.bind('np', NP)
-    rdf_dataset.bind('foaf', FOAF)
+    for prefix, namespace in NAMESPACES:
+        rdf_dataset.bind(prefix, namespace)
+
+    graphs = {None: rdf_dataset}
+    for s, p, o, g in data_structure_quads(profile, dataset_name, dataset_base_uri, variables, source_path,
+                                           source_hash, timestamp=timestamp, processes=processes):
+        if g not in graphs:
+            graphs[g] = rdf_dataset.graph(g)
+        graphs[g].add((s, p, o))
+
+    return rdf_dataset
+
+
+def write_data_structure_definition(out, profile, dataset_name, dataset_base_uri, variables, source_path, source_hash,
+                                    timestamp=None, format='nquads', processes=1):
+    """Writes the nanopublication of data_structure_definition to the file `out`, as N-Quads or TriG,
+    without building an rdflib graph store first (see writer.py)"""
+    quads = data_structure_quads(profile, dataset_name, dataset_base_uri, variables, source_path, source_hash,
+                                 timestamp=timestamp, processes=processes)
+
+    if format == 'nquads':
+        writer.write_nquads(quads, out)
+    elif format == 'trig':
+        writer.write_trig(quads, out, NAMESPACES)
+    else:
+        raise Exception("Unsupported format: {}".format(format))
+
+
+def data_structure_quads(profile, dataset_name, dataset_base_uri, variables, source_path, source_hash,
+                         timestamp=None, processes=1):
+    """Generates the statements of the nanopublication of data_structure_definition, as (subject, predicate,
+    object, graph) tuples, grouped by graph. The graph of statements in the default graph is None.
+
+    Statements may be generated more than once (e.g. when variables share values)."""
+    BASE = Namespace('{}/'.format(dataset_base_uri))
+    dataset_uri = URIRef(dataset_base_uri)
 
     # Initialize the graphs needed for the nanopublication
-    timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M")
+    timestamp = (timestamp or datetime.datetime.utcnow()).strftime("%Y-%m-%dT%H:%M")
 
     # Shorten the source hash to 8 digits (similar to Github)
     source_hash = source_hash[:8]
@@ -78,56 +139,44 @@ def data_structure_definition(profile, dataset_name, dataset_base_uri, variables
 
     # The Nanopublication consists of three graphs
     assertion_graph_uri = BASE['assertion/' + hash_part]
-    assertion_graph = rdf_dataset.graph(assertion_graph_uri)
-
     provenance_graph_uri = BASE['provenance/' + hash_part]
-    provenance_graph = rdf_dataset.graph(provenance_graph_uri)
-
     pubinfo_graph_uri = BASE['pubinfo/' + hash_part]
-    pubinfo_graph = rdf_dataset.graph(pubinfo_graph_uri)
 
     # A URI that represents the author
     author_uri = QBR['person/' + profile['email']]
 
-    rdf_dataset.add((author_uri, RDF.type, FOAF['Person']))
-    rdf_dataset.add((author_uri, FOAF['name'], Literal(profile['name'])))
-    rdf_dataset.add((author_uri, FOAF['email'], Literal(profile['email'])))
-    rdf_dataset.add((author_uri, QBRV['googleId'], Literal(profile['id'])))
-    try:
-        rdf_dataset.add((author_uri, FOAF['depiction'], URIRef(profile['image'])))
-    except KeyError: 
-        pass 
-    
+    for s, p, o in author_triples(author_uri, profile):
+        yield s, p, o, None
+
     # A URI that represents the version of the dataset source file
     dataset_version_uri = BASE[source_hash]
 
     # Some information about the source file used
-    rdf_dataset.add((dataset_version_uri, QBRV['path'], Literal(source_path, datatype=XSD.string)))
-    rdf_dataset.add((dataset_version_uri, QBRV['sha1_hash'], Literal(source_hash, datatype=XSD.string)))
+    yield dataset_version_uri, QBRV['path'], Literal(source_path, datatype=XSD.string), None
+    yield dataset_version_uri, QBRV['sha1_hash'], Literal(source_hash, datatype=XSD.string), None
 
     # ----
     # The nanopublication itself
     # ----
     nanopublication_uri = BASE['nanopublication/' + hash_part]
 
-    rdf_dataset.add((nanopublication_uri, RDF.type, NP['Nanopublication']))
-    rdf_dataset.add((nanopublication_uri, NP['hasAssertion'], assertion_graph_uri))
-    rdf_dataset.add((assertion_graph_uri, RDF.type, NP['Assertion']))
-    rdf_dataset.add((nanopublication_uri, NP['hasProvenance'], provenance_graph_uri))
-    rdf_dataset.add((provenance_graph_uri, RDF.type, NP['Provenance']))
-    rdf_dataset.add((nanopublication_uri, NP['hasPublicationInfo'], pubinfo_graph_uri))
-    rdf_dataset.add((pubinfo_graph_uri, RDF.type, NP['PublicationInfo']))
+    yield nanopublication_uri, RDF.type, NP['Nanopublication'], None
+    yield nanopublication_uri, NP['hasAssertion'], assertion_graph_uri, None
+    yield assertion_graph_uri, RDF.type, NP['Assertion'], None
+    yield nanopublication_uri, NP['hasProvenance'], provenance_graph_uri, None
+    yield provenance_graph_uri, RDF.type, NP['Provenance'], None
+    yield nanopublication_uri, NP['hasPublicationInfo'], pubinfo_graph_uri, None
+    yield pubinfo_graph_uri, RDF.type, NP['PublicationInfo'], None
 
     # ----
     # The provenance graph
     # ----
 
     # Provenance information for the assertion graph (the data structure definition itself)
-    provenance_graph.add((assertion_graph_uri, PROV['wasDerivedFrom'], dataset_version_uri))
-    provenance_graph.add((dataset_uri, PROV['wasDerivedFrom'], dataset_version_uri))
-    provenance_graph.add((assertion_graph_uri, PROV['generatedAtTime'],
-                          Literal(timestamp, datatype=XSD.datetime)))
-    provenance_graph.add((assertion_graph_uri, PROV['wasAttributedTo'], author_uri))
+    yield assertion_graph_uri, PROV['wasDerivedFrom'], dataset_version_uri, provenance_graph_uri
+    yield dataset_uri, PROV['wasDerivedFrom'], dataset_version_uri, provenance_graph_uri
+    yield assertion_graph_uri, PROV['generatedAtTime'], Literal(timestamp, datatype=XSD.datetime), provenance_graph_uri
+    yield assertion_graph_uri, PROV['wasAttributedTo'], author_uri, provenance_graph_uri
 
     # ----
     # The publication info graph
@@ -138,142 +187,261 @@ def data_structure_definition(profile, dataset_name, dataset_base_uri, variables
     # TODO: consider linking to this as the plan of some activity, rather than an activity itself.
     qber_uri = URIRef('https://github.com/CLARIAH/qber.git')
 
-    pubinfo_graph.add((nanopublication_uri, PROV['wasGeneratedBy'], qber_uri))
-    pubinfo_graph.add((nanopublication_uri, PROV['generatedAtTime'],
-                      Literal(timestamp, datatype=XSD.datetime)))
-    pubinfo_graph.add((nanopublication_uri, PROV['wasAttributedTo'], author_uri))
+    yield nanopublication_uri, PROV['wasGeneratedBy'], qber_uri, pubinfo_graph_uri
+    yield nanopublication_uri, PROV['generatedAtTime'], Literal(timestamp, datatype=XSD.datetime), pubinfo_graph_uri
+    yield nanopublication_uri, PROV['wasAttributedTo'], author_uri, pubinfo_graph_uri
 
     # ----
     # The assertion graph
     # ----
+    for s, p, o in assertion_triples(BASE, dataset_uri, dataset_name, variables, processes=processes):
+        yield s, p, o, assertion_graph_uri
 
-    structure_uri = BASE['structure']
 
-    assertion_graph.add((dataset_uri, RDF.type, QB['DataSet']))
-    assertion_graph.add((dataset_uri, RDFS.label, Literal(dataset_name)))
-    assertion_graph.add((structure_uri, RDF.type, QB['DataStructureDefinition']))
+def data_structure_delta(previous, profile, dataset_name, dataset_base_uri, variables, source_hash, timestamp=None,
+                         processes=1):
+    """Compares the assertion graph of data_structure_definition with that of an earlier publication of
+    the same dataset and source file, and returns the statements to remove from and to add to the earlier
+    assertion graph, as (subject, predicate, object, graph) tuples (see data_structure_quads).
 
-    assertion_graph.add((dataset_uri, QB['structure'], structure_uri))
+    Only the statements of the earlier assertion graph that assertion_triples could have generated are
+    compared (see is_structure_triple), so that nothing else the converter wrote to it is ever removed.
 
-    for variable_id, variable in variables.items():
-        variable_uri = URIRef(variable['original']['uri'])
-        variable_label = Literal(variable['original']['label'])
-        variable_type = URIRef(variable['type'])
+    The statements to add include a revision in the earlier provenance graph that records when, by whom,
+    and how many triples were removed and added. Both lists are empty if nothing changed.
 
-        codelist_uri = URIRef(variable['codelist']['original']['uri'])
-        codelist_label = Literal(variable['codelist']['original']['label'])
+    Arguments:
+    previous    -- a dictionary with the `assertion` and `provenance` graph URIs of the earlier
+                   publication, and the `triples` in its assertion graph
+    timestamp   -- the time of the revision (a datetime, defaults to now)
+    (the other arguments are those of data_structure_definition)
 
-        # The variable as component of the definition
-        component_uri = safe_url(BASE, 'component/' + variable['original']['label'])
+    :returns: a (removed, added) tuple of lists of statements
+    """
+    BASE = Namespace('{}/'.format(dataset_base_uri))
+    assertion_graph_uri = URIRef(previous['assertion'])
+    provenance_graph_uri = URIRef(previous['provenance'])
 
-        # Add link between the definition and the component
-        assertion_graph.add((structure_uri, QB['component'], component_uri))
+    triples = set(assertion_triples(BASE, URIRef(dataset_base_uri), dataset_name, variables, processes=processes))
+    subjects = set(s for s, _, _ in triples) | structure_subjects(previous['triples'], BASE['structure'])
+    previous_triples = set(t for t in previous['triples'] if is_structure_triple(t, subjects))
 
-        # Add label to variable
-        # TODO: We may need to do something with a changed label for the variable
-        assertion_graph.add((variable_uri, RDFS.label, variable_label))
+    # Sorted, so that the same change always results in the same update
+    def statements(triples):
+        return [(s, p, o, assertion_graph_uri) for s, p, o in sorted(triples, key=lambda t: [n.n3() for n in t])]
 
-        if 'description' in variable and variable['description'] != "":
-            assertion_graph.add((variable_uri, RDFS.comment, Literal(variable['description'])))
+    removed = statements(previous_triples - triples)
+    added = statements(triples - previous_triples)
 
-        # If the variable URI is not the same as the original,
-        # it is a specialization of a prior variable property.
-        if variable['uri'] != str(variable_uri):
-            assertion_graph.add((variable_uri,
-                                 RDFS['subPropertyOf'],
-                                 URIRef(variable['uri'])))
+    if not removed and not added:
+        return [], []
 
-        if variable_type == QB['DimensionProperty']:
-            assertion_graph.add((variable_uri, RDF.type, variable_type))
-            assertion_graph.add((component_uri, QB['dimension'], variable_uri))
+    removed_count, added_count = len(removed), len(added)
 
-            # Coded variables are also of type coded property (a subproperty of dimension property)
-            if variable['category'] == 'coded':
-                assertion_graph.add((variable_uri, RDF.type, QB['CodedProperty']))
+    # With seconds, as a dataset may well be revised more than once a minute
+    timestamp = (timestamp or datetime.datetime.utcnow()).strftime("%Y-%m-%dT%H:%M:%S")
+    revision_uri = BASE['revision/' + source_hash[:8] + '/' + timestamp]
+    author_uri = QBR['person/' + profile['email']]
 
-        elif variable_type == QB['MeasureProperty']:
-            # The category 'other'
-            assertion_graph.add((variable_uri, RDF.type, variable_type))
-            assertion_graph.add((component_uri, QB['measure'], variable_uri))
-        elif variable_type == QB['AttributeProperty']:
-            # Actually never produced by QBer at this stage
-            assertion_graph.add((variable_uri, RDF.type, variable_type))
-            assertion_graph.add((component_uri, QB['attribute'], variable_uri))
+    for s, p, o in author_triples(author_uri, profile):
+        added.append((s, p, o, None))
 
-        # If this variable is of category 'coded', we add codelist and URIs for
-        # each variable (including mappings between value uris and etc....)
-        if variable['category'] == 'coded':
-            assertion_graph.add((codelist_uri, RDF.type, SKOS['Collection']))
-            assertion_graph.add((codelist_uri, RDFS.label, Literal(codelist_label)))
-
-            # The variable should point to the codelist
-            assertion_graph.add((variable_uri, QB['codeList'], codelist_uri))
-
-            # The variable is mapped onto an external code list.
-            # If the codelist uri is not the same as the original one, we
-            # have a derived codelist.
-            if variable['codelist']['uri'] != str(codelist_uri):
-                assertion_graph.add((codelist_uri,
-                                     PROV['wasDerivedFrom'],
-                                     URIRef(variable['codelist']['uri'])))
-
-            # Generate a SKOS concept for each of the values and map it to the
-            # assigned codelist
-            for value in variable['values']:
-                value_uri = URIRef(value['original']['uri'])
-                value_label = Literal(value['original']['label'])
-
-                assertion_graph.add((value_uri, RDF.type, SKOS['Concept']))
-                assertion_graph.add((value_uri, SKOS['prefLabel'], Literal(value_label)))
-                assertion_graph.add((codelist_uri, SKOS['member'], value_uri))
-
-                # The value has been changed, and therefore there is a mapping
-                if value['original']['uri'] != value['uri']:
-                    assertion_graph.add((value_uri, SKOS['exactMatch'], URIRef(value['uri'])))
-                    assertion_graph.add((value_uri, RDFS.label, Literal(value['label'])))
-
-        elif variable['category'] == 'identifier':
-            # Generate a SKOS concept for each of the values
-            for value in variable['values']:
-                value_uri = URIRef(value['original']['uri'])
-                value_label = Literal(value['original']['label'])
-
-                assertion_graph.add((value_uri, RDF.type, SKOS['Concept']))
-                assertion_graph.add((value_uri, SKOS['prefLabel'], value_label))
-
-                # The value has been changed, and therefore there is a mapping
-                if value['original']['uri'] != value['uri']:
-                    assertion_graph.add((value_uri, SKOS['exactMatch'], URIRef(value['uri'])))
-                    assertion_graph.add((value_uri, RDFS.label, Literal(value['label'])))
-
-        elif variable['category'] == 'other':
-            # Generate a literal for each of the values when converting the dataset (but not here)
-            pass
+    added.extend([
+        (assertion_graph_uri, QBRV['revision'], revision_uri, provenance_graph_uri),
+        (revision_uri, RDF.type, PROV['Activity'], provenance_graph_uri),
+        (revision_uri, PROV['endedAtTime'], Literal(timestamp, datatype=XSD.datetime), provenance_graph_uri),
+        (revision_uri, PROV['wasAssociatedWith'], author_uri, provenance_graph_uri),
+        (revision_uri, QBRV['removedTriples'], Literal(removed_count), provenance_graph_uri),
+        (revision_uri, QBRV['addedTriples'], Literal(added_count), provenance_graph_uri),
+    ])
 
-    return rdf_dataset
+    return removed, added
 
 
-def reindent(s, numSpaces):
-    s = s.split('\n')
-    s = [(numSpaces * ' ') + string.lstrip(line) for line in s]
-    s = "\n".join(s)
-    return s
+def structure_subjects(triples, structure_uri):
+    """The resources that the data structure definition in the triples describes: the components of the
+    structure, and everything of one of the classes that assertion_triples generates"""
+    subjects = set()
+    for s, p, o in triples:
+        if (p == RDF.type and o in STRUCTURE_CLASSES) or (s == structure_uri and p == QB['component']):
+            subjects.add(s if p == RDF.type else o)
 
-# Because Trig serialization in RDFLib is extremely crappy
-import string
+    return subjects
 
 
-def serializeTrig(rdf_dataset):
-    turtles = []
+def is_structure_triple(triple, subjects):
+    """Whether assertion_triples could have generated the statement: one of its predicates (and classes),
+    about one of the `subjects` of the data structure definition"""
+    s, p, o = triple
+    if p not in STRUCTURE_PREDICATES or (p == RDF.type and o not in STRUCTURE_CLASSES):
+        return False
+
+    return s in subjects
+
+
+def author_triples(author_uri, profile):
+    """Generates the description of the author, from the Google signin profile"""
+    yield author_uri, RDF.type, FOAF['Person']
+    yield author_uri, FOAF['name'], Literal(profile['name'])
+    yield author_uri, FOAF['email'], Literal(profile['email'])
+    yield author_uri, QBRV['googleId'], Literal(profile['id'])
+    if 'image' in profile:
+        yield author_uri, FOAF['depiction'], URIRef(profile['image'])
+
+
+def assertion_triples(BASE, dataset_uri, dataset_name, variables, processes=1):
+    """Generates the data structure definition of the dataset, and the mappings of its variables (in the
+    order of their names). With `processes` > 1, the triples of the variables are generated by that many
+    worker processes, and merged in the same order.
+
+    Worker processes cannot be used in a process that gevent patched (such as the API), where they would
+    never return their results, and would be forked with its connections: this raises an exception."""
+    structure_uri = BASE['structure']
+
+    yield dataset_uri, RDF.type, QB['DataSet']
+    yield dataset_uri, RDFS.label, Literal(dataset_name)
+    yield structure_uri, RDF.type, QB['DataStructureDefinition']
+
+    yield dataset_uri, QB['structure'], structure_uri
+
+    arguments = [(BASE, structure_uri, variable) for _, variable in sorted(variables.items())]
+
+    if processes > 1 and len(arguments) > 1:
+        if monkey.is_module_patched('threading'):
+            raise Exception("Cannot generate the variables in worker processes in a process patched by gevent")
+
+        pool = multiprocessing.Pool(min(processes, len(arguments)))
+        try:
+            # imap returns the results in order, while the workers may finish in any order
+            for triples in pool.imap(variable_triple_list, arguments,
+                                     chunksize=max(1, len(arguments) // (4 * processes))):
+                for triple in triples:
+                    yield triple
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for argument in arguments:
+            for triple in variable_triples(*argument):
+                yield triple
+
+
+def variable_triple_list(arguments):
+    # The (picklable) function that the worker processes of assertion_triples run
+    return list(variable_triples(*arguments))
+
+
+def variable_triples(BASE, structure_uri, variable):
+    """Generates the component of the variable, and its code list, concepts and mappings"""
+    variable_uri = URIRef(variable['original']['uri'])
+    variable_label = Literal(variable['original']['label'])
+    variable_type = URIRef(variable['type'])
+
+    codelist_uri = URIRef(variable['codelist']['original']['uri'])
+    codelist_label = Literal(variable['codelist']['original']['label'])
+
+    # The variable as component of the definition
+    component_uri = safe_url(BASE, 'component/' + variable['original']['label'])
+
+    # Add link between the definition and the component
+    yield structure_uri, QB['component'], component_uri
+
+    # Add label to variable
+    # TODO: We may need to do something with a changed label for the variable
+    yield variable_uri, RDFS.label, variable_label
+
+    if 'description' in variable and variable['description'] != "":
+        yield variable_uri, RDFS.comment, Literal(variable['description'])
+
+    # If the variable URI is not the same as the original,
+    # it is a specialization of a prior variable property.
+    if variable['uri'] != str(variable_uri):
+        yield variable_uri, RDFS['subPropertyOf'], URIRef(variable['uri'])
+
+    if variable_type == QB['DimensionProperty']:
+        yield variable_uri, RDF.type, variable_type
+        yield component_uri, QB['dimension'], variable_uri
+
+        # Coded variables are also of type coded property (a subproperty of dimension property)
+        if variable['category'] == 'coded':
+            yield variable_uri, RDF.type, QB['CodedProperty']
+
+    elif variable_type == QB['MeasureProperty']:
+        # The category 'other'
+        yield variable_uri, RDF.type, variable_type
+        yield component_uri, QB['measure'], variable_uri
+    elif variable_type == QB['AttributeProperty']:
+        # Actually never produced by QBer at this stage
+        yield variable_uri, RDF.type, variable_type
+        yield component_uri, QB['attribute'], variable_uri
+
+    # If this variable is of category 'coded', we add codelist and URIs for
+    # each variable (including mappings between value uris and etc....)
+    if variable['category'] == 'coded':
+        yield codelist_uri, RDF.type, SKOS['Collection']
+        yield codelist_uri, RDFS.label, Literal(codelist_label)
+
+        # The variable should point to the codelist
+        yield variable_uri, QB['codeList'], codelist_uri
+
+        # The variable is mapped onto an external code list.
+        # If the codelist uri is not the same as the original one, we
+        # have a derived codelist.
+        if variable['codelist']['uri'] != str(codelist_uri):
+            yield codelist_uri, PROV['wasDerivedFrom'], URIRef(variable['codelist']['uri'])
+
+        # Generate a SKOS concept for each of the values and map it to the
+        # assigned codelist
+        for value in variable['values']:
+            value_uri = URIRef(value['original']['uri'])
+            value_label = Literal(value['original']['label'])
+
+            yield value_uri, RDF_TYPE, SKOS_CONCEPT
+            yield value_uri, SKOS_PREF_LABEL, value_label
+            yield codelist_uri, SKOS_MEMBER, value_uri
+
+            # The value has been changed, and therefore there is a mapping
+            if value['original']['uri'] != value['uri']:
+                yield value_uri, SKOS_EXACT_MATCH, URIRef(value['uri'])
+                yield value_uri, RDFS_LABEL, Literal(value['label'])
+
+    elif variable['category'] == 'identifier':
+        # Generate a SKOS concept for each of the values
+        for value in variable['values']:
+            value_uri = URIRef(value['original']['uri'])
+            value_label = Literal(value['original']['label'])
+
+            yield value_uri, RDF_TYPE, SKOS_CONCEPT
+            yield value_uri, SKOS_PREF_LABEL, value_label
+
+            # The value has been changed, and therefore there is a mapping
+            if value['original']['uri'] != value['uri']:
+                yield value_uri, SKOS_EXACT_MATCH, URIRef(value['uri'])
+                yield value_uri, RDFS_LABEL, Literal(value['label'])
+
+    elif variable['category'] == 'other':
+        # Generate a literal for each of the values when converting the dataset (but not here)
+        pass
+
+
+def serializeTrig(rdf_dataset, out=None):
+    """Serializes the graph store as TriG (see writer.TrigWriter), with the prefixes bound in it, to the
+    file `out` or, if not given, to a string that is returned"""
+    target = out if out is not None else StringIO()
+
+    trig = writer.TrigWriter(target, rdf_dataset.namespaces())
     for c in rdf_dataset.contexts():
-        if c.identifier != URIRef('urn:x-rdflib:default'):
-            turtle = "<{id}> {{\n".format(id=c.identifier)
-            turtle += reindent(c.serialize(format='turtle'), 4)
-            turtle += "}\n\n"
-        else:
-            turtle = c.serialize(format='turtle')
-            turtle += "\n\n"
+        graph_uri = None if c.identifier == DATASET_DEFAULT_GRAPH_ID else c.identifier
+
+        # Group the statements by subject (in order), so that the writer can abbreviate them
+        subjects = {}
+        for s, p, o in c:
+            subjects.setdefault(s, []).append((p, o))
 
-        turtles.append(turtle)
+        for s in sorted(subjects, key=unicode):
+            for p, o in subjects[s]:
+                trig.write(s, p, o, graph_uri)
+    trig.close()
 
-    return "\n".join(turtles)
+    if out is None:
+        return target.getvalue()
@@ -0,0 +1,127 @@
+"""Streaming writers for (subject, predicate, object, graph) statements, such as those of
+converter.data_structure_quads. Statements are written as they are generated, without collecting
+them in an rdflib graph first. The graph of statements in the default graph is None."""
+import re
+
+from rdflib import Literal, BNode, RDF
+
+# Local names that can safely be written as prefixed names (a conservative subset of PN_LOCAL)
+LOCAL_NAME = re.compile(r'^[A-Za-z0-9_]([A-Za-z0-9_\-]*)$')
+
+
+def write_nquads(quads, out):
+    """Writes the statements to the file `out` as N-Quads (one statement per line, UTF-8)"""
+    for s, p, o, g in quads:
+        if g is None:
+            out.write("{} {} {} .\n".format(term(s), term(p), term(o)))
+        else:
+            out.write("{} {} {} {} .\n".format(term(s), term(p), term(o), term(g)))
+
+
+def write_trig(quads, out, namespaces=()):
+    """Writes the statements to the file `out` as TriG (see TrigWriter)"""
+    trig = TrigWriter(out, namespaces)
+    for s, p, o, g in quads:
+        trig.write(s, p, o, g)
+    trig.close()
+
+
+class TrigWriter(object):
+    """Writes statements to a file (or socket) as TriG, while they are generated.
+
+    IRIs in one of the `namespaces` (prefix, namespace pairs) are written as prefixed names, and
+    consecutive statements about the same subject share it (`;`). Every run of statements in the same
+    graph is written as one graph block, so statements should be grouped by graph (TriG allows more
+    blocks for the same graph, but the output is smaller if they are). Output is UTF-8.
+    """
+
+    def __init__(self, out, namespaces=()):
+        self.out = out
+        self.prefixes = {}
+        self.graph = None
+        self.subject = None
+        self.indent = ""
+        # The serializations of predicates and graph names, of which there are few
+        self.names = {RDF.type: "a"}
+
+        for prefix, namespace in namespaces:
+            namespace = unicode(namespace)
+            if prefix and namespace not in self.prefixes:
+                self.prefixes[namespace] = prefix
+                out.write("@prefix {}: <{}> .\n".format(prefix.encode('utf-8'), namespace.encode('utf-8')))
+        out.write("\n")
+
+    def write(self, s, p, o, g=None):
+        # Compare serializations rather than rdflib terms, which is much faster
+        graph = self.name(g) if g is not None else None
+        if graph != self.graph:
+            self.end_graph()
+            if graph is not None:
+                self.out.write("{} {{\n".format(graph))
+                self.indent = "    "
+            self.graph = graph
+
+        subject = self.term(s)
+        if subject == self.subject:
+            self.out.write(" ;\n{}    {} {}".format(self.indent, self.name(p), self.term(o)))
+        else:
+            if self.subject is not None:
+                self.out.write(" .\n")
+            self.out.write("{}{} {} {}".format(self.indent, subject, self.name(p), self.term(o)))
+            self.subject = subject
+
+    def end_graph(self):
+        if self.subject is None and self.graph is None:
+            return
+
+        if self.subject is not None:
+            self.out.write(" .\n")
+            self.subject = None
+        if self.graph is not None:
+            self.out.write("}\n")
+            self.graph = None
+            self.indent = ""
+        self.out.write("\n")
+
+    def close(self):
+        self.end_graph()
+
+    def name(self, node):
+        name = self.names.get(node)
+        if name is None:
+            name = self.names[node] = self.term(node)
+        return name
+
+    def term(self, node):
+        if isinstance(node, Literal):
+            if node.datatype and not node.language:
+                return '"{}"^^{}'.format(escape(node).encode('utf-8'), self.term(node.datatype))
+            return term(node)
+        elif isinstance(node, BNode):
+            return term(node)
+
+        split = max(node.rfind(u'/'), node.rfind(u'#')) + 1
+        prefix = self.prefixes.get(node[:split]) if split > 0 else None
+        if prefix is not None and LOCAL_NAME.match(node[split:]):
+            return "{}:{}".format(prefix.encode('utf-8'), node[split:].encode('utf-8'))
+
+        return term(node)
+
+
+def term(node):
+    """The N-Triples representation of the URI, blank node or literal, as UTF-8"""
+    if isinstance(node, Literal):
+        value = u'"{}"'.format(escape(node))
+        if node.language:
+            value += u'@' + node.language
+        elif node.datatype:
+            value += u'^^<{}>'.format(node.datatype)
+        return value.encode('utf-8')
+    elif isinstance(node, BNode):
+        return '_:' + node.encode('utf-8')
+    else:
+        return '<' + node.encode('utf-8') + '>'
+
+
+def escape(value):
+    return value.replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n').replace(u'\r', u'\\r')
@@ -0,0 +1,190 @@
+import re
+import gzip
+import time
+import uuid
+import logging
+import traceback
+from StringIO import StringIO
+
+import gevent
+from gevent.pool import Pool
+
+import app.config as config
+import sparql_client as sc
+
+from app import app
+
+log = app.logger
+log.setLevel(logging.DEBUG)
+
+
+IRI = r'<[^>]*>'
+BNODE = r'_:\S+'
+LITERAL = r'"(?:[^"\\]|\\.)*"(?:@[A-Za-z0-9-]+|\^\^<[^>]*>)?'
+
+# An N-Quads statement: subject, predicate, object and (optionally) the graph label
+NQUAD_PATTERN = re.compile(r'^\s*(?:{IRI}|{BNODE})\s+{IRI}\s+(?:{IRI}|{BNODE}|{LITERAL})\s*(?:({IRI}|{BNODE})\s*)?\.\s*$'
+                           .format(IRI=IRI, BNODE=BNODE, LITERAL=LITERAL))
+
+# The blank nodes in a statement (IRIs and literals are matched as well, so that their contents are skipped)
+BNODE_PATTERN = re.compile(r'({IRI}|{LITERAL})|_:([A-Za-z0-9_\-.]*[A-Za-z0-9_\-])'.format(IRI=IRI, LITERAL=LITERAL))
+
+
+class Chunk(object):
+    """A bounded run of N-Triples lines destined for a single graph"""
+
+    def __init__(self, number, graph_uri):
+        self.number = number
+        self.graph_uri = graph_uri
+        self.lines = []
+        self.size = 0
+
+    def add(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+
+
+def chunks(lines, graph_uri=None, format='nt',
+           max_triples=config.BULK_CHUNK_TRIPLES, max_bytes=config.BULK_CHUNK_BYTES, skolem_base=None):
+    """Splits a stream of N-Triples (or N-Quads) lines into chunks of at most `max_triples`
+    triples and `max_bytes` bytes, each of which belongs to a single graph.
+
+    For N-Triples all chunks go to `graph_uri`; for N-Quads the graph label is stripped
+    from every statement, and the triple goes to the chunk of its graph (or to `graph_uri`
+    if the statement has no graph label).
+
+    A blank node is only the same node within a single upload, so with a `skolem_base`, every blank
+    node is replaced by an IRI under it (see skolemize), and the chunks can be split anywhere.
+    """
+    open_chunks = {}
+    number = 0
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        if skolem_base is not None and '_:' in line:
+            line = skolemize(line, skolem_base)
+
+        target = graph_uri
+        if format == 'nq':
+            match = NQUAD_PATTERN.match(line)
+            if match is None:
+                raise Exception("Not a valid N-Quads statement: {}".format(line[:200]))
+            if match.group(1) is not None:
+                target = match.group(1)[1:-1]
+                line = line[:match.start(1)].rstrip() + ' .'
+
+        chunk = open_chunks.get(target)
+        if chunk is None:
+            chunk = open_chunks[target] = Chunk(number, target)
+            number += 1
+
+        chunk.add(line + '\n')
+
+        if len(chunk.lines) >= max_triples or chunk.size >= max_bytes:
+            del open_chunks[target]
+            yield chunk
+
+    for chunk in sorted(open_chunks.values(), key=lambda c: c.number):
+        yield chunk
+
+
+def bulk_load(lines, graph_uri=None, format='nt', endpoint_url=config.CRUD_URL,
+              max_triples=config.BULK_CHUNK_TRIPLES, max_bytes=config.BULK_CHUNK_BYTES,
+              parallel=config.BULK_PARALLEL, retries=config.BULK_RETRIES, compress=config.BULK_GZIP,
+              progress=None):
+    """Loads a stream of N-Triples or N-Quads lines (e.g. an open file) into the store in chunks.
+
+    Chunks are uploaded to the CRUD endpoint as they are read, `parallel` at a time; only those
+    chunks are held in memory. Failed chunks are retried `retries` times with exponential backoff.
+    Blank nodes are replaced by IRIs under BULK_SKOLEM_BASE, unique to this load (see chunks).
+
+    Arguments:
+    lines       -- an iterable of N-Triples or N-Quads statements
+    graph_uri   -- the graph to load the triples into (for N-Quads: statements without graph label)
+    format      -- 'nt' or 'nq'
+    compress    -- whether to gzip the request bodies
+    progress    -- an optional function that is called with the report of every chunk
+
+    :returns: a list of reports (dicts) with the graph, size, duration, attempts and status of every chunk
+    """
+    def upload(chunk):
+        data = "".join(chunk.lines)
+        headers = {'Content-Type': 'application/n-triples'}
+        if compress:
+            data = gzipped(data)
+            headers['Content-Encoding'] = 'gzip'
+
+        params = {} if chunk.graph_uri is None else {'graph-uri': chunk.graph_uri}
+
+        report = {'chunk': chunk.number, 'graph': chunk.graph_uri, 'triples': len(chunk.lines),
+                  'bytes': len(data), 'attempts': 0, 'status': None}
+        start = time.time()
+
+        for attempt in range(retries + 1):
+            report['attempts'] = attempt + 1
+            try:
+                with sc.stats.call('crud', endpoint_url, bytes_out=len(data)) as call:
+                    result = sc.session.post(endpoint_url, data=data, params=params, headers=headers,
+                                             auth=config.CRUD_AUTH, timeout=sc.TIMEOUT)
+                    report['status'] = call.status = result.status_code
+                    call.bytes_in = len(result.content)
+                    result.raise_for_status()
+                report.pop('error', None)
+                break
+            except Exception as e:
+                log.debug(traceback.format_exc())
+                report['error'] = str(e)
+                if attempt < retries:
+                    gevent.sleep(config.SPARQL_BACKOFF * (2 ** attempt))
+
+        report['seconds'] = time.time() - start
+        return report
+
+    reports = []
+    pool = Pool(parallel)
+
+    # The blank nodes of every load are distinct from those of any other load
+    skolem_base = '{}{}/'.format(config.BULK_SKOLEM_BASE, uuid.uuid4().hex)
+
+    for report in pool.imap_unordered(upload, chunks(lines, graph_uri=graph_uri, format=format,
+                                                     max_triples=max_triples, max_bytes=max_bytes,
+                                                     skolem_base=skolem_base)):
+        if 'error' in report:
+            log.error("Chunk {chunk} ({triples} triples) for <{graph}> failed after {attempts} attempts: {error}"
+                      .format(**report))
+        else:
+            log.debug("Chunk {chunk} ({triples} triples, {bytes} bytes) for <{graph}> loaded in {seconds:.2f}s"
+                      .format(**report))
+
+        reports.append(report)
+        if progress is not None:
+            progress(report)
+
+    graphs = set(r['graph'] for r in reports)
+    sc.result_cache.invalidate(None if None in graphs else graphs)
+
+    return reports
+
+
+def bulk_load_file(filename, graph_uri=None, format=None, **kwargs):
+    """Loads an N-Triples (.nt) or N-Quads (.nq) file into the store, see `bulk_load`"""
+    if format is None:
+        format = 'nq' if filename.endswith('.nq') else 'nt'
+
+    with open(filename, 'r') as f:
+        return bulk_load(f, graph_uri=graph_uri, format=format, **kwargs)
+
+
+def skolemize(line, skolem_base):
+    """Replaces the blank nodes in the statement by IRIs under `skolem_base` (the same label gives the same IRI)"""
+    return BNODE_PATTERN.sub(lambda m: m.group(1) or '<{}{}>'.format(skolem_base, m.group(2)), line)
+
+
+def gzipped(data):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
@@ -0,0 +1,184 @@
+import time
+from threading import RLock
+from collections import OrderedDict
+
+import gevent
+
+
+class Cache(object):
+    """A thread-safe least-recently-used cache with a time-to-live and a size limit.
+
+    Every entry has a size (e.g. the number of bytes of the response it was built from)
+    and an optional set of tags it depends on. Entries are evicted when they expire, when
+    the total size exceeds `max_size`, or when one of their tags is invalidated. Entries
+    stored with `tags=None` depend on everything, and are dropped by any invalidation.
+
+    Every invalidation increases `generation`: a value that was read before an invalidation and
+    stored after it may be outdated, so `put` ignores values read in an earlier generation.
+    """
+
+    def __init__(self, ttl=300, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+
+            value, size, expires, tags = entry
+            if expires < time.time():
+                self.size -= size
+                return default
+
+            # Re-insert to mark the entry as most recently used
+            self._entries[key] = entry
+            return value
+
+    def put(self, key, value, size=1, tags=None, generation=None):
+        if size > self.max_size:
+            return
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._remove(key)
+
+            if tags is not None:
+                tags = frozenset(tags)
+
+            self._entries[key] = (value, size, time.time() + self.ttl, tags)
+            self.size += size
+
+            while self.size > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def invalidate(self, tags=None):
+        """Drops all entries that depend on any of `tags` (or all entries if `tags` is None)"""
+        with self._lock:
+            if tags is None:
+                self.clear()
+                return
+
+            self.generation += 1
+            tags = frozenset(tags)
+            for key, (_, _, _, entry_tags) in self._entries.items():
+                if entry_tags is None or not entry_tags.isdisjoint(tags):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+class StaleWhileRevalidate(object):
+    """A cache of values that are (re)built by a slow function, and served stale while they are rebuilt.
+
+    A value that is not cached yet is built by calling `load(key)`, and the caller waits for it.
+    Once a value is older than `max_age` seconds it is still returned immediately, but it is
+    rebuilt in the background (once, however many callers ask for it in the meantime); if that
+    fails, the old value is kept. Values are evicted least recently used first when their total
+    size, as computed by `sizeof(value)`, exceeds `max_size`.
+    """
+
+    def __init__(self, load, max_age=300, max_size=1000, sizeof=None):
+        self.load = load
+        self.max_age = max_age
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self._entries = OrderedDict()
+        self._refreshing = {}
+        self._generation = 0
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+
+        if entry is None:
+            return self._load(key)
+
+        value, size, loaded_at = entry
+        if loaded_at + self.max_age < time.time():
+            self.refresh(key)
+
+        return value
+
+    def put(self, key, value, loaded_at=None):
+        """Stores a value, e.g. from a local copy, as if it were loaded at `loaded_at` (by default: now)"""
+        size = self.sizeof(value)
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, size, time.time() if loaded_at is None else loaded_at)
+            self.size += size
+
+            while self.size > self.max_size and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def refresh(self, key=None):
+        """Rebuilds the value in the background, unless that is already happening. Returns the greenlet."""
+        with self._lock:
+            greenlet = self._refreshing.get(key)
+            if greenlet is None or greenlet.ready():
+                greenlet = self._refreshing[key] = gevent.spawn(self._load, key)
+            return greenlet
+
+    def invalidate(self, keys=None):
+        """Drops the values of `keys` (or all values if `keys` is None), so they are rebuilt on the next get"""
+        with self._lock:
+            # Values that are being built now may be based on the old data
+            self._generation += 1
+
+            if keys is None:
+                self._entries.clear()
+                self.size = 0
+                return
+
+            for key in keys:
+                self._remove(key)
+
+    def _load(self, key):
+        generation = self._generation
+        value = self.load(key)
+
+        with self._lock:
+            if generation == self._generation:
+                self.put(key, value)
+
+        return value
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
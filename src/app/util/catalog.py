@@ -0,0 +1,260 @@
+import logging
+
+import app.config as config
+import sparql_client as sc
+
+from app import app
+
+log = app.logger
+log.setLevel(logging.DEBUG)
+
+
+NANOPUBLICATION_TYPE = ('<http://www.w3.org/1999/02/22-rdf-syntax-ns#type> '
+                        '<http://www.nanopub.org/nschema#Nanopublication>')
+
+PREFIXES = """
+    PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+    PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+    PREFIX qb: <http://purl.org/linked-data/cube#>
+    PREFIX np: <http://www.nanopub.org/nschema#>
+    PREFIX prov: <http://www.w3.org/ns/prov#>
+    PREFIX qbrv: <http://data.socialhistory.org/vocab/>
+"""
+
+# Adds the dimensions and code lists defined in the graphs ?g to the catalog, as defined in ?source
+# (the nanopublication of which ?g is the assertion graph, or ?g itself)
+DEFINITIONS_TEMPLATE = PREFIXES + """
+    INSERT {{ GRAPH <{CATALOG}> {{
+        ?uri a ?type ;
+             rdfs:label ?label ;
+             qbrv:definedIn ?source .
+    }} }}
+    WHERE {{
+        {SOURCES}
+        {{
+            GRAPH ?g {{
+                ?uri a ?type ;
+                     rdfs:label ?label .
+                VALUES ?type {{ qb:DimensionProperty qb:MeasureProperty qb:AttributeProperty }}
+            }}
+        }}
+        UNION
+        {{
+            GRAPH ?g {{
+                {{ ?c skos:inScheme ?uri . }} UNION {{ ?uri skos:member ?c . }}
+                ?uri rdfs:label ?label .
+            }}
+            BIND(qbrv:CodeList AS ?type)
+        }}
+    }}
+"""
+
+# Adds the datasets published by the nanopublications ?source to the catalog
+DATASETS_TEMPLATE = PREFIXES + """
+    INSERT {{ GRAPH <{CATALOG}> {{
+        ?uri a qb:DataSet ;
+             rdfs:label ?label ;
+             qbrv:definedIn ?source .
+        ?source prov:wasAttributedTo ?owner ;
+             qbrv:definedIn ?source .
+    }} }}
+    WHERE {{
+        {SOURCES}
+        ?source np:hasPublicationInfo ?pubinfo_uri .
+        GRAPH ?g {{
+            ?uri a qb:DataSet ;
+                 rdfs:label ?label .
+        }}
+        GRAPH ?pubinfo_uri {{
+            ?source prov:wasAttributedTo ?owner .
+        }}
+    }}
+"""
+
+NANOPUBLICATION_SOURCES = """
+        VALUES ?source {{ {URIS} }}
+        ?source np:hasAssertion ?g .
+"""
+
+GRAPH_SOURCES = """
+        VALUES ?g {{ {URIS} }}
+        BIND(?g AS ?source)
+"""
+
+ALL_NANOPUBLICATION_SOURCES = """
+        ?source a np:Nanopublication ;
+                np:hasAssertion ?g .
+"""
+
+# Named graphs that are not part of a nanopublication, such as the documents added by the crawler
+ALL_OTHER_SOURCES = """
+        {{
+            SELECT DISTINCT ?g WHERE {{
+                GRAPH ?g {{ ?s ?p ?o }}
+                FILTER (?g != <{CATALOG}> && ?g != <{MEMBERSHIP}>)
+                FILTER NOT EXISTS {{ ?np np:hasAssertion|np:hasProvenance|np:hasPublicationInfo ?g }}
+                FILTER NOT EXISTS {{ ?g a np:Nanopublication }}
+            }}
+        }}
+        BIND(?g AS ?source)
+"""
+
+# Removes the sources from the catalog, and with them all entries that are no longer defined anywhere
+REMOVE_TEMPLATE = PREFIXES + """
+    DELETE {{ GRAPH <{CATALOG}> {{ ?uri qbrv:definedIn ?source . }} }}
+    WHERE {{
+        VALUES ?source {{ {URIS} }}
+        GRAPH <{CATALOG}> {{ ?uri qbrv:definedIn ?source . }}
+    }} ;
+    DELETE {{ GRAPH <{CATALOG}> {{ ?uri ?p ?o . }} }}
+    WHERE {{
+        GRAPH <{CATALOG}> {{
+            ?uri ?p ?o .
+            FILTER NOT EXISTS {{ ?uri qbrv:definedIn ?any . }}
+        }}
+    }}
+"""
+
+# Removes the transitive members of the collections ?c from the membership graph
+REMOVE_MEMBERS_TEMPLATE = PREFIXES + """
+    DELETE {{ GRAPH <{MEMBERSHIP}> {{ ?c qbrv:transitiveMember ?member . }} }}
+    WHERE {{
+        VALUES ?c {{ {URIS} }}
+        GRAPH <{MEMBERSHIP}> {{ ?c qbrv:transitiveMember ?member . }}
+    }}
+"""
+
+# Adds the transitive members (skos:member+) of the collections ?c to the membership graph
+ADD_MEMBERS_TEMPLATE = PREFIXES + """
+    INSERT {{ GRAPH <{MEMBERSHIP}> {{ ?c qbrv:transitiveMember ?member . }} }}
+    WHERE {{
+        {COLLECTIONS}
+        ?c skos:member+ ?member .
+    }}
+"""
+
+ALL_COLLECTIONS = """
+        {{ SELECT DISTINCT ?c WHERE {{ ?c skos:member ?any . }} }}
+"""
+
+# The collections that (transitively) contain the collections ?member
+ANCESTORS_QUERY = PREFIXES + """
+    SELECT DISTINCT ?c WHERE {{
+        VALUES ?member {{ {URIS} }}
+        GRAPH <{MEMBERSHIP}> {{ ?c qbrv:transitiveMember ?member . }}
+    }}
+"""
+
+# The collections that the graph adds members to
+GRAPH_COLLECTIONS_QUERY = PREFIXES + """
+    SELECT DISTINCT ?c WHERE {{
+        GRAPH <{GRAPH}> {{ ?c skos:member ?member . }}
+    }}
+"""
+
+
+def add_nanopublications(uris, graph_uri=config.CATALOG_GRAPH):
+    """Adds the datasets, dimensions and code lists published by the nanopublications to the catalog"""
+    for batch in batches(uris):
+        sources = NANOPUBLICATION_SOURCES.format(URIS=values(batch))
+        log.debug("Adding {} nanopublications to the catalog".format(len(batch)))
+        update(DEFINITIONS_TEMPLATE.format(CATALOG=graph_uri, SOURCES=sources) + " ;\n" +
+               DATASETS_TEMPLATE.format(CATALOG=graph_uri, SOURCES=sources))
+
+
+def add_graphs(uris, graph_uri=config.CATALOG_GRAPH):
+    """Adds the dimensions and code lists defined in the named graphs (e.g. crawled documents) to the catalog"""
+    for batch in batches(uris):
+        log.debug("Adding {} graphs to the catalog".format(len(batch)))
+        update(DEFINITIONS_TEMPLATE.format(CATALOG=graph_uri, SOURCES=GRAPH_SOURCES.format(URIS=values(batch))))
+
+
+def remove(uris, graph_uri=config.CATALOG_GRAPH):
+    """Removes everything the nanopublications or graphs added from the catalog"""
+    for batch in batches(uris):
+        log.debug("Removing {} sources from the catalog".format(len(batch)))
+        update(REMOVE_TEMPLATE.format(CATALOG=graph_uri, URIS=values(batch)))
+
+
+def rebuild(graph_uri=config.CATALOG_GRAPH):
+    """Rebuilds the catalog from the nanopublications and the other graphs in the store"""
+    log.info("Rebuilding the catalog in <{}>".format(graph_uri))
+    other_sources = ALL_OTHER_SOURCES.format(CATALOG=graph_uri, MEMBERSHIP=config.MEMBERSHIP_GRAPH)
+
+    update("CLEAR SILENT GRAPH <{}>".format(graph_uri))
+    update(DEFINITIONS_TEMPLATE.format(CATALOG=graph_uri, SOURCES=ALL_NANOPUBLICATION_SOURCES))
+    update(DATASETS_TEMPLATE.format(CATALOG=graph_uri, SOURCES=ALL_NANOPUBLICATION_SOURCES))
+    update(DEFINITIONS_TEMPLATE.format(CATALOG=graph_uri, SOURCES=other_sources))
+
+    rebuild_membership()
+
+
+def update_membership(uris, graph_uri=config.MEMBERSHIP_GRAPH):
+    """Recomputes the transitive members of the collections, and of all collections that contain them,
+    after members were added to or removed from them.
+
+    :returns: the URIs of the recomputed collections (the given ones and the collections that contain them)
+    """
+    uris = set(uris)
+    for batch in batches(uris):
+        uris.update(r['c']['value'] for r in sc.sparql(ANCESTORS_QUERY.format(MEMBERSHIP=graph_uri,
+                                                                             URIS=values(batch))))
+
+    # Remove everything first, so no collection is ever recomputed from outdated members
+    log.debug("Updating the transitive members of {} collections".format(len(uris)))
+    for batch in batches(uris):
+        update(REMOVE_MEMBERS_TEMPLATE.format(MEMBERSHIP=graph_uri, URIS=values(batch)))
+    for batch in batches(uris):
+        collections = "VALUES ?c {{ {} }}".format(values(batch))
+        update(ADD_MEMBERS_TEMPLATE.format(MEMBERSHIP=graph_uri, COLLECTIONS=collections))
+
+    return uris
+
+
+def rebuild_membership(graph_uri=config.MEMBERSHIP_GRAPH):
+    """Rebuilds the transitive members of all collections in the store"""
+    log.info("Rebuilding the transitive members of collections in <{}>".format(graph_uri))
+    update("CLEAR SILENT GRAPH <{}>".format(graph_uri))
+    update(ADD_MEMBERS_TEMPLATE.format(MEMBERSHIP=graph_uri, COLLECTIONS=ALL_COLLECTIONS))
+
+
+def graph_collections(uri):
+    """Returns the URIs of the collections that the graph adds members to"""
+    return set(r['c']['value'] for r in sc.sparql(GRAPH_COLLECTIONS_QUERY.format(GRAPH=uri)))
+
+
+def ensure():
+    """Builds the catalog and the membership graph, if they do not exist yet"""
+    if not exists():
+        rebuild()
+    elif not exists(config.MEMBERSHIP_GRAPH):
+        rebuild_membership()
+
+
+def exists(graph_uri=config.CATALOG_GRAPH):
+    return sc.ask_graph(graph_uri) is True
+
+
+def update(query):
+    sc.execute_updates([query])
+
+
+def batches(uris):
+    uris = sorted(set(unicode(uri) for uri in uris if not sc.INVALID_IRI_PATTERN.search(uri)))
+    return [uris[i:i + config.SPARQL_VALUES_SIZE] for i in range(0, len(uris), config.SPARQL_VALUES_SIZE)]
+
+
+def values(uris):
+    return " ".join(u"<{}>".format(uri) for uri in uris).encode('utf-8')
+
+
+def nanopublication_uris(lines):
+    """Returns the URIs of the nanopublications in the N-Quads statements"""
+    uris = set()
+    for line in lines:
+        if NANOPUBLICATION_TYPE in line:
+            uris.add(line.split(None, 1)[0][1:-1])
+
+    return uris
+
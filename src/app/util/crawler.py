@@ -0,0 +1,187 @@
+import time
+import logging
+import traceback
+from urlparse import urlparse
+
+import gevent
+from gevent.pool import Pool
+from gevent.lock import BoundedSemaphore
+from rdflib import Graph, URIRef
+
+from app import app
+
+log = app.logger
+log.setLevel(logging.DEBUG)
+
+
+ACCEPT = ('text/turtle, application/rdf+xml;q=0.9, application/n-triples;q=0.9, '
+          'application/ld+json;q=0.8, text/n3;q=0.8, text/html;q=0.3, */*;q=0.1')
+
+FORMATS = {
+    'text/turtle': 'turtle',
+    'application/x-turtle': 'turtle',
+    'application/rdf+xml': 'xml',
+    'application/xml': 'xml',
+    'text/xml': 'xml',
+    'application/n-triples': 'nt',
+    'text/plain': 'nt',
+    'text/n3': 'n3',
+    'application/ld+json': 'json-ld',
+    'application/json': 'json-ld',
+    'text/html': 'rdfa',
+    'application/xhtml+xml': 'rdfa'
+}
+
+
+class Crawler(object):
+    """A breadth-first Linked Data crawler that dereferences URIs and adds the documents to the store.
+
+    Every level of the crawl is a frontier of documents (URIs without their fragment). Documents
+    that are already known to the store are not fetched; the others are fetched concurrently, with
+    at most `per_host` simultaneous requests (spaced at least `delay` seconds apart) to any one host.
+    The crawl stops when the maximum depth is reached, or when the time budget is spent.
+    Documents that could not be fetched or parsed are not tried again for `failure_ttl` seconds.
+    Expired failures, and hosts that are no longer being fetched from, are forgotten at the start
+    of every crawl.
+
+    Arguments:
+    session     -- the requests session used to fetch documents
+    known       -- a function that takes a list of document URIs, and returns the set of those already in the store
+    store       -- a function that takes an rdflib Graph and the document URI, and adds it to the store
+    """
+
+    def __init__(self, session, known, store, concurrency=8, per_host=2, delay=0.0,
+                 budget=30, failure_ttl=3600, timeout=10):
+        self.session = session
+        self.known = known
+        self.store = store
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.delay = delay
+        self.budget = budget
+        self.failure_ttl = failure_ttl
+        self.timeout = timeout
+
+        # Shared between calls: the politeness limits and the failures
+        self.hosts = {}
+        self.failures = {}
+
+    def crawl(self, uris, depth=2, budget=None):
+        """Dereferences the URIs, and then the object URIs of the triples found, up to `depth` levels.
+
+        Returns a tuple of the set of URIs that are now known to the store (either because they
+        already were, or because they were fetched), and the set of all visited document URIs.
+        """
+        deadline = time.time() + (budget or self.budget)
+        self.prune()
+
+        visited = set()
+        resolved = set()
+        frontier = [document(uri) for uri in uris]
+
+        for level in range(depth):
+            frontier = [d for d in unique(frontier) if d not in visited]
+            remaining = deadline - time.time()
+
+            if not frontier or remaining <= 0:
+                break
+
+            visited.update(frontier)
+
+            known = self.known(frontier)
+            resolved.update(known)
+
+            candidates = [d for d in frontier if d not in known and not self.failed(d)]
+            log.debug("Crawl level {}: {} documents, {} known, {} to fetch".format(level, len(frontier),
+                                                                                  len(known), len(candidates)))
+
+            next_frontier = []
+
+            pool = Pool(self.concurrency)
+            with gevent.Timeout(remaining, False):
+                for doc, graph in pool.imap_unordered(self.fetch, candidates):
+                    if graph is None:
+                        continue
+
+                    resolved.add(doc)
+                    next_frontier.extend(document(o) for o in graph.objects() if isinstance(o, URIRef))
+            pool.kill()
+
+            frontier = next_frontier
+
+        return set(uri for uri in uris if document(uri) in resolved), visited
+
+    def fetch(self, doc):
+        """Fetches and parses the document, and adds it to the store. Returns the graph, or None on failure"""
+        host = urlparse(doc).netloc
+        limit = self.hosts.setdefault(host, [BoundedSemaphore(self.per_host), 0])
+
+        try:
+            with limit[0]:
+                wait = limit[1] + self.delay - time.time()
+                if wait > 0:
+                    gevent.sleep(wait)
+                limit[1] = time.time()
+
+                response = self.session.get(doc, headers={'Accept': ACCEPT}, timeout=self.timeout)
+                response.raise_for_status()
+
+            graph = parse(response.content, response.headers.get('Content-Type', ''), doc)
+            self.store(graph, doc)
+            log.debug("{} added to triple store".format(doc))
+            return doc, graph
+        except Exception:
+            log.debug(traceback.format_exc())
+            log.warning("Could not resolve {}".format(doc))
+            self.failures[doc] = time.time()
+            return doc, None
+
+    def prune(self):
+        """Forgets the expired failures, and the hosts that are idle (i.e. no request to them is running,
+        and the delay since the last one has passed)"""
+        now = time.time()
+
+        for doc, failed_at in self.failures.items():
+            if failed_at + self.failure_ttl < now:
+                del self.failures[doc]
+
+        for host, (semaphore, last) in self.hosts.items():
+            if semaphore.counter == self.per_host and last + self.delay < now:
+                del self.hosts[host]
+
+    def failed(self, doc):
+        failed_at = self.failures.get(doc)
+        if failed_at is None:
+            return False
+        elif failed_at + self.failure_ttl < time.time():
+            del self.failures[doc]
+            return False
+        else:
+            return True
+
+
+def parse(content, content_type, doc):
+    """Parses the content as RDF, in the format indicated by its content type (or turtle or RDF/XML)"""
+    mimetype = content_type.split(';')[0].strip().lower()
+    formats = [FORMATS[mimetype]] if mimetype in FORMATS else []
+    formats += [f for f in ['turtle', 'xml'] if f not in formats]
+
+    for f in formats:
+        try:
+            g = Graph()
+            g.parse(data=content, format=f, publicID=doc)
+            return g
+        except Exception:
+            continue
+
+    raise Exception("Could not parse {} as any of {}".format(doc, formats))
+
+
+def document(uri):
+    """The document URI for a URI (i.e. without the fragment)"""
+    return unicode(URIRef(uri).defrag())
+
+
+def unique(items):
+    seen = set()
+    return [i for i in items if not (i in seen or seen.add(i))]
@@ -2,10 +2,22 @@ import os
 import json
 import requests
 import logging
+import gevent
+from itertools import chain, islice
+from collections import Counter
 from SPARQLWrapper import SPARQLWrapper, JSON
 import sparql_client as sc
-from rdflib import Graph
-from threading import Thread
+import result_table as rt
+import catalog
+import app.config as config
+from rdflib import Graph, URIRef
+from parallel import fan_out
+from dimension_catalog import DimensionCatalog
+from dimension_index import DimensionIndex
+from cache import Cache, StaleWhileRevalidate
+from jobs import JobQueue
+from vocabulary import VocabularyStore
+import app.datacube.converter as datacube
 
 
 from app import app
@@ -13,99 +25,200 @@ from app import app
 log = app.logger
 log.setLevel(logging.DEBUG)
 
+# The LSD dimensions, loaded once and refreshed in the background
+lsd_catalog = DimensionCatalog(config.LSD_DIMENSIONS_FILE, config.LSD_DIMENSIONS_URL,
+                               refresh_interval=config.LSD_REFRESH_INTERVAL)
 
-def get_definition(uri):
-    exists = sc.ask(uri, template="""
-        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+# The dimensions in the catalog graph (see catalog.py)
+CSDH_DIMENSIONS_QUERY = """
+    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+    PREFIX qb: <http://purl.org/linked-data/cube#>
 
-        ASK {{<{}> rdfs:label ?l .}}""")
-
-    if not exists:
-        success, visited = sc.resolve(uri, depth=2)
-        print "Resolved ", visited
-    else:
-        success = True
-
-    if success:
-        query = """
-            PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-            PREFIX dct: <http://purl.org/dc/terms/>
-            PREFIX qb: <http://purl.org/linked-data/cube#>
-
-            SELECT (<{URI}> as ?uri) ?type ?label ?description ?concept_uri WHERE {{
-                OPTIONAL
-                {{
-                    <{URI}>   rdfs:label ?label .
-                }}
-                OPTIONAL
-                {{
-                    <{URI}>   rdfs:comment ?description .
-                }}
-                OPTIONAL
-                {{
-                    <{URI}>   a  qb:DimensionProperty .
-                    BIND(qb:DimensionProperty AS ?type )
-                }}
-                OPTIONAL
-                {{
-                    <{URI}>   qb:concept  ?measured_concept .
-                }}
-                OPTIONAL
-                {{
-                    <{URI}>   a  qb:MeasureProperty .
-                    BIND(qb:MeasureProperty AS ?type )
-                }}
-                OPTIONAL
-                {{
-                    <{URI}>   a  qb:AttributeProperty .
-                    BIND(qb:AttributeProperty AS ?type )
-                }}
-            }}
+    SELECT DISTINCT ?uri ?label ("CSDH" as ?refs)
+    FROM <{CATALOG}>
+    WHERE {{
+      ?uri a ?type ;
+           rdfs:label ?label .
+      VALUES ?type {{ qb:DimensionProperty qb:MeasureProperty qb:AttributeProperty }}
+    }}
+""".format(CATALOG=config.CATALOG_GRAPH)
+
+# The external SKOS schemes and their concepts, as imported with manage.py (see vocabulary.py)
+vocabulary_store = VocabularyStore(config.VOCABULARY_FILE)
 
-        """.format(URI=uri)
+# The SKOS schemes from the LOD cloud and HISCO (see get_schemes), and those merged with the CSDH schemes
+external_schemes = StaleWhileRevalidate(lambda key: build_schemes(), max_age=config.SCHEMES_MAX_AGE)
+scheme_catalog = StaleWhileRevalidate(lambda key: build_scheme_catalog(), max_age=config.SCHEME_CATALOG_MAX_AGE)
 
-        results = sc.sparql(query)
+# The concepts per scheme (see get_concepts), and the number of times each scheme was requested (see count_request)
+concept_cache = StaleWhileRevalidate(lambda uri: load_concepts(uri), max_age=config.CONCEPT_CACHE_MAX_AGE,
+                                     max_size=config.CONCEPT_CACHE_SIZE, sizeof=lambda c: concepts_size(c))
+concept_requests = Counter()
 
-        log.debug(results)
+SKOS_MEMBER = '<http://www.w3.org/2004/02/skos/core#member>'
+SKOS_IN_SCHEME = '<http://www.w3.org/2004/02/skos/core#inScheme>'
 
-        # Turn into something more manageable, and take only the first element.
-        variable_definition = sc.dictize(results)[0]
+# The definitions of variables (see get_definitions), shared by all users
+definition_cache = Cache(ttl=config.DEFINITION_CACHE_TTL, max_size=config.DEFINITION_CACHE_SIZE)
 
-        query = """
-            PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-            PREFIX dct: <http://purl.org/dc/terms/>
-            PREFIX qb: <http://purl.org/linked-data/cube#>
+# Background jobs, such as the deletion of datasets (see delete_datasets)
+jobs = JobQueue(workers=config.JOB_WORKERS, history=config.JOB_HISTORY)
 
-            SELECT DISTINCT ?uri ?label WHERE {{
-                  <{URI}>   a               qb:CodedProperty .
-                  BIND(qb:DimensionProperty AS ?type )
-                  <{URI}>   qb:codeList     ?uri .
-                  ?uri       rdfs:label      ?label .
-            }}""".format(URI=uri)
+# The CSDH dimensions query results the current search index was built from, and the index
+csdh_dimension_index = [None, DimensionIndex([])]
 
-        codelist_results = sc.sparql(query)
 
-        log.debug(codelist_results)
+def get_definition(uri):
+    """Returns the definition of a variable, see get_definitions"""
+    definitions = get_definitions([uri])
+
+    if uri not in definitions:
+        raise(Exception("Could not find the definition for <{}> online, nor in the CSDH".format(uri)))
+
+    log.debug("Definition for: {}".format(uri))
+    log.debug(definitions[uri])
 
-        if len(codelist_results) > 0:
-            codelist = sc.dictize(codelist_results)
-            log.debug(codelist)
-            # Only take the first result (won't allow multiple code lists)
-            # TODO: Check how this potentially interacts with user-added codes and lists
-            variable_definition['codelist'] = codelist[0]
+    return definitions[uri]
+
+
+def get_definitions(uris):
+    """Returns a dict of the definitions (label, description, type and codelist) of the variables.
+
+    Definitions are served from a cache shared by all users. The others are retrieved from the
+    CSDH with a few combined VALUES queries, at the same time as we check which of the variables we
+    know. The unknown variables are resolved together in a single crawl, and queried again.
+    Variables that cannot be found online nor in the CSDH are left out.
+    """
+    definitions = {}
+    missing = []
+    for uri in set(uris):
+        definition = definition_cache.get(uri)
+        if definition is None:
+            missing.append(uri)
         else:
-            log.debug("No codelist for this variable")
+            definitions[uri] = definition
 
-        log.debug("Definition for: {}".format(uri))
-        log.debug(variable_definition)
+    if not missing:
+        return definitions
 
-        return variable_definition
-    else:
-        raise(Exception("Could not find the definition for <{}> online, nor in the CSDH".format(uri)))
+    # Check whether we know the variables, and query for their definitions and codelists at the same time
+    known, results = fan_out([
+        lambda: sc.known_resources(missing, pattern="?uri <http://www.w3.org/2000/01/rdf-schema#label> ?l"),
+        lambda: query_definitions(missing)
+    ])
+    if known is None or results is None:
+        raise(Exception("Could not retrieve the definitions of {} variables from the CSDH".format(len(missing))))
+
+    unknown = [uri for uri in missing if uri not in known]
+    if unknown:
+        resolved, visited = sc.crawler.crawl(unknown, depth=2)
+        log.debug("Resolved {} of {} variables, visited {}".format(len(resolved), len(unknown), visited))
+
+        if resolved:
+            catalog.add_graphs(visited)
+
+            # The earlier results predate resolving the URIs, so we query again
+            results.update(query_definitions(resolved))
+
+        known = set(known) | resolved
+
+    for uri in missing:
+        if uri in known and uri in results:
+            definitions[uri] = results[uri]
+            definition_cache.put(uri, results[uri])
+
+    return definitions
+
+
+def query_definitions(uris):
+    """Queries the CSDH for the definitions and codelists of the variables, in batches of SPARQL_VALUES_SIZE"""
+    uris = [uri for uri in uris if not sc.INVALID_IRI_PATTERN.search(uri)]
+    batches = [uris[i:i + config.SPARQL_VALUES_SIZE] for i in range(0, len(uris), config.SPARQL_VALUES_SIZE)]
+
+    queries = []
+    for batch in batches:
+        queries.append(lambda batch=batch: sc.sparql(definition_query(batch)))
+        queries.append(lambda batch=batch: sc.sparql(codelist_query(batch)))
+
+    results = fan_out(queries)
+    if any(r is None or isinstance(r, basestring) for r in results):
+        raise(Exception("Could not retrieve the definitions of {} variables from the CSDH".format(len(uris))))
+
+    definitions = {}
+    codelists = {}
+    for definition_results, codelist_results in zip(results[0::2], results[1::2]):
+        # Only take the first result for every variable
+        for definition in sc.iter_dictize(definition_results):
+            definitions.setdefault(definition['uri'], definition)
+
+        # Only take the first codelist (won't allow multiple code lists)
+        # TODO: Check how this potentially interacts with user-added codes and lists
+        for codelist in sc.iter_dictize(codelist_results):
+            codelists.setdefault(codelist.pop('variable'), codelist)
+
+    for uri, codelist in codelists.items():
+        if uri in definitions:
+            definitions[uri]['codelist'] = codelist
+
+    return definitions
+
+
+def definition_query(uris):
+    return """
+        PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+        PREFIX dct: <http://purl.org/dc/terms/>
+        PREFIX qb: <http://purl.org/linked-data/cube#>
+
+        SELECT ?uri ?type ?label ?description ?concept_uri WHERE {{
+            VALUES ?uri {{ {URIS} }}
+            OPTIONAL
+            {{
+                ?uri   rdfs:label ?label .
+            }}
+            OPTIONAL
+            {{
+                ?uri   rdfs:comment ?description .
+            }}
+            OPTIONAL
+            {{
+                ?uri   a  qb:DimensionProperty .
+                BIND(qb:DimensionProperty AS ?type )
+            }}
+            OPTIONAL
+            {{
+                ?uri   qb:concept  ?measured_concept .
+            }}
+            OPTIONAL
+            {{
+                ?uri   a  qb:MeasureProperty .
+                BIND(qb:MeasureProperty AS ?type )
+            }}
+            OPTIONAL
+            {{
+                ?uri   a  qb:AttributeProperty .
+                BIND(qb:AttributeProperty AS ?type )
+            }}
+        }}
+
+    """.format(URIS=" ".join("<{}>".format(uri) for uri in uris))
+
+
+def codelist_query(uris):
+    return """
+        PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+        PREFIX dct: <http://purl.org/dc/terms/>
+        PREFIX qb: <http://purl.org/linked-data/cube#>
+
+        SELECT DISTINCT ?variable ?uri ?label WHERE {{
+              VALUES ?variable {{ {URIS} }}
+              ?variable   a               qb:CodedProperty .
+              ?variable   qb:codeList     ?uri .
+              ?uri        rdfs:label      ?label .
+        }}""".format(URIS=" ".join("<{}>".format(uri) for uri in uris))
 
 
 def get_dimensions():
@@ -113,7 +226,8 @@ def get_dimensions():
     # And concatenate it with the dimensions in the CSDH
     # Return an ordered dict of dimensions (ordered by number of references)
 
-    dimensions = get_lsd_dimensions() + get_csdh_dimensions()
+    lsd_dimensions, csdh_dimensions = fan_out([get_lsd_dimensions, get_csdh_dimensions], default=[])
+    dimensions = lsd_dimensions + csdh_dimensions
 
     # dimensions_as_dict = {dim['uri']: dim for dim in dimensions}
     sorted_dimensions = sorted(dimensions, key=lambda t: t['refs'])
@@ -123,71 +237,21 @@ def get_dimensions():
 
 
 def get_lsd_dimensions():
-    """Loads the list of Linked Statistical Data dimensions (variables) from the LSD portal"""
-    # TODO: Create a local copy that gets updated periodically
-
+    """Loads the list of Linked Statistical Data dimensions (variables) from the LSD portal (or a locally cached copy)"""
     try:
-        if os.path.exists('metadata/dimensions.json'):
-            log.debug("Loading dimensions from file...")
-            with open('metadata/dimensions.json', 'r') as f:
-                dimensions_json = f.read()
-            log.debug("Dimensions loaded...")
-            dimensions = json.loads(dimensions_json)
-        else:
-            raise Exception("Could not load dimensions from file...")
+        return lsd_catalog.get()
     except Exception as e:
-        log.warning(e)
-        dimensions_response = requests.get("http://amp.ops.few.vu.nl/data.json")
-        log.debug("Loading dimensions from LSD service...")
-        try:
-            dimensions = json.loads(dimensions_response.content)
-
-            if len(dimensions_response) > 1:
-                with open('metadata/dimensions.json', 'w') as f:
-                    f.write(dimensions_response)
-            else:
-                raise Exception("Could not load dimensions from service")
-
-        except Exception as e:
-            log.error(e)
-
-            dimensions = []
-
-    dimensions = [dim for dim in dimensions if dim['refs'] > 1]
-    return dimensions
+        log.error(e)
+        return []
 
 
 def get_csdh_dimensions():
     """Loads the list of Linked Statistical Data dimensions (variables) from the CSDH"""
     log.debug("Loading dimensions from the CSDH")
-    query = """
-        PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-        PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-        PREFIX dct: <http://purl.org/dc/terms/>
-        PREFIX qb: <http://purl.org/linked-data/cube#>
-
-        SELECT DISTINCT ?uri ?label ("CSDH" as ?refs) WHERE {
-          {
-              ?uri a qb:DimensionProperty .
-              ?uri rdfs:label ?label .
-          }
-          UNION
-          {
-              ?uri a qb:MeasureProperty .
-              ?uri rdfs:label ?label .
-          }
-          UNION
-          {
-              ?uri a qb:AttributeProperty .
-              ?uri rdfs:label ?label .
-          }
-        }
-    """
-    sdh_dimensions_results = sc.sparql(query)
+    sdh_dimensions_results = sc.sparql(CSDH_DIMENSIONS_QUERY, cache=True)
     try:
         if len(sdh_dimensions_results) > 0:
-            sdh_dimensions = sc.dictize(sdh_dimensions_results)
+            sdh_dimensions = rt.decode(sdh_dimensions_results).dicts()
         else:
             sdh_dimensions = []
     except Exception as e:
@@ -197,210 +261,413 @@ def get_csdh_dimensions():
     return sdh_dimensions
 
 
+def get_csdh_dimension_index():
+    """Returns a search index of the dimensions in the CSDH, rebuilt only when their query results change"""
+    results = sc.sparql(CSDH_DIMENSIONS_QUERY, cache=True)
+    if isinstance(results, basestring):
+        log.error("Could not load dimensions from the CSDH: {}".format(results[:200]))
+        return DimensionIndex([])
+
+    built_from, index = csdh_dimension_index
+    if results is not built_from:
+        index = DimensionIndex(rt.decode(results).dicts())
+        csdh_dimension_index[:] = [results, index]
+
+    return index
+
+
+def search_dimensions(query, offset=0, limit=20):
+    """Searches the labels and URIs of the LSD and CSDH dimensions for the query string.
+
+    Dimensions whose label starts with the query come first, and within those (and the
+    other matches) the CSDH dimensions come first, followed by the LSD dimensions by
+    decreasing number of references.
+
+    :returns: a tuple of the total number of matches, and the matches from `offset` to `offset + limit`
+    """
+    lsd_index, csdh_index = fan_out([lsd_catalog.get_index, get_csdh_dimension_index], default=DimensionIndex([]))
+
+    lsd_prefix, lsd_other = lsd_index.search(query)
+    csdh_prefix, csdh_other = csdh_index.search(query)
+
+    # LSD dimensions that are also in the CSDH are only listed once, as CSDH dimension
+    csdh_uris = set(csdh_index[i]['uri'] for i in chain(csdh_prefix, csdh_other))
+    duplicates = set(p for p in (lsd_index.positions.get(uri) for uri in csdh_uris) if p is not None)
+    if duplicates:
+        lsd_prefix = [i for i in lsd_prefix if i not in duplicates]
+        lsd_other = [i for i in lsd_other if i not in duplicates]
+
+    total = len(csdh_prefix) + len(lsd_prefix) + len(csdh_other) + len(lsd_other)
+
+    # Only look up the dimensions on the requested page
+    matches = chain(((csdh_index, i) for i in csdh_prefix), ((lsd_index, i) for i in lsd_prefix),
+                    ((csdh_index, i) for i in csdh_other), ((lsd_index, i) for i in lsd_other))
+
+    return total, [index[i] for index, i in islice(matches, offset, offset + limit)]
+
+
 def get_csdh_schemes():
     """Loads SKOS Schemes (code lists) from the CSDH"""
     log.debug("Querying CSDH Cloud")
 
+    # The code lists in the catalog graph (see catalog.py)
+    query = """
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        PREFIX qbrv: <http://data.socialhistory.org/vocab/>
+
+        SELECT DISTINCT ?uri ?label
+        FROM <{CATALOG}>
+        WHERE {{
+          ?uri a qbrv:CodeList ;
+               rdfs:label ?label .
+        }}
+    """.format(CATALOG=config.CATALOG_GRAPH)
+
+    schemes_results = sc.sparql(query, cache=True)
+    log.debug(schemes_results)
+    schemes = rt.decode(schemes_results).dicts()
+
+    log.debug(schemes)
+
+    return schemes
+
+
+def get_schemes():
+    """Loads SKOS Schemes (code lists) from the vocabulary store, followed by the other schemes in the
+    cached copy in SCHEMES_FILE (if any). If nothing was imported into the store, the schemes are loaded
+    from the LOD Cache and HISCO instead (see build_schemes), or from the cached copy"""
+    stored = vocabulary_store.schemes()
+    if stored:
+        # Imported schemes are only refreshed by another import, so the LOD Cache is never queried
+        stored_uris = set(scheme['uri'] for scheme in stored)
+        return stored + [scheme for scheme in load_schemes_file() or [] if scheme['uri'] not in stored_uris]
+
+    if None not in external_schemes:
+        schemes = load_schemes_file()
+        if schemes is not None:
+            # Serve the cached copy, and rebuild it in the background once it is older than SCHEMES_MAX_AGE
+            external_schemes.put(None, schemes, loaded_at=os.path.getmtime(config.SCHEMES_FILE))
+
+    return external_schemes.get()
+
+
+def load_schemes_file():
+    """The schemes in the copy that build_schemes stored in SCHEMES_FILE, or None if there is none"""
+    if not os.path.exists(config.SCHEMES_FILE):
+        return None
+
+    log.debug("Loading schemes from file...")
+    with open(config.SCHEMES_FILE, 'r') as f:
+        return json.load(f)
+
+
+def build_schemes():
+    """Loads SKOS Schemes (code lists) from the LOD Cache and HISCO, and stores a copy in SCHEMES_FILE"""
+    log.debug("Loading schemes from RDF sources...")
+    schemes = []
+
+    # ---
+    # Querying the LOD Cloud
+    # ---
+    log.debug("Querying LOD Cloud")
+
     query = """
         PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
         PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
         PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
         PREFIX dct: <http://purl.org/dc/terms/>
 
-        SELECT DISTINCT ?uri ?label WHERE {
-          {
-              ?c skos:inScheme ?uri .
-              ?uri rdfs:label ?label .
-          }
-          UNION
-          {
-              ?uri skos:member ?c .
-              ?uri rdfs:label ?label .
-          }
+        SELECT DISTINCT ?scheme ?label WHERE {
+          ?c skos:inScheme ?scheme .
+          ?scheme rdfs:label ?label .
+        }
+    """
+
+    sparql = SPARQLWrapper('http://lod.openlinksw.com/sparql')
+    sparql.setReturnFormat(JSON)
+    sparql.setQuery(query)
+
+    results = sparql.query().convert()
+
+    for r in results['results']['bindings']:
+        scheme = {}
 
+        scheme['label'] = r['label']['value']
+        scheme['uri'] = r['scheme']['value']
+        schemes.append(scheme)
+
+    log.debug("Found {} schemes".format(len(schemes)))
+    # ---
+    # Querying the HISCO RDF Specification (will become a call to a
+    # generic CLARIAH Vocabulary Portal thing.)
+    # ---
+    log.debug("Querying HISCO RDF Specification")
+
+    query = """
+        PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+        PREFIX dct: <http://purl.org/dc/terms/>
+
+        SELECT DISTINCT ?scheme ?label WHERE {
+          ?scheme a skos:ConceptScheme.
+          ?scheme dct:title ?label .
         }
     """
 
-    schemes_results = sc.sparql(query)
-    log.debug(schemes_results)
-    schemes = sc.dictize(schemes_results)
+    g = Graph()
+    g.parse('metadata/hisco.ttl', format='turtle')
 
-    log.debug(schemes)
+    results = g.query(query)
+
+    for r in results:
+        scheme = {}
+        scheme['label'] = unicode(r.label)
+        scheme['uri'] = unicode(r.scheme)
+        schemes.append(scheme)
+
+    log.debug("Found a total of {} schemes".format(len(schemes)))
+
+    schemes_json = json.dumps(schemes)
+
+    # Write to a temporary file first, so readers never see a partial copy
+    with open(config.SCHEMES_FILE + '.tmp', 'w') as f:
+        f.write(schemes_json)
+    os.rename(config.SCHEMES_FILE + '.tmp', config.SCHEMES_FILE)
 
     return schemes
 
 
-def get_schemes():
-    """Loads SKOS Schemes (code lists) either from the LOD Cache, or from a cached copy"""
-    if os.path.exists('metadata/schemes.json'):
-        # TODO: Check the age of this file, and update if older than e.g. a week.
-        log.debug("Loading schemes from file...")
-        with open('metadata/schemes.json', 'r') as f:
-            schemes_json = f.read()
-
-        schemes = json.loads(schemes_json)
-        return schemes
-    else:
-        log.debug("Loading schemes from RDF sources...")
-        schemes = []
-
-        # ---
-        # Querying the LOD Cloud
-        # ---
-        log.debug("Querying LOD Cloud")
-
-        query = """
-            PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-            PREFIX dct: <http://purl.org/dc/terms/>
-
-            SELECT DISTINCT ?scheme ?label WHERE {
-              ?c skos:inScheme ?scheme .
-              ?scheme rdfs:label ?label .
-            }
-        """
-
-        sparql = SPARQLWrapper('http://lod.openlinksw.com/sparql')
-        sparql.setReturnFormat(JSON)
-        sparql.setQuery(query)
-
-        results = sparql.query().convert()
-
-        for r in results['results']['bindings']:
-            scheme = {}
-
-            scheme['label'] = r['label']['value']
-            scheme['uri'] = r['scheme']['value']
-            schemes.append(scheme)
+def get_all_schemes():
+    """Returns the external and CSDH schemes, without duplicate URIs.
 
-        log.debug("Found {} schemes".format(len(schemes)))
-        # ---
-        # Querying the HISCO RDF Specification (will become a call to a
-        # generic CLARIAH Vocabulary Portal thing.)
-        # ---
-        log.debug("Querying HISCO RDF Specification")
-
-        query = """
-            PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-            PREFIX dct: <http://purl.org/dc/terms/>
-
-            SELECT DISTINCT ?scheme ?label WHERE {
-              ?scheme a skos:ConceptScheme.
-              ?scheme dct:title ?label .
-            }
-        """
-
-        g = Graph()
-        g.parse('metadata/hisco.ttl', format='turtle')
-
-        results = g.query(query)
-
-        for r in results:
-            scheme = {}
-            scheme['label'] = r.label
-            scheme['uri'] = r.scheme
-            schemes.append(scheme)
+    The list is served from memory, and rebuilt in the background when it is older than
+    SCHEME_CATALOG_MAX_AGE seconds (or when a dataset is submitted)."""
+    return scheme_catalog.get()
 
-        log.debug("Found a total of {} schemes".format(len(schemes)))
 
-        schemes_json = json.dumps(schemes)
+def build_scheme_catalog():
+    external, csdh = fan_out([get_schemes, get_csdh_schemes])
+    if external is None or csdh is None:
+        # Keep serving the previous catalog
+        raise Exception("Could not build the scheme catalog")
 
-        with open('metadata/schemes.json', 'w') as f:
-            f.write(schemes_json)
+    seen = set()
+    schemes = []
+    for scheme in external + csdh:
+        if scheme['uri'] not in seen:
+            seen.add(scheme['uri'])
+            schemes.append(scheme)
 
-        return schemes
+    return schemes
 
 
 def get_concepts(uri):
-    query = """
+    """Returns the concepts in the scheme or collection, from the concept cache (see load_concepts)"""
+    concepts = concept_cache.get(uri)
+    if concepts:
+        count_request(uri)
+    return concepts
+
+
+def iter_concepts(uri):
+    """Iterates over the concepts in the scheme or collection: from the concept cache if they are in it,
+    and otherwise as they arrive from the sources (see iter_load_concepts), after which they are cached"""
+    if uri in concept_cache:
+        return iter(get_concepts(uri))
+
+    return cache_concepts(uri, iter_load_concepts(uri))
+
+
+def cache_concepts(uri, concepts):
+    """Yields the concepts, and puts them in the concept cache once all of them were loaded"""
+    loaded = []
+    for concept in concepts:
+        loaded.append(concept)
+        yield concept
+
+    concept_cache.put(uri, loaded)
+    if loaded:
+        count_request(uri)
+
+
+def count_request(uri):
+    """Counts a request for the concepts of the scheme or collection. Once more than CONCEPT_REQUESTS_SIZE
+    schemes were counted, the counts are halved, and the least requested half of the schemes forgotten,
+    so that the counts stay bounded and follow what is requested now"""
+    concept_requests[uri] += 1
+
+    if len(concept_requests) > config.CONCEPT_REQUESTS_SIZE:
+        popular = concept_requests.most_common(config.CONCEPT_REQUESTS_SIZE // 2)
+        concept_requests.clear()
+        concept_requests.update(dict((u, (count + 1) // 2) for u, count in popular))
+
+
+def load_concepts(uri):
+    """Loads the concepts in the scheme or collection from the LOD cloud and the SDH (see iter_load_concepts)"""
+    return list(iter_load_concepts(uri))
+
+
+def iter_load_concepts(uri):
+    """Iterates over the concepts in the scheme or collection in the SDH, as the pages of results arrive,
+    followed by those in the LOD cloud (which is queried at the same time).
+
+    In the SDH, the members of collections are looked up in the membership graph (see
+    catalog.update_membership) rather than by following skos:member+ on every request.
+    For schemes that were imported into the vocabulary store, the concepts in the store come
+    first, followed by the other concepts in the SDH, and the LOD cloud is not queried.
+
+    Raises an exception if the SDH cannot be queried, so that incomplete lists are never cached.
+    """
+    stored = vocabulary_store.concepts(uri)
+    seen = set()
+    for concept in stored:
+        seen.add(concept_key(concept))
+        yield concept
+
+    query_template = """
         PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
         PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
         PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
         PREFIX dct: <http://purl.org/dc/terms/>
+        PREFIX qbrv: <http://data.socialhistory.org/vocab/>
 
         SELECT DISTINCT ?uri ?label ?notation WHERE {{
           {{ ?uri skos:inScheme <{URI}> . }}
           UNION
-          {{ <{URI}> skos:member+ ?uri . }}
+          {{ {MEMBERS} }}
           ?uri skos:prefLabel ?label .
           OPTIONAL {{ ?uri skos:notation ?notation . }}
         }}
-    """.format(URI=uri)
+    """
+    lod_query = query_template.format(URI=uri, MEMBERS="<{}> skos:member+ ?uri .".format(uri))
+    sdh_query = query_template.format(URI=uri, MEMBERS="GRAPH <{}> {{ <{}> qbrv:transitiveMember ?uri . }}".format(
+        config.MEMBERSHIP_GRAPH, uri))
 
-    lod_codelist = []
-    sdh_codelist = []
+    def lod_concepts():
+        try:
+            log.debug("Querying the LOD cloud cache")
+            sparql = SPARQLWrapper('http://lod.openlinksw.com/sparql')
+            sparql.setTimeout(1)
+            sparql.setReturnFormat(JSON)
+            sparql.setQuery(lod_query)
+
+            lod_codelist_results = sparql.query().convert()['results']['bindings']
+            if len(lod_codelist_results) > 0:
+                lod_codelist = sc.dictize(lod_codelist_results)
+            else:
+                lod_codelist = []
 
-    try:
-        log.debug("Querying the LOD cloud cache")
-        # First we go to the LOD cloud
-        sparql = SPARQLWrapper('http://lod.openlinksw.com/sparql')
-        sparql.setTimeout(1)
-        sparql.setReturnFormat(JSON)
-        sparql.setQuery(query)
-
-        lod_codelist_results = sparql.query().convert()['results']['bindings']
-        if len(lod_codelist_results) > 0:
-            lod_codelist = sc.dictize(lod_codelist_results)
-        else:
+            log.debug("Retrieved {} concepts from the LOD cloud".format(len(lod_codelist)))
+        except Exception as e:
+            log.error(e)
+            log.error('Could not retrieve anything from the LOD cloud')
             lod_codelist = []
 
-        log.debug(lod_codelist)
-    except Exception as e:
-        log.error(e)
-        log.error('Could not retrieve anything from the LOD cloud')
-        lod_codelist = []
+        return lod_codelist
 
+    # We query the LOD cloud while the SDH results stream in
+    lod = None if stored else gevent.spawn(lod_concepts)
     try:
         log.debug("Querying the SDH")
-        # Then we have a look locally
-        sdh_codelist_results = sc.sparql(query)
-        if len(sdh_codelist_results) > 0:
-            sdh_codelist = sc.dictize(sdh_codelist_results)
-        else:
-            sdh_codelist = []
-
-        log.debug(sdh_codelist)
-
+        # In pages, as code lists such as HISCO can be large
+        for concept in sc.iter_dictize(sc.iter_sparql(sdh_query + "ORDER BY ?uri ?label ?notation")):
+            if concept_key(concept) not in seen:
+                yield concept
     except Exception as e:
         log.error(e)
         log.error('Could not retrieve anything from the SDH')
-        sdh_codelist = []
+        if lod is not None:
+            lod.kill(block=False)
+        raise Exception("Could not retrieve the concepts of <{}> from the SDH".format(uri))
+
+    if lod is not None:
+        try:
+            lod_codelist = lod.get(block=True, timeout=config.FAN_OUT_TIMEOUT) or []
+        except gevent.Timeout:
+            log.error('Could not retrieve anything from the LOD cloud in time')
+            lod.kill(block=False)
+            lod_codelist = []
+
+        for concept in lod_codelist:
+            yield concept
+
+
+def concept_key(concept):
+    return concept['uri'], concept['label'], concept.get('notation')
+
 
-    return lod_codelist + sdh_codelist
+def concepts_size(concepts):
+    """Approximates the memory used by a list of concepts (in bytes)"""
+    return sum(200 + sum(len(v) for v in c.values()) for c in concepts)
 
 
-def get_datasets():
+def prefetch_concepts(uris=None):
+    """Loads the concepts of the schemes (by default: those in CONCEPT_PREFETCH) into the concept cache,
+    in the background"""
+    if uris is None:
+        uris = config.CONCEPT_PREFETCH
+
+    return [concept_cache.refresh(uri) for uri in set(uris)]
+
+
+def invalidate_concepts(uris):
+    """Drops the cached concepts of the schemes and collections, and reloads the popular ones right away"""
+    uris = set(uris)
+    concept_cache.invalidate(uris)
+
+    popular = set(uri for uri, _ in concept_requests.most_common(config.CONCEPT_PREFETCH_TOP))
+    prefetch_concepts(uris & (popular | set(config.CONCEPT_PREFETCH)))
+
+
+def codelist_uris(lines):
+    """Returns the URIs of the schemes and collections that the N-Triples or N-Quads statements add members to"""
+    uris = set()
+    for line in lines:
+        if SKOS_MEMBER in line:
+            uris.add(line.split(None, 1)[0][1:-1])
+        elif SKOS_IN_SCHEME in line:
+            uris.add(line.split(None, 3)[2][1:-1])
+
+    return uris
+
+
+def get_datasets(offset=0, limit=None, owner=None):
+    """Lists the datasets in the catalog graph (see catalog.py), ordered by label, optionally only those of
+    the owner (a URI), and only `limit` of them starting at `offset`"""
+    if owner is not None and sc.INVALID_IRI_PATTERN.search(owner):
+        raise Exception("Not a valid owner URI: {}".format(owner))
+
     query = """
-        PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
         PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-        PREFIX np: <http://www.nanopub.org/nschema#>
         PREFIX qb: <http://purl.org/linked-data/cube#>
         PREFIX prov: <http://www.w3.org/ns/prov#>
+        PREFIX qbrv: <http://data.socialhistory.org/vocab/>
+
+        SELECT DISTINCT ?uri ?label ?owner ?nanopublication
+        FROM <{CATALOG}>
+        WHERE {{
+          {OWNER}
+          ?uri a qb:DataSet ;
+               rdfs:label ?label ;
+               qbrv:definedIn ?nanopublication .
+          ?nanopublication prov:wasAttributedTo ?owner .
+        }}
+        ORDER BY ?label ?uri ?nanopublication
+    """.format(CATALOG=config.CATALOG_GRAPH,
+               OWNER="" if owner is None else "VALUES ?owner {{ <{}> }}".format(owner))
 
-        SELECT DISTINCT ?uri ?label ?owner ?nanopublication WHERE {
-          ?nanopublication a         np:Nanopublication ;
-               np:hasAssertion       ?assertion_uri ;
-               np:hasPublicationInfo ?pubinfo_uri .
-
-          GRAPH ?assertion_uri {
-            ?uri         a                    qb:DataSet ;
-                         rdfs:label           ?label .
-          }
-          GRAPH ?pubinfo_uri {
-            ?nanopublication         prov:wasAttributedTo ?owner .
-          }
-        }
-    """
+    if limit is not None:
+        query += "LIMIT {}\n".format(max(0, int(limit)))
+    if offset:
+        query += "OFFSET {}\n".format(int(offset))
 
     dataset_list = []
 
     try:
         log.debug("Querying the SDH")
         # Then we have a look locally
-        sdh_datasets_results = sc.sparql(query)
+        sdh_datasets_results = sc.sparql(query, cache=True)
         if len(sdh_datasets_results) > 0:
             dataset_list = sc.dictize(sdh_datasets_results)
         else:
@@ -417,85 +684,221 @@ def get_datasets():
 
 
 def delete_dataset(uri):
-    log.warning("TODO: Untested! Unsafe!")
-    uri = uri.strip()
+    """Deletes the nanopublication in the background (see delete_datasets), and returns the job"""
+    return delete_datasets([uri])
 
-    query = """
+
+def delete_datasets(uris):
+    """Queues a job that deletes the nanopublications: removes them from the catalog, clears their assertion,
+    provenance and publication info graphs, and removes the nanopublications themselves.
+
+    :returns: the job, of which the result lists the deleted and the missing nanopublications
+    """
+    uris = sorted(set(uri.strip() for uri in uris))
+    invalid = [uri for uri in uris if sc.INVALID_IRI_PATTERN.search(uri)]
+    if invalid:
+        raise Exception("Not a valid nanopublication URI: {}".format(invalid[0]))
+
+    return jobs.submit("Delete {} nanopublication(s)".format(len(uris)), run_deletion, uris)
+
+
+def run_deletion(job, uris):
+    """Deletes the nanopublications (see delete_datasets), reporting progress per graph on the job"""
+    query_template = """
         PREFIX np: <http://www.nanopub.org/nschema#>
 
-        SELECT DISTINCT ?assertion_uri ?pubinfo_uri ?provenance_uri WHERE {{
-            <{URI}> a         np:Nanopublication ;
+        SELECT DISTINCT ?uri ?assertion_uri ?pubinfo_uri ?provenance_uri WHERE {{
+            VALUES ?uri {{ {URIS} }}
+            ?uri a         np:Nanopublication ;
                np:hasAssertion       ?assertion_uri ;
                np:hasPublicationInfo ?pubinfo_uri ;
                np:hasProvenance      ?provenance_uri .
         }}
-    """.format(URI=uri)
-
-    def clear_graph(uri):
-        clear_query_template = """
-            DEFINE sql:log-enable 2
-            CLEAR GRAPH <{}>
-        """
-        clear_query = clear_query_template.format(uri)
-        log.debug("Clearing graph {}".format(uri))
-        return sc.sparql_update(clear_query)
-
-    def delete_publication(uri):
-        delete_query = """
-            PREFIX np: <http://www.nanopub.org/nschema#>
-
-            DELETE {{ GRAPH ?g {{
-              <{URI}> a         np:Nanopublication ;
-                   np:hasAssertion       ?assertion_uri ;
-                   np:hasPublicationInfo ?pubinfo_uri ;
-                   np:hasProvenance      ?provenance_uri .
-                ?assertion_uri a    np:Assertion .
-                ?pubinfo_uri a      np:PublicationInfo .
-                ?provenance_uri a   np:Provenance .
-            }}}}
-            WHERE {{ GRAPH ?g {{
-              <{URI}> a         np:Nanopublication ;
-                   np:hasAssertion       ?assertion_uri ;
-                   np:hasPublicationInfo ?pubinfo_uri ;
-                   np:hasProvenance      ?provenance_uri .
-                ?assertion_uri a    np:Assertion .
-                ?pubinfo_uri a      np:PublicationInfo .
-                ?provenance_uri a   np:Provenance .
-            }}}}
-        """.format(URI=uri)
-
-        log.debug("Removing the nanopublication {}...".format(uri))
-        return sc.sparql_update(delete_query)
-
-
-    nanopub = {}
+    """
 
-    try:
-        log.debug("Querying the SDH")
-        # Then we have a look locally
-        nanopub_results = sc.sparql(query)
-        if len(nanopub_results) > 0:
-            nanopub = sc.dictize(nanopub_results)[0]
-            log.debug(nanopub)
-
-            t_assertion = Thread(target=clear_graph, args=(nanopub['assertion_uri'],))
-            t_assertion.start()
-            t_provenance = Thread(target=clear_graph, args=(nanopub['provenance_uri'],))
-            t_provenance.start()
-            t_pubinfo = Thread(target=clear_graph, args=(nanopub['pubinfo_uri'],))
-            t_pubinfo.start()
-            t_publication = Thread(target=delete_publication, args=(uri,))
-            t_publication.start()
-
-            return "Called delete functions for {}".format(uri)
-        else:
-            return "No matching nanopublication found"
+    nanopubs = []
+    for batch in catalog.batches(uris):
+        nanopubs.extend(sc.dictize(sc.sparql(query_template.format(URIS=catalog.values(batch)))))
+
+    deleted = sorted(set(nanopub['uri'] for nanopub in nanopubs))
+    job.total = 3 * len(nanopubs) + 1
+    log.debug("Deleting {} of {} nanopublications".format(len(deleted), len(uris)))
+
+    catalog.remove(deleted)
+
+    # The assertion graphs may have added members to collections that are published elsewhere
+    collections = set()
+    for nanopub in nanopubs:
+        collections.update(catalog.graph_collections(nanopub['assertion_uri']))
+
+        for graph_uri in (nanopub['assertion_uri'], nanopub['provenance_uri'], nanopub['pubinfo_uri']):
+            job.message = "Clearing <{}>".format(graph_uri)
+            clear_graph(graph_uri)
+            job.done += 1
+
+    job.message = "Removing the nanopublications"
+    for batch in catalog.batches(deleted):
+        delete_publications(batch)
+    job.done += 1
+
+    collections = catalog.update_membership(collections)
+    definition_cache.clear()
+    scheme_catalog.refresh()
+    invalidate_concepts(collections)
+
+    job.message = None
+    return {'deleted': deleted, 'missing': sorted(set(uris) - set(deleted))}
+
+
+def clear_graph(uri, chunk_size=config.CLEAR_CHUNK_SIZE):
+    """Clears the graph in updates of at most `chunk_size` triples, so that the endpoint never has to log
+    the removal of a very large graph in a single transaction"""
+    count_query = "SELECT (COUNT(*) AS ?count) WHERE {{ GRAPH <{}> {{ ?s ?p ?o }} }}".format(uri)
+    delete_template = """
+        DEFINE sql:log-enable 2
+        DELETE {{ GRAPH <{URI}> {{ ?s ?p ?o }} }}
+        WHERE {{
+            {{ SELECT ?s ?p ?o WHERE {{ GRAPH <{URI}> {{ ?s ?p ?o }} }} LIMIT {LIMIT} }}
+        }}
+    """
 
-        log.debug(nanopub)
-    except Exception as e:
-        log.error(e)
-        log.error("Could not retrieve anything from the SDH")
-        log.debug(nanopub_results)
-        return "Could not retrieve anything from the SDH"
+    results = sc.sparql(count_query)
+    if isinstance(results, basestring) or not results or 'count' not in results[0]:
+        raise Exception("Could not count the triples in graph <{}>: {}".format(uri, results[:200]))
+
+    count = int(results[0]['count']['value'])
+    chunks = (count + chunk_size - 1) // chunk_size
+    log.debug("Clearing graph {} ({} triples) in {} chunks".format(uri, count, chunks))
+
+    for _ in range(chunks):
+        sc.execute_updates([delete_template.format(URI=uri, LIMIT=chunk_size)])
+
+    # Removes whatever was added in the meantime, and the (now empty) graph itself
+    sc.execute_updates(["CLEAR SILENT GRAPH <{}>".format(uri)])
+
+
+def delete_publications(uris):
+    """Removes the statements that make the URIs nanopublications"""
+    delete_query = """
+        PREFIX np: <http://www.nanopub.org/nschema#>
+
+        DELETE {{ GRAPH ?g {{
+          ?uri a         np:Nanopublication ;
+               np:hasAssertion       ?assertion_uri ;
+               np:hasPublicationInfo ?pubinfo_uri ;
+               np:hasProvenance      ?provenance_uri .
+            ?assertion_uri a    np:Assertion .
+            ?pubinfo_uri a      np:PublicationInfo .
+            ?provenance_uri a   np:Provenance .
+        }}}}
+        WHERE {{ GRAPH ?g {{
+          VALUES ?uri {{ {URIS} }}
+          ?uri a         np:Nanopublication ;
+               np:hasAssertion       ?assertion_uri ;
+               np:hasPublicationInfo ?pubinfo_uri ;
+               np:hasProvenance      ?provenance_uri .
+            ?assertion_uri a    np:Assertion .
+            ?pubinfo_uri a      np:PublicationInfo .
+            ?provenance_uri a   np:Provenance .
+        }}}}
+    """.format(URIS=catalog.values(uris))
+
+    log.debug("Removing {} nanopublications...".format(len(uris)))
+    sc.execute_updates([delete_query])
+
+
+def publish_data_structure_delta(profile, dataset_name, dataset_base_uri, variables, source_path, source_hash):
+    """Publishes only the changes to the data structure definition of a dataset that was published before
+    from the same source file: the triples removed from and added to the earlier assertion graph are sent
+    as a single DELETE DATA/INSERT DATA request, and the change is recorded as a revision in the earlier
+    provenance graph (see datacube.converter.data_structure_delta).
+
+    :returns: None if there is no earlier publication, or the URI of the nanopublication and the numbers
+              of triples removed and added
+    """
+    previous = get_previous_publication(dataset_base_uri, source_hash)
+    if previous is None:
+        log.debug("No earlier publication of {} from {}".format(dataset_base_uri, source_path))
+        return None
+
+    # Only when the earlier assertion graph holds the data structure definition that the converter module would
+    # generate (rather than one with other URIs), as the statements it does not recognize are never changed
+    structure = (URIRef(dataset_base_uri), datacube.QB['structure'], URIRef('{}/structure'.format(dataset_base_uri)))
+    if structure not in previous['triples']:
+        log.warning("The earlier publication {} of {} has another data structure definition".format(
+            previous['nanopublication'], dataset_base_uri))
+        return None
+
+    removed, added = datacube.data_structure_delta(previous, profile, dataset_name, dataset_base_uri, variables,
+                                                   source_hash)
+    result = {'nanopublication': previous['nanopublication'],
+              'removed': len([q for q in removed if q[3] == previous['assertion']]),
+              'added': len([q for q in added if q[3] == previous['assertion']])}
+
+    if not removed and not added:
+        log.debug("The data structure definition of {} did not change".format(dataset_base_uri))
+        return result
+
+    log.debug("Removing {removed} and adding {added} triples to {nanopublication}".format(**result))
+    updates = list(sc.make_quad_update(removed, operation='DELETE DATA')) + list(sc.make_quad_update(added))
+    sc.execute_updates(updates, group_size=len(updates))
+
+    catalog.remove([previous['nanopublication']])
+    catalog.add_nanopublications([previous['nanopublication']])
+
+    # The collections that members were removed from or added to
+    collections = set(unicode(s if p == datacube.SKOS['member'] else o)
+                      for s, p, o, g in removed + added if p in (datacube.SKOS['member'], datacube.SKOS['inScheme']))
+    collections = catalog.update_membership(collections)
+    definition_cache.clear()
+    scheme_catalog.refresh()
+    invalidate_concepts(collections)
+
+    return result
+
+
+def get_previous_publication(dataset_uri, source_hash):
+    """Returns the URIs of the latest nanopublication of the dataset from the version of the source file, and of
+    its assertion and provenance graphs, with the triples of the data structure definition in its assertion graph
+    (see datacube.converter.is_structure_triple), or None if there is none"""
+    if sc.INVALID_IRI_PATTERN.search(dataset_uri + source_hash):
+        raise Exception("Not a valid dataset URI or source hash: {} {}".format(dataset_uri, source_hash))
 
-    return "Not implemented"
+    query = """
+        PREFIX np: <http://www.nanopub.org/nschema#>
+        PREFIX prov: <http://www.w3.org/ns/prov#>
+
+        SELECT ?nanopublication ?assertion ?provenance WHERE {{
+            ?nanopublication a np:Nanopublication ;
+                np:hasAssertion ?assertion ;
+                np:hasProvenance ?provenance .
+            GRAPH ?provenance {{
+                <{DATASET}> prov:wasDerivedFrom <{VERSION}> .
+                ?assertion prov:wasDerivedFrom <{VERSION}> ;
+                    prov:generatedAtTime ?time .
+            }}
+        }}
+        ORDER BY DESC(?time) DESC(?nanopublication)
+        LIMIT 1
+    """.format(DATASET=dataset_uri, VERSION='{}/{}'.format(dataset_uri, source_hash[:8]))
+
+    results = sc.dictize(sc.sparql(query))
+    if not results:
+        return None
+
+    previous = dict((k, URIRef(v)) for k, v in results[0].items())
+    # Not the observations, which may well be the largest part of the graph
+    triples_query = """
+        SELECT ?s ?p ?o WHERE {{
+            VALUES ?p {{ {PREDICATES} }}
+            GRAPH <{GRAPH}> {{ ?s ?p ?o }}
+            FILTER (?p != <{TYPE}> || ?o IN ({CLASSES}))
+        }}
+        ORDER BY ?s ?p ?o
+    """.format(GRAPH=previous['assertion'], TYPE=datacube.RDF.type,
+               PREDICATES=" ".join(p.n3() for p in sorted(datacube.STRUCTURE_PREDICATES)),
+               CLASSES=", ".join(c.n3() for c in sorted(datacube.STRUCTURE_CLASSES)))
+    previous['triples'] = set((sc.term(b['s']), sc.term(b['p']), sc.term(b['o']))
+                              for b in sc.iter_sparql(triples_query))
+
+    return previous
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import logging
+import traceback
+from threading import RLock
+from email.utils import formatdate
+
+import gevent
+import requests
+
+from dimension_index import DimensionIndex
+from app import app
+
+log = app.logger
+log.setLevel(logging.DEBUG)
+
+
+# The fields of an LSD dimension that are used by the API (drops e.g. the HTML 'view' snippet)
+FIELDS = ('id', 'uri', 'label', 'refs')
+
+
+class DimensionCatalog(object):
+    """A process-wide, in-memory catalog of the Linked Statistical Data dimensions.
+
+    The dimensions are read from a local copy (`path`) of the LSD service data, once, and
+    kept stripped of unused fields, without dimensions with fewer than `min_refs` references,
+    and sorted by number of references. The file is read again when it changes on disk. On every
+    load, a search index of the dimensions (most references first) is built as well.
+
+    Every `refresh_interval` seconds, the local copy is refreshed from the LSD service (`url`)
+    in the background, with a conditional request (using the ETag and Last-Modified of the
+    previous response, or the modification time of the file). Requests are served from the
+    current catalog in the meantime.
+    """
+
+    def __init__(self, path, url, min_refs=2, refresh_interval=86400, timeout=30):
+        self.path = path
+        self.url = url
+        self.min_refs = min_refs
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+
+        self.dimensions = []
+        self.index = DimensionIndex([])
+        self.mtime = None
+        self.etag = None
+        self.last_modified = None
+        self.checked = 0
+        self.refreshing = None
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self.get())
+
+    def get_index(self):
+        """Returns the search index of the current list of dimensions"""
+        self.get()
+        return self.index
+
+    def get(self):
+        """Returns the current list of dimensions (do not modify it)"""
+        mtime = self.file_mtime()
+
+        if mtime is None and self.mtime is None and self.checked + self.refresh_interval < time.time():
+            # Nothing to serve yet, so wait for the service
+            self.refresh()
+            mtime = self.file_mtime()
+
+        if mtime is not None and mtime != self.mtime:
+            self.load()
+
+        if self.checked + self.refresh_interval < time.time():
+            self.start_refresh()
+
+        return self.dimensions
+
+    def load(self):
+        """(Re)loads the catalog from the local copy"""
+        with self._lock:
+            mtime = self.file_mtime()
+            if mtime is None or mtime == self.mtime:
+                return
+
+            log.debug("Loading dimensions from {}...".format(self.path))
+            with open(self.path, 'r') as f:
+                dimensions = self.compact(json.load(f))
+
+            self.index = DimensionIndex(reversed(dimensions))
+            self.dimensions = dimensions
+            self.mtime = mtime
+            if not self.checked:
+                # Do not check the service before the file is as old as the refresh interval
+                self.checked = mtime
+
+            log.debug("Loaded {} dimensions".format(len(dimensions)))
+
+    def compact(self, dimensions):
+        """Keeps only the used fields of dimensions with at least `min_refs` references, sorted by references"""
+        compacted = []
+        for dim in dimensions:
+            if dim.get('refs', 0) < self.min_refs:
+                continue
+
+            compacted.append(dict((k, dim[k]) for k in FIELDS if k in dim))
+
+        compacted.sort(key=lambda d: d['refs'])
+        return compacted
+
+    def start_refresh(self):
+        """Refreshes the local copy in the background, unless a refresh is already running"""
+        with self._lock:
+            if self.refreshing is not None and not self.refreshing.ready():
+                return
+
+            self.checked = time.time()
+            self.refreshing = gevent.spawn(self.refresh)
+
+    def refresh(self):
+        """Downloads the dimensions from the LSD service if they changed, and reloads the catalog.
+
+        :returns: True if the local copy was updated
+        """
+        self.checked = time.time()
+
+        headers = {'Accept': 'application/json'}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        elif self.file_mtime() is not None:
+            headers['If-Modified-Since'] = formatdate(self.file_mtime(), usegmt=True)
+
+        try:
+            log.debug("Loading dimensions from LSD service...")
+            response = requests.get(self.url, headers=headers, timeout=self.timeout)
+
+            if response.status_code == 304:
+                log.debug("Dimensions at {} not modified".format(self.url))
+                return False
+
+            response.raise_for_status()
+
+            dimensions = json.loads(response.content)
+            if not isinstance(dimensions, list) or len(dimensions) == 0:
+                raise Exception("Could not load dimensions from service: no dimensions in response")
+
+            # Write to a temporary file first, so the catalog never reads a partial copy
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(response.content)
+            os.rename(temp_path, self.path)
+
+            self.etag = response.headers.get('ETag')
+            self.last_modified = response.headers.get('Last-Modified')
+        except Exception as e:
+            log.debug(traceback.format_exc())
+            log.error("Could not refresh dimensions from {}: {}".format(self.url, e))
+            return False
+
+        self.load()
+        return True
+
+    def file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
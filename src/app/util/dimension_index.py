@@ -0,0 +1,77 @@
+from array import array
+from collections import defaultdict
+
+EMPTY = array('i')
+
+
+class DimensionIndex(object):
+    """An n-gram index for substring search over the labels and URIs of dimensions.
+
+    Every dimension is indexed under all 1- to `n`-grams of its lower-cased label and URI
+    (without the scheme), and under the first 1 to `n` characters of its label. Queries of at
+    most `n` characters are answered from the index directly; for longer queries, the shortest
+    list of dimensions that contain one of the n-grams of the query is checked for the full query.
+
+    The dimensions should be given in order of rank: `search` returns the positions of the
+    matches in that order, those whose label starts with the query first.
+    """
+
+    def __init__(self, dimensions, n=3):
+        self.n = n
+        self.dimensions = list(dimensions)
+        self.labels = [(d.get('label') or u'').lower() for d in self.dimensions]
+        self.texts = [label + u' ' + strip_scheme(d.get('uri') or u'').lower()
+                      for label, d in zip(self.labels, self.dimensions)]
+        self.positions = dict((d.get('uri'), i) for i, d in reversed(list(enumerate(self.dimensions))))
+        self.all = array('i', range(len(self.dimensions)))
+
+        postings = defaultdict(lambda: array('i'))
+        prefixes = defaultdict(lambda: array('i'))
+        for i, (label, text) in enumerate(zip(self.labels, self.texts)):
+            for gram in set(ngrams(text, n)):
+                postings[gram].append(i)
+            for size in range(1, min(len(label), n) + 1):
+                prefixes[label[:size]].append(i)
+
+        self.postings = dict(postings)
+        self.prefixes = dict(prefixes)
+
+    def __len__(self):
+        return len(self.dimensions)
+
+    def __getitem__(self, position):
+        return self.dimensions[position]
+
+    def search(self, query):
+        """Returns the positions of the matching dimensions, as a tuple of those whose label starts
+        with the query, and the others"""
+        query = query.strip().lower()
+        if not query:
+            return self.all, EMPTY
+
+        if len(query) <= self.n:
+            matches = self.postings.get(query, EMPTY)
+            prefix = self.prefixes.get(query, EMPTY)
+        else:
+            texts = self.texts
+            labels = self.labels
+            candidates = min((self.postings.get(g, EMPTY) for g in set(ngrams(query, self.n, self.n))), key=len)
+            matches = [i for i in candidates if query in texts[i]]
+            prefix = [i for i in self.prefixes.get(query[:self.n], EMPTY) if labels[i].startswith(query)]
+
+        if not prefix:
+            return prefix, matches
+
+        in_prefix = set(prefix)
+        return prefix, [i for i in matches if i not in in_prefix]
+
+
+def ngrams(text, n, min_n=1):
+    """All substrings of `text` with a length between `min_n` and `n`"""
+    for size in range(min_n, n + 1):
+        for start in range(len(text) - size + 1):
+            yield text[start:start + size]
+
+
+def strip_scheme(uri):
+    return uri.split('://', 1)[-1]
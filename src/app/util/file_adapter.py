@@ -10,7 +10,7 @@ from collections import OrderedDict
 import csv
 import pandas as pd
 import numpy as np
-import iribaker
+import app.util.iri as ib
 import magic
 import os
 import traceback
@@ -34,10 +34,10 @@ class Adapter(object):
             self.dataset_name = dataset['name']
 
         if 'version' in dataset:
-            self.dataset_uri = iribaker.to_iri(
+            self.dataset_uri = ib.to_iri(
                 config.QBR_BASE + dataset['version'] + '/' + self.dataset_name)
         else:
-            self.dataset_uri = iribaker.to_iri(
+            self.dataset_uri = ib.to_iri(
                 config.QBR_BASE + self.dataset_name)
 
         print "Initialized adapter"
@@ -120,11 +120,10 @@ class Adapter(object):
 
             # print self.data[col][0]
 
-            for i in counts.index:
-                print col, i
-                # The URI for the variable value
-                i_uri = iribaker.to_iri(u"{}/value/{}/{}"
-                                        .format(self.dataset_uri, col, i))
+            # The URIs for the variable values
+            i_uris = ib.to_iris([u"{}/value/{}/{}".format(self.dataset_uri, col, i) for i in counts.index])
+
+            for i, i_uri in zip(counts.index, i_uris):
 
                 # Capture the counts and label in a dictionary for the value
                 stat = {
@@ -141,11 +140,11 @@ class Adapter(object):
                 istats.append(stat)
 
             # The URI for the variable
-            variable_uri = iribaker.to_iri("{}/variable/{}"
-                                           .format(self.dataset_uri, col))
+            variable_uri = ib.to_iri("{}/variable/{}"
+                                     .format(self.dataset_uri, col))
             # The URI for a (potential) codelist for the variable
-            codelist_uri = iribaker.to_iri("{}/codelist/{}"
-                                           .format(self.dataset_uri, col))
+            codelist_uri = ib.to_iri("{}/codelist/{}"
+                                     .format(self.dataset_uri, col))
 
             codelist_label = "Codelist generated from the values for '{}'".format(
                 col)
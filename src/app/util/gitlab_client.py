@@ -4,6 +4,7 @@ import gitlab
 import os
 import json
 import base64
+import hashlib
 import traceback
 
 from datetime import datetime
@@ -175,6 +176,16 @@ def get_local_file_path(relative_dataset_path):
     return filename
 
 
+def blob_hash(path):
+    """Returns the Git hash of the contents of the file (the blob id GitLab reports for it)"""
+    sha = hashlib.sha1("blob {}\0".format(os.path.getsize(path)))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
 # TODO: Copied from File Client
 def load(dataset_name, relative_dataset_path):
 
@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import logging
+from threading import RLock
+from collections import deque
+
+from app import app
+
+log = app.logger
+log.setLevel(logging.DEBUG)
+
+
+# Calls made from these modules are attributed to the function that called into them
+INTERNAL_MODULES = set(['sparql_client', 'bulk_loader', 'instrumentation', 'parallel', 'cache', 'contextlib'])
+
+
+class Instrumentation(object):
+    """Collects statistics on the calls made to the SPARQL query, update and CRUD endpoints.
+
+    For every call it records the duration, the number of bytes sent and received, the number of
+    results and whether it failed, aggregated per kind of call ('query', 'update', 'crud'), endpoint
+    and calling function. Calls that take longer than `slow_threshold` seconds are logged, and kept
+    (with their query text, normalized by `normalize` and cut off at `max_query_length` characters)
+    in a slow-query log of the last `slow_log_size` such calls.
+    """
+
+    def __init__(self, slow_threshold=1.0, slow_log_size=100, normalize=None, max_query_length=4000):
+        self.slow_threshold = slow_threshold
+        self.slow_log_size = slow_log_size
+        self.normalize = normalize or (lambda query: query)
+        self.max_query_length = max_query_length
+        self._lock = RLock()
+        self.reset()
+
+    def reset(self):
+        """Clears the aggregates and the slow-query log"""
+        with self._lock:
+            self.since = time.time()
+            self.aggregates = {}
+            self.slow = deque(maxlen=self.slow_log_size)
+
+    def call(self, kind, endpoint_url, query=None, bytes_out=0):
+        """Starts measuring a call, use as a context manager:
+
+            with stats.call('query', endpoint_url, query) as c:
+                response = session.get(...)
+                c.bytes_in = len(response.content)
+        """
+        return Call(self, kind, endpoint_url, query, bytes_out, caller())
+
+    def record(self, call):
+        key = (call.kind, call.endpoint_url, call.caller)
+
+        with self._lock:
+            a = self.aggregates.get(key)
+            if a is None:
+                a = self.aggregates[key] = {'kind': call.kind, 'endpoint': call.endpoint_url, 'caller': call.caller,
+                                            'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                            'bytes_out': 0, 'bytes_in': 0, 'rows': 0}
+            a['calls'] += 1
+            a['errors'] += 1 if call.error is not None else 0
+            a['seconds'] += call.seconds
+            a['max_seconds'] = max(a['max_seconds'], call.seconds)
+            a['bytes_out'] += call.bytes_out
+            a['bytes_in'] += call.bytes_in
+            a['rows'] += call.rows or 0
+
+        if call.seconds < self.slow_threshold:
+            return
+
+        entry = call.as_dict()
+        if call.query is not None:
+            entry['query'] = self.normalize(call.query)[:self.max_query_length]
+
+        with self._lock:
+            self.slow.append(entry)
+
+        log.warning("Slow SPARQL {} ({:.2f}s, {} rows, {} bytes) from {}:\n{}".format(
+            call.kind, call.seconds, call.rows, call.bytes_in, call.caller, entry['query']))
+
+    def stats(self):
+        """Returns the aggregates (slowest total time first) and the slow-query log (most recent first)"""
+        with self._lock:
+            aggregates = [dict(a) for a in self.aggregates.values()]
+            slow = list(reversed(self.slow))
+
+        for a in aggregates:
+            a['mean_seconds'] = a['seconds'] / a['calls']
+
+        return {
+            'since': self.since,
+            'slow_threshold': self.slow_threshold,
+            'calls': sorted(aggregates, key=lambda a: a['seconds'], reverse=True),
+            'slow': slow
+        }
+
+
+class Call(object):
+    """A single measured call. Set `bytes_in`, `rows` and `status` while the call is in progress."""
+
+    def __init__(self, instrumentation, kind, endpoint_url, query, bytes_out, caller):
+        self.instrumentation = instrumentation
+        self.kind = kind
+        self.endpoint_url = endpoint_url
+        self.query = query
+        self.bytes_out = bytes_out
+        self.caller = caller
+        self.bytes_in = 0
+        self.rows = None
+        self.status = None
+        self.error = None
+        self.start = None
+        self.seconds = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.seconds = time.time() - self.start
+        if exc_value is not None and not isinstance(exc_value, GeneratorExit):
+            self.error = str(exc_value) or exc_type.__name__
+
+        self.instrumentation.record(self)
+        return False
+
+    def as_dict(self):
+        return {'kind': self.kind, 'endpoint': self.endpoint_url, 'caller': self.caller, 'time': self.start,
+                'seconds': self.seconds, 'bytes_out': self.bytes_out, 'bytes_in': self.bytes_in,
+                'rows': self.rows, 'status': self.status, 'error': self.error, 'query': None}
+
+
+def caller():
+    """The 'module.function' name of the first function on the stack outside the SPARQL client modules"""
+    frame = sys._getframe(2)
+
+    while frame is not None:
+        module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+        if module not in INTERNAL_MODULES:
+            return "{}.{}".format(module, frame.f_code.co_name)
+        frame = frame.f_back
+
+    return None
@@ -0,0 +1,72 @@
+import iribaker
+
+import app.config as config
+
+
+class Memo(object):
+    """A least-recently-used memo that is cheap enough to consult for every IRI, as most IRIs (such as
+    those of the values of a column) are baked only once.
+
+    The entries are kept in two dicts: new entries, and entries that are used again, go into the
+    current one, and once it holds `size` entries it replaces the previous one. So the `size` most
+    recently used entries are always remembered (and at most twice as many). There is no lock: at
+    worst, concurrent updates forget an entry, which is then baked again.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.current = {}
+        self.previous = {}
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def __contains__(self, key):
+        return key in self.current or key in self.previous
+
+    def get(self, key):
+        value = self.current.get(key)
+        if value is None:
+            value = self.previous.get(key)
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        if len(self.current) >= self.size:
+            self.previous = self.current
+            self.current = {}
+        self.current[key] = value
+
+
+# The most recently baked IRIs, by source (see to_iri)
+memo = Memo(config.IRI_MEMO_SIZE)
+
+
+def to_iri(source):
+    """Bakes an RFC 3987 compliant IRI from the string with iribaker (replacing invalid characters),
+    remembering the results for (at least) the IRI_MEMO_SIZE most recently used distinct strings.
+
+    Raises an exception if the string cannot be made into an IRI (e.g. if it has no scheme)."""
+    iri = memo.get(source)
+    if iri is None:
+        iri = iribaker.to_iri(source)
+        memo.put(source, iri)
+
+    return iri
+
+
+def to_iris(sources, strict=True):
+    """Bakes the IRIs of all strings (see to_iri), in order. Unless `strict`, the IRI of a string that
+    cannot be made into an IRI is None, rather than raising an exception."""
+    if strict:
+        return [to_iri(source) for source in sources]
+
+    iris = []
+    for source in sources:
+        try:
+            iris.append(to_iri(source))
+        except Exception:
+            iris.append(None)
+
+    return iris
@@ -0,0 +1,118 @@
+import time
+import uuid
+import logging
+import traceback
+from threading import RLock
+from collections import OrderedDict
+
+import gevent
+from gevent.queue import Queue
+
+from app import app
+
+log = app.logger
+log.setLevel(logging.DEBUG)
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job(object):
+    """A unit of background work. The function it runs is passed the job, and may report its
+    progress by setting `done`, `total` and `message` while it runs."""
+
+    def __init__(self, description, function, args):
+        self.id = uuid.uuid4().hex
+        self.description = description
+        self.function = function
+        self.args = args
+        self.status = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = 0
+        self.total = None
+        self.message = None
+        self.error = None
+        self.result = None
+
+    def run(self):
+        self.status = RUNNING
+        self.started = time.time()
+        log.info("Started job {} ({})".format(self.id, self.description))
+
+        try:
+            self.result = self.function(self, *self.args)
+            self.status = DONE
+            log.info("Finished job {} ({})".format(self.id, self.description))
+        except Exception as e:
+            log.debug(traceback.format_exc())
+            log.error("Job {} ({}) failed: {}".format(self.id, self.description, e))
+            self.error = str(e) or type(e).__name__
+            self.status = FAILED
+        finally:
+            self.finished = time.time()
+
+    def as_dict(self):
+        return {'id': self.id, 'description': self.description, 'status': self.status,
+                'created': self.created, 'started': self.started, 'finished': self.finished,
+                'done': self.done, 'total': self.total, 'message': self.message,
+                'error': self.error, 'result': self.result}
+
+
+class JobQueue(object):
+    """A queue of background jobs, run in order by at most `workers` greenlets at a time.
+
+    Jobs are kept (for status requests) until more than `history` jobs were submitted after them;
+    jobs that are queued or running are never dropped.
+    """
+
+    def __init__(self, workers=2, history=1000):
+        self.workers = workers
+        self.history = history
+        self.jobs = OrderedDict()
+        self._queue = Queue()
+        self._greenlets = []
+        self._lock = RLock()
+
+    def submit(self, description, function, *args):
+        """Queues `function(job, *args)`, and returns the job"""
+        job = Job(description, function, args)
+
+        with self._lock:
+            self.jobs[job.id] = job
+            self._forget()
+            self._start()
+
+        self._queue.put(job)
+        log.debug("Queued job {} ({})".format(job.id, description))
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list(self):
+        return list(self.jobs.values())
+
+    def join(self, timeout=None):
+        """Waits until all queued jobs have finished"""
+        with gevent.Timeout(timeout, False):
+            while any(job.status in (QUEUED, RUNNING) for job in self.jobs.values()):
+                gevent.sleep(0.01)
+
+    def _start(self):
+        self._greenlets = [g for g in self._greenlets if not g.ready()]
+        while len(self._greenlets) < self.workers:
+            self._greenlets.append(gevent.spawn(self._work))
+
+    def _work(self):
+        while True:
+            self._queue.get().run()
+
+    def _forget(self):
+        for job_id in list(self.jobs.keys())[:max(0, len(self.jobs) - self.history)]:
+            if self.jobs[job_id].status in (DONE, FAILED):
+                del self.jobs[job_id]
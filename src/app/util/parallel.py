@@ -0,0 +1,42 @@
+import logging
+
+import gevent
+
+import app.config as config
+
+from app import app
+
+log = app.logger
+log.setLevel(logging.DEBUG)
+
+
+def fan_out(calls, timeout=config.FAN_OUT_TIMEOUT, default=None):
+    """Runs the calls (functions without arguments) concurrently, with a combined deadline.
+
+    Waits until all calls have returned, or until `timeout` seconds have passed, whichever
+    comes first. Calls that are still running at the deadline are killed.
+
+    :returns: the results of the calls, in order (`default` for calls that failed or did not finish)
+    """
+    greenlets = [gevent.spawn(call) for call in calls]
+    gevent.joinall(greenlets, timeout=timeout)
+
+    results = []
+    for call, greenlet in zip(calls, greenlets):
+        if greenlet.successful():
+            results.append(greenlet.value)
+            continue
+
+        if not greenlet.ready():
+            greenlet.kill(block=False)
+            log.error("{} did not finish within {} seconds".format(name(call), timeout))
+        else:
+            log.error("{} failed: {}".format(name(call), greenlet.exception))
+
+        results.append(default)
+
+    return results
+
+
+def name(call):
+    return getattr(call, '__name__', None) or getattr(getattr(call, 'func', None), '__name__', repr(call))
@@ -0,0 +1,181 @@
+import isodate
+import numpy as np
+
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+INTEGER_TYPES = set(XSD + t for t in ['integer', 'int', 'long', 'short', 'byte', 'nonNegativeInteger',
+                                      'nonPositiveInteger', 'positiveInteger', 'negativeInteger',
+                                      'unsignedLong', 'unsignedInt', 'unsignedShort', 'unsignedByte', 'gYear'])
+FLOAT_TYPES = set(XSD + t for t in ['decimal', 'double', 'float'])
+BOOLEAN_TYPES = set([XSD + 'boolean'])
+DATETIME_TYPES = set([XSD + 'dateTime', XSD + 'dateTimeStamp'])
+DATE_TYPES = set([XSD + 'date'])
+
+
+class ResultTable(object):
+    """A column-oriented, typed representation of SPARQL SELECT results.
+
+    Every variable is a column: integer and decimal literals become int64 or float64 NumPy
+    arrays (float64 with NaN if values are missing), xsd:boolean a bool array, xsd:date and
+    xsd:dateTime datetime64 arrays (in UTC, NaT if missing), and everything else an object
+    array of interned strings (None if missing). The language tags of literals are kept in
+    `langs`, the datatype of typed columns in `datatypes`.
+    """
+
+    def __init__(self, variables, columns, datatypes, langs):
+        self.variables = variables
+        self.columns = columns
+        self.datatypes = datatypes
+        self.langs = langs
+
+    def __len__(self):
+        return len(self.columns[self.variables[0]]) if self.variables else 0
+
+    def __getitem__(self, variable):
+        return self.columns[variable]
+
+    def __iter__(self):
+        return self.rows()
+
+    def rows(self):
+        """Iterates over light-weight views of the rows, that behave like the dicts of `dictize`"""
+        for i in xrange(len(self)):
+            yield Row(self, i)
+
+    def dicts(self):
+        """Returns the rows as a list of dicts (leaving out missing values, as `dictize` does)"""
+        return [row.as_dict() for row in self.rows()]
+
+
+class Row(object):
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, variable):
+        value = self.get(variable)
+        if value is None:
+            raise KeyError(variable)
+        return value
+
+    def __contains__(self, variable):
+        return self.get(variable) is not None
+
+    def get(self, variable, default=None):
+        column = self.table.columns.get(variable)
+        if column is None:
+            return default
+
+        value = column[self.index]
+        if is_missing(value):
+            return default
+        # Plain Python values, so that rows can be serialized as JSON
+        return value.item() if isinstance(value, np.generic) else value
+
+    def keys(self):
+        return [v for v in self.table.variables if v in self]
+
+    def as_dict(self):
+        return dict((v, self.get(v)) for v in self.keys())
+
+    def __repr__(self):
+        return "Row({})".format(self.as_dict())
+
+
+def decode(bindings, variables=None):
+    """Decodes SPARQL JSON bindings (e.g. from `sparql` or `iter_sparql`) into a ResultTable"""
+    raw = {}
+    types = {}
+    langs = {}
+    count = 0
+
+    if variables is not None:
+        variables = list(variables)
+        for v in variables:
+            raw[v] = []
+            types[v] = set()
+            langs[v] = []
+    else:
+        variables = []
+
+    for binding in bindings:
+        for v, term in binding.items():
+            if v not in raw:
+                # A variable we have not seen before: pad the earlier rows
+                variables.append(v)
+                raw[v] = [None] * count
+                types[v] = set()
+                langs[v] = [None] * count
+
+            raw[v].append(term['value'])
+            langs[v].append(term.get('xml:lang'))
+            types[v].add(term.get('datatype') if term['type'] in ('literal', 'typed-literal') else term['type'])
+
+        count += 1
+        for v in variables:
+            if len(raw[v]) < count:
+                raw[v].append(None)
+                langs[v].append(None)
+
+    columns = {}
+    datatypes = {}
+    for v in variables:
+        columns[v], datatypes[v] = column(raw[v], types[v])
+        if not any(langs[v]):
+            langs[v] = None
+
+    return ResultTable(variables, columns, datatypes, langs)
+
+
+def column(values, types):
+    """Converts a list of lexical values to a typed array, if all values share a decodable type"""
+    if len(types) == 1:
+        datatype = next(iter(types))
+        missing = None in values
+
+        try:
+            if datatype in INTEGER_TYPES:
+                if missing:
+                    return np.array([np.nan if v is None else int(v) for v in values], dtype=np.float64), datatype
+                return np.array([int(v) for v in values], dtype=np.int64), datatype
+            elif datatype in FLOAT_TYPES:
+                return np.array([np.nan if v is None else float(v) for v in values], dtype=np.float64), datatype
+            elif datatype in BOOLEAN_TYPES and not missing:
+                return np.array([v in ('true', '1') for v in values], dtype=np.bool_), datatype
+            elif datatype in DATETIME_TYPES:
+                return np.array([parse_datetime(v) for v in values], dtype='datetime64[us]'), datatype
+            elif datatype in DATE_TYPES:
+                return np.array([None if v is None else isodate.parse_date(v) for v in values],
+                                dtype='datetime64[D]'), datatype
+        except (ValueError, isodate.ISO8601Error, OverflowError):
+            # Not all values are valid for the datatype, fall back to strings
+            pass
+
+    interned = {}
+    strings = np.empty(len(values), dtype=object)
+    strings[:] = [None if v is None else interned.setdefault(v, v) for v in values]
+    return strings, None
+
+
+def parse_datetime(value):
+    """Parses an xsd:dateTime as a naive datetime in UTC"""
+    if value is None:
+        return None
+
+    dt = isodate.parse_datetime(value)
+    if dt.tzinfo is not None:
+        dt = (dt - dt.utcoffset()).replace(tzinfo=None)
+    return dt
+
+
+def is_missing(value):
+    if value is None:
+        return True
+    elif isinstance(value, np.datetime64):
+        return str(value) == 'NaT'
+    elif isinstance(value, float):
+        return value != value
+    else:
+        return False
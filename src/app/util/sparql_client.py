@@ -1,8 +1,22 @@
 import app.config as config
-from rdflib import Graph, URIRef, Dataset
+from rdflib import Graph, URIRef, BNode, Literal, Dataset, XSD
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import requests
 import json
-import traceback
+import re
+import uuid
+import logging
+from gevent.pool import Pool
+
+from cache import Cache
+from crawler import Crawler
+from instrumentation import Instrumentation
+
+from app import app
+
+log = app.logger
+log.setLevel(logging.DEBUG)
 
 
 # This is old style, but leaving for backwards compatibility with earlier versions of Stardog
@@ -17,78 +31,263 @@ UPDATE_HEADERS = {
 }
 
 
-def resolve(uri, depth=2, current_depth=0, visited=set()):
+def make_session(pool_connections=3, retries=config.SPARQL_RETRIES):
+    """Builds the HTTP session shared by all calls to the SPARQL query, update and CRUD endpoints.
+
+    Connections are kept alive and pooled per endpoint host. The pool blocks when all
+    connections are in use, so concurrent requests (greenlets, under the gevent worker)
+    wait for a free connection rather than opening an unbounded number of sockets.
+    Failed connections are retried with exponential backoff, as are 502/503/504 responses
+    for idempotent (GET) requests.
+    """
+    retries = Retry(total=retries,
+                    backoff_factor=config.SPARQL_BACKOFF,
+                    status_forcelist=[502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=config.SPARQL_POOL_SIZE,
+                          max_retries=retries,
+                          pool_block=True)
+
+    s = requests.Session()
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    return s
+
+
+session = make_session()
+
+TIMEOUT = (config.SPARQL_CONNECT_TIMEOUT, config.SPARQL_READ_TIMEOUT)
+
+# The results of cached SELECT queries, keyed by endpoint and normalized query text,
+# and tagged with the named graphs the query depends on.
+result_cache = Cache(ttl=config.SPARQL_CACHE_TTL, max_size=config.SPARQL_CACHE_SIZE)
+
+IRI_GRAPH_PATTERN = re.compile(r'\b(?:GRAPH|FROM(?:\s+NAMED)?|INTO|WITH)\s+<([^>]*)>', re.IGNORECASE)
+VARIABLE_GRAPH_PATTERN = re.compile(r'\bGRAPH\s+[?$]', re.IGNORECASE)
+FROM_PATTERN = re.compile(r'\bFROM\s', re.IGNORECASE)
+
+BINDINGS_PATTERN = re.compile(r'"bindings"\s*:\s*\[')
+
+# Characters that may not occur in an IRIREF
+INVALID_IRI_PATTERN = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+
+
+def normalize_query(query):
+    """Strips indentation and blank lines from the query, so differently formatted copies of
+    the same query share a cache entry"""
+    lines = [line.strip() for line in query.splitlines()]
+    return "\n".join(line for line in lines if line)
+
+
+# Duration, size and result counts of all calls to the endpoints, and a log of the slow ones
+stats = Instrumentation(slow_threshold=config.SPARQL_SLOW_QUERY, slow_log_size=config.SPARQL_SLOW_LOG_SIZE,
+                        normalize=normalize_query)
+
+
+def query_graphs(query):
+    """Returns the set of named graphs a query reads from, or None if it may read from any graph.
+
+    Unless the query restricts its default graph with a FROM clause, the endpoint evaluates
+    it against the union of all graphs (Virtuoso) or the default graph, so it depends on everything.
+    """
+    if not FROM_PATTERN.search(query) or VARIABLE_GRAPH_PATTERN.search(query):
+        return None
+
+    return set(IRI_GRAPH_PATTERN.findall(query))
+
+
+def update_graphs(query):
+    """Returns the set of named graphs an update writes to, or None if it may write to any graph"""
+    if VARIABLE_GRAPH_PATTERN.search(query):
+        return None
+
+    graphs = set(IRI_GRAPH_PATTERN.findall(query))
+    if not graphs:
+        # Writes to the default graph, or to all graphs (e.g. CLEAR ALL)
+        return None
+
+    return graphs
+
+
+# The crawler has its own session, as it talks to many different hosts
+crawler = Crawler(make_session(pool_connections=config.CRAWLER_CONCURRENCY, retries=1),
+                  known=lambda uris: known_graphs(uris),
+                  store=lambda graph, graph_uri: store_graph(graph, graph_uri),
+                  concurrency=config.CRAWLER_CONCURRENCY,
+                  per_host=config.CRAWLER_PER_HOST,
+                  delay=config.CRAWLER_DELAY,
+                  budget=config.CRAWLER_BUDGET,
+                  failure_ttl=config.CRAWLER_FAILURE_TTL,
+                  timeout=config.SPARQL_CONNECT_TIMEOUT)
+
+
+def resolve(uri, depth=2):
     """ Resolves the URI to the maximum depth specified by 'depth' """
-    # print current_depth, uri
-    if current_depth == depth:
-        # print "reached max depth"
-        return True, visited
-
-    # If the URI is already present in our triple store, we won't follow...
-    if uri in visited:
-        # print uri, "already visited"
-        return True, visited
-
-    print uri, "not visited yet"
-
-    if ask_graph(URIRef(uri).defrag()):
-        print uri, "already known"
-        visited.add(uri)
-        return True, visited
-    else:
-        print uri, "not yet known"
-        g = Graph()
-        try:
-            print "Trying to parse", uri
-            g.parse(uri)
-        except:
-            try:
-                print "Trying to parse", uri, "as turtle"
-                g.parse(uri, format='turtle')
-            except:
-                traceback.print_exc()
-                visited.add(uri)
-                return False, visited
-
-        # Add the gleaned triples to the store
-        post_data(g.serialize(format='nt'), graph_uri=URIRef(uri).defrag())
-        # update_query = make_update(g, graph_uri=URIRef(uri).defrag())
-        # sparql_update(update_query)
-        print uri, "added to triple store"
-        visited.add(uri)
-        # We'll visit every triple in the file we downloaded
-        # Alternatively only use those where the 'uri' is a subject (but that makes caching harder)
-        for s, p, o in g.triples((None, None, None)):
-            # Resolve every object 'o' (as long as it is a URI)
-            if isinstance(o, URIRef):
-                success, visited = resolve(o, depth=depth, current_depth=current_depth + 1, visited=visited)
-
-    return True, visited
-
-
-def make_update(graph, graph_uri=None):
+    resolved, visited = crawler.crawl([uri], depth=depth)
+
+    return uri in resolved, visited
+
+
+def known_graphs(uris, endpoint_url=config.ENDPOINT_URL):
+    """Returns the set of URIs that are the name of a (non-empty) graph in the store"""
+    return exists(uris, "GRAPH ?uri { ?s ?p ?o }", endpoint_url=endpoint_url)
+
+
+def known_resources(uris, pattern="?uri ?p ?o", endpoint_url=config.ENDPOINT_URL):
+    """Returns the set of URIs that match the graph pattern (by default: that are the subject of a triple)"""
+    return exists(uris, pattern, endpoint_url=endpoint_url)
+
+
+def exists(uris, pattern, endpoint_url=config.ENDPOINT_URL, batch_size=config.SPARQL_VALUES_SIZE):
+    """Checks which of the URIs match the graph pattern, in which the URI is bound to ?uri
+
+    Instead of one ASK query per URI, the URIs are checked in batches of `batch_size`, each
+    with a single SELECT query that binds ?uri using a VALUES block.
+    """
+    uris = list(set(unicode(uri) for uri in uris if not INVALID_IRI_PATTERN.search(uri)))
+    found = set()
+
+    for i in range(0, len(uris), batch_size):
+        values = " ".join("<{}>".format(uri) for uri in uris[i:i + batch_size])
+        query = "SELECT ?uri WHERE {{ VALUES ?uri {{ {} }} FILTER EXISTS {{ {} }} }}".format(values, pattern)
+
+        results = sparql(query, endpoint_url=endpoint_url)
+        if isinstance(results, basestring):
+            raise Exception("Could not check the existence of {} URIs: {}".format(len(uris), results[:200]))
+
+        found.update(r['uri']['value'] for r in results)
+
+    return found
+
+
+def store_graph(graph, graph_uri):
+    """Adds the triples of the graph to the named graph in the store"""
+    post_data(graph.serialize(format='nt'), graph_uri=graph_uri, content_type='application/n-triples')
+
+
+def make_update(graph, graph_uri=None,
+                max_triples=config.UPDATE_BATCH_TRIPLES, max_bytes=config.UPDATE_BATCH_BYTES):
+    """Generates INSERT DATA updates for the triples in the graph (or all graphs in the Dataset).
+
+    Triples are serialized one at a time, and every update holds at most `max_triples`
+    triples and (about) `max_bytes` bytes, so large graphs are sent in several updates
+    rather than as one query string that may exceed the limits of the endpoint.
+    """
     if isinstance(graph, Dataset):
-        nts = []
-        for c in graph.contexts():
-            if c.identifier != URIRef('urn:x-rdflib:default'):
-                nt = "GRAPH <{id}> {{\n".format(id=c.identifier)
-                nt += c.serialize(format='nt')
-                nt += "}\n\n"
-            else:
-                nt = c.serialize(format='nt')
-                nt += "\n\n"
-
-            nts.append(nt)
-        query = "INSERT DATA {{ {} }}".format("\n".join(nts))
+        contexts = [(None if c.identifier == URIRef('urn:x-rdflib:default') else c.identifier, c)
+                    for c in graph.contexts()]
     elif isinstance(graph, Graph):
-        if graph_uri is None:
-            template = "INSERT DATA {{ {} }}"
-            query = template.format(graph.serialize(format='nt'))
-        else:
-            template = "INSERT DATA {{ GRAPH <{}> {{ {} }} }}"
-            query = template.format(graph_uri, graph.serialize(format='nt'))
+        contexts = [(graph_uri, graph)]
+
+    quads = ((s, p, o, identifier) for identifier, context in contexts
+             for s, p, o in context.triples((None, None, None)))
+
+    return make_quad_update(quads, max_triples=max_triples, max_bytes=max_bytes)
+
+
+def make_quad_update(quads, operation='INSERT DATA',
+                     max_triples=config.UPDATE_BATCH_TRIPLES, max_bytes=config.UPDATE_BATCH_BYTES):
+    """Generates INSERT DATA (or DELETE DATA) updates for the (subject, predicate, object, graph)
+    statements, in batches as make_update does. The graph of statements in the default graph is None.
+
+    A blank node is only the same node within a single update, so the blank nodes of inserted statements
+    are replaced by IRIs under BULK_SKOLEM_BASE (unique to the call, as in bulk loads), and the batches
+    can be split anywhere."""
+    skolem_base = '{}{}/'.format(config.BULK_SKOLEM_BASE, uuid.uuid4().hex)
+    blocks = []
+    lines = None
+    current = None
+    count = 0
+    size = 0
+
+    for s, p, o, identifier in quads:
+        if lines is None or identifier != current:
+            lines = []
+            blocks.append((identifier, lines))
+            current = identifier
+
+        if operation == 'INSERT DATA':
+            s, o = skolemize(s, skolem_base), skolemize(o, skolem_base)
+
+        line = u"{} {} {} .\n".format(s.n3(), p.n3(), o.n3()).encode('utf-8')
+        lines.append(line)
+        count += 1
+        size += len(line)
+
+        if count >= max_triples or size >= max_bytes:
+            yield data_update(operation, blocks)
+
+            lines = []
+            blocks = [(identifier, lines)]
+            count = 0
+            size = 0
+
+    if count > 0:
+        yield data_update(operation, blocks)
 
-    return query
+
+def skolemize(term, skolem_base):
+    """Replaces a blank node by an IRI under `skolem_base` (the same blank node gives the same IRI)"""
+    return URIRef(u'{}{}'.format(skolem_base, term)) if isinstance(term, BNode) else term
+
+
+def insert_data(blocks):
+    """Builds an INSERT DATA update from a list of (graph URI, N-Triples lines) blocks"""
+    return data_update('INSERT DATA', blocks)
+
+
+def data_update(operation, blocks):
+    """Builds an INSERT DATA or DELETE DATA update from a list of (graph URI, N-Triples lines) blocks"""
+    parts = []
+    for identifier, lines in blocks:
+        if not lines:
+            continue
+        elif identifier is None:
+            parts.append("".join(lines))
+        else:
+            parts.append("GRAPH <{}> {{\n{}}}\n".format(identifier.encode('utf-8'), "".join(lines)))
+
+    return "{} {{\n{}}}".format(operation, "".join(parts))
+
+
+def execute_updates(updates, endpoint_url=config.UPDATE_URL, parallel=1, group_size=1):
+    """Sends a sequence of updates (e.g. from make_update) to the endpoint.
+
+    Every `group_size` updates are joined into a single request, which endpoints such as Stardog
+    (and Virtuoso, unless log-enable is set) execute as one transaction. With `parallel` > 1,
+    that many requests are sent concurrently; only use this when the order of the updates does
+    not matter.
+
+    :returns: the number of requests sent
+    """
+    def send(query):
+        with stats.call('update', endpoint_url, query, bytes_out=len(query)) as call:
+            result = session.post(endpoint_url, data=query, headers=UPDATE_HEADERS, timeout=TIMEOUT)
+            call.status = result.status_code
+            call.bytes_in = len(result.content)
+            result.raise_for_status()
+
+        result_cache.invalidate(update_graphs(query))
+
+    def groups():
+        group = []
+        for update in updates:
+            group.append(update)
+            if len(group) >= group_size:
+                yield " ;\n".join(group)
+                group = []
+        if group:
+            yield " ;\n".join(group)
+
+    if parallel > 1:
+        pool = Pool(parallel)
+        return len(list(pool.imap_unordered(send, groups())))
+    else:
+        count = 0
+        for query in groups():
+            send(query)
+            count += 1
+        return count
 
 
 def ask_graph(uri, endpoint_url=config.ENDPOINT_URL):
@@ -98,9 +297,14 @@ def ask_graph(uri, endpoint_url=config.ENDPOINT_URL):
 def ask(uri, template="ASK {{ <{}> ?p ?o }}", endpoint_url=config.ENDPOINT_URL):
     query = template.format(uri)
 
-    result = requests.get(endpoint_url,
-                          params={'query': query, 'reasoning': config.REASONING_TYPE},
-                          headers={'Accept': 'application/json'})
+    with stats.call('query', endpoint_url, query, bytes_out=len(query)) as call:
+        result = session.get(endpoint_url,
+                             params={'query': query, 'reasoning': config.REASONING_TYPE},
+                             headers={'Accept': 'application/json'},
+                             timeout=TIMEOUT)
+        call.status = result.status_code
+        call.bytes_in = len(result.content)
+        call.rows = 1
 
     json_result = json.loads(result.content)
 
@@ -112,16 +316,22 @@ def ask(uri, template="ASK {{ <{}> ?p ?o }}", endpoint_url=config.ENDPOINT_URL):
         return json_result
 
 
-def post_data(data, graph_uri=None, endpoint_url=config.CRUD_URL):
+def post_data(data, graph_uri=None, endpoint_url=config.CRUD_URL, content_type='application/turtle'):
     if not(graph_uri is None):
         params = {'graph-uri': graph_uri}
     else:
         params = {}
-    result = requests.post(endpoint_url, data=data, params=params,
-                           headers={'Content-Type': 'application/turtle'}, auth=config.CRUD_AUTH)
+    with stats.call('crud', endpoint_url, bytes_out=len(data)) as call:
+        result = session.post(endpoint_url, data=data, params=params,
+                              headers={'Content-Type': content_type}, auth=config.CRUD_AUTH,
+                              timeout=TIMEOUT)
+        call.status = result.status_code
+        call.bytes_in = len(result.content)
+
+    log.debug("SPARQL CRUD status: {}".format(result.status_code))
+    log.debug("SPARQL CRUD response:\n {}".format(result.content[:200]))
 
-    print "SPARQL CRUD status: ", result.status_code
-    print "SPARQL CRUD response:\n ", result.content
+    result_cache.invalidate(None if graph_uri is None else [unicode(graph_uri)])
 
     return result.content
 
@@ -129,37 +339,148 @@ def post_data(data, graph_uri=None, endpoint_url=config.CRUD_URL):
 def sparql_update(query, endpoint_url=config.UPDATE_URL):
     # result = requests.post(endpoint_url,params={'reasoning': config.REASONING_TYPE},
     # data=query, headers=UPDATE_HEADERS)
-    result = requests.post(endpoint_url, data=query, headers=UPDATE_HEADERS)
+    with stats.call('update', endpoint_url, query, bytes_out=len(query)) as call:
+        result = session.post(endpoint_url, data=query, headers=UPDATE_HEADERS, timeout=TIMEOUT)
+        call.status = result.status_code
+        call.bytes_in = len(result.content)
+
+    log.debug("SPARQL UPDATE status: {}".format(result.status_code))
+    log.debug("SPARQL UPDATE response:\n {}".format(result.content[:200]))
 
-    print "SPARQL UPDATE status: ", result.status_code
-    print "SPARQL UPDATE response:\n ", result.content[:200]
+    result_cache.invalidate(update_graphs(query))
 
     return result.content
 
 
-def sparql(query, endpoint_url=config.ENDPOINT_URL):
+def sparql(query, endpoint_url=config.ENDPOINT_URL, cache=False):
     """This method replaces the SPARQLWrapper SPARQL interface, since SPARQLWrapper
-       cannot handle the Stardog-style query headers needed for inferencing"""
+       cannot handle the Stardog-style query headers needed for inferencing
 
-    try:
-        result = requests.get(endpoint_url,
-                              params={'query': query, 'reasoning': config.REASONING_TYPE},
-                              headers=QUERY_HEADERS)
-        result_dict = json.loads(result.content)
-    except Exception as e:
-        print e
-        return result.content
+       If `cache` is True, the bindings are served from (and stored in) the result cache,
+       until they expire or a post_data or sparql_update call writes to a graph the query reads."""
 
-    return result_dict['results']['bindings']
+    if cache:
+        key = (endpoint_url, normalize_query(query))
+        bindings = result_cache.get(key)
+        if bindings is not None:
+            return bindings
 
+        # Writes that finish while the query runs may not be in its results
+        generation = result_cache.generation
 
-def dictize(sparql_results):
-    # If the results are a dict, just return the list of bindings
+    with stats.call('query', endpoint_url, query, bytes_out=len(query)) as call:
+        result = session.get(endpoint_url,
+                             params={'query': query, 'reasoning': config.REASONING_TYPE},
+                             headers=QUERY_HEADERS,
+                             timeout=TIMEOUT)
+        call.status = result.status_code
+        call.bytes_in = len(result.content)
+
+        try:
+            result_dict = json.loads(result.content)
+        except Exception as e:
+            log.warning("Could not parse SPARQL results: {}".format(e))
+            call.error = str(e)
+            return result.content
+
+        bindings = result_dict['results']['bindings']
+        call.rows = len(bindings)
+
+    if cache:
+        result_cache.put(key, bindings, size=len(result.content), tags=query_graphs(query), generation=generation)
+
+    return bindings
+
+
+def iter_sparql(query, endpoint_url=config.ENDPOINT_URL, page_size=config.SPARQL_PAGE_SIZE):
+    """Iterates over the bindings of a SELECT query, without holding the full result in memory.
+
+    The query is sent in pages of `page_size` results (by appending LIMIT and OFFSET clauses),
+    and the bindings of every page are parsed as they stream in. The query itself should
+    not have a LIMIT or OFFSET, and should have an ORDER BY clause for the pages to be stable.
+    """
+    offset = 0
+
+    while True:
+        paged_query = "{}\nLIMIT {}\nOFFSET {}".format(query, page_size, offset)
+
+        # The time measured includes the time the caller spends on every binding
+        with stats.call('query', endpoint_url, paged_query, bytes_out=len(paged_query)) as call:
+            result = session.get(endpoint_url,
+                                 params={'query': paged_query, 'reasoning': config.REASONING_TYPE},
+                                 headers=QUERY_HEADERS,
+                                 timeout=TIMEOUT,
+                                 stream=True)
+            call.status = result.status_code
+            count = 0
+            try:
+                result.raise_for_status()
+
+                for binding in iter_bindings(result):
+                    count += 1
+                    yield binding
+            finally:
+                call.rows = count
+                call.bytes_in = result.raw.tell()
+                result.close()
+
+        if count < page_size:
+            return
+
+        offset += page_size
+
+
+def iter_bindings(response, chunk_size=64 * 1024):
+    """Incrementally parses the bindings from a (streamed) SPARQL JSON results response"""
+    decoder = json.JSONDecoder()
+    chunks = response.iter_content(chunk_size)
+
+    buf = ''
+    pos = None
+
+    # Read ahead until the start of the bindings array
+    while pos is None:
+        match = BINDINGS_PATTERN.search(buf)
+        if match:
+            pos = match.end()
+            break
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise Exception("No SPARQL bindings found in response: {}".format(buf[:200]))
+        buf += chunk
+
+    while True:
+        # Skip the separators between bindings
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+
+        if pos < len(buf) and buf[pos] == ']':
+            return
+
+        try:
+            if pos == len(buf):
+                raise ValueError("Need more data")
+            binding, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            # The binding is incomplete, read the next chunk
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise Exception("Truncated SPARQL results response")
+
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+
+        yield binding
+
+
+def iter_dictize(sparql_results):
+    """Lazy version of `dictize`, for use with `iter_sparql`"""
+    # If the results are a dict, just iterate over the list of bindings
     if isinstance(sparql_results, dict):
         sparql_results = sparql_results['results']['bindings']
 
-    results = []
-
     for r in sparql_results:
         result = {}
         for k, v in r.items():
@@ -168,6 +489,23 @@ def dictize(sparql_results):
             except:
                 print k, v
 
-        results.append(result)
+        yield result
+
+
+def dictize(sparql_results):
+    return list(iter_dictize(sparql_results))
+
+
+def term(value):
+    """The rdflib term for a value in a SPARQL JSON results binding. Literals typed xsd:string are
+    the same as plain literals (RDF 1.1), so they are returned as plain literals."""
+    if value['type'] == 'uri':
+        return URIRef(value['value'])
+    elif value['type'] == 'bnode':
+        return BNode(value['value'])
+
+    datatype = value.get('datatype')
+    if datatype == unicode(XSD.string):
+        datatype = None
 
-    return results
+    return Literal(value['value'], lang=value.get('xml:lang'), datatype=datatype)
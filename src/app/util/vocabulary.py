@@ -0,0 +1,224 @@
+import os
+import time
+import sqlite3
+import logging
+from threading import RLock
+from collections import defaultdict
+
+from rdflib import Graph, Namespace, RDF, RDFS
+from SPARQLWrapper import SPARQLWrapper, JSON
+
+from app import app
+
+log = app.logger
+log.setLevel(logging.DEBUG)
+
+
+SKOS = Namespace('http://www.w3.org/2004/02/skos/core#')
+DCT = Namespace('http://purl.org/dc/terms/')
+
+# The properties that give the label of a scheme, in order of preference
+SCHEME_LABELS = (DCT['title'], RDFS['label'], SKOS['prefLabel'])
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS schemes (
+        uri TEXT PRIMARY KEY,
+        label TEXT,
+        source TEXT NOT NULL,
+        imported REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS concepts (
+        scheme TEXT NOT NULL,
+        uri TEXT NOT NULL,
+        label TEXT NOT NULL,
+        notation TEXT
+    );
+    CREATE INDEX IF NOT EXISTS schemes_source ON schemes (source);
+    CREATE INDEX IF NOT EXISTS concepts_scheme ON concepts (scheme, uri, label, notation);
+    CREATE INDEX IF NOT EXISTS concepts_label ON concepts (label COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS concepts_notation ON concepts (notation);
+"""
+
+LOD_SCHEMES_QUERY = """
+    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+    PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+
+    SELECT DISTINCT ?scheme ?label WHERE {
+      ?c skos:inScheme ?scheme .
+      ?scheme rdfs:label ?label .
+    }
+"""
+
+
+class VocabularyStore(object):
+    """A local SQLite copy of external SKOS schemes and collections, and their concepts.
+
+    Vocabularies are compiled into the store by an explicit import (see `import_file` and
+    `import_lod_schemes`, or manage.py), which replaces everything previously imported from the
+    same source. The concepts are indexed by scheme, label and notation, so lookups never have to
+    leave the machine. Reading from a store that was never imported returns nothing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._lock = RLock()
+
+    def connect(self, create=False):
+        with self._lock:
+            if self._connection is None:
+                if not create and not os.path.exists(self.path):
+                    return None
+
+                self._connection = sqlite3.connect(self.path, check_same_thread=False)
+                self._connection.executescript(SCHEMA)
+
+            return self._connection
+
+    def select(self, query, parameters=()):
+        with self._lock:
+            connection = self.connect()
+            if connection is None:
+                return []
+
+            return connection.execute(query, parameters).fetchall()
+
+    def schemes(self):
+        """All schemes in the store, as dictionaries with a uri and a label"""
+        return [{'uri': uri, 'label': label}
+                for uri, label in self.select("SELECT uri, label FROM schemes ORDER BY label, uri")]
+
+    def has_concepts(self, uri):
+        return len(self.select("SELECT 1 FROM concepts WHERE scheme = ? LIMIT 1", (uri,))) > 0
+
+    def concepts(self, uri):
+        """The concepts in the scheme or collection, as dictionaries with a uri, label and (if any) notation"""
+        concepts = []
+        for concept_uri, label, notation in self.select(
+                "SELECT uri, label, notation FROM concepts WHERE scheme = ? ORDER BY uri, label, notation", (uri,)):
+            concept = {'uri': concept_uri, 'label': label}
+            if notation is not None:
+                concept['notation'] = notation
+            concepts.append(concept)
+
+        return concepts
+
+    def find_concepts(self, label=None, notation=None, scheme=None, limit=20):
+        """The concepts (with their scheme) of which the label starts with `label`, or that have the notation"""
+        conditions, parameters = [], []
+        if label is not None:
+            # A range rather than LIKE, so that the label index is used
+            conditions.append("label >= ? COLLATE NOCASE AND label < ? COLLATE NOCASE")
+            parameters.extend([label, label + u'\uffff'])
+        if notation is not None:
+            conditions.append("notation = ?")
+            parameters.append(notation)
+        if scheme is not None:
+            conditions.append("scheme = ?")
+            parameters.append(scheme)
+
+        query = "SELECT scheme, uri, label, notation FROM concepts"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        return [dict((k, v) for k, v in zip(('scheme', 'uri', 'label', 'notation'), row) if v is not None)
+                for row in self.select(query + " ORDER BY label COLLATE NOCASE, uri LIMIT ?", parameters + [int(limit)])]
+
+    def replace(self, source, schemes, concepts):
+        """Replaces everything imported from `source` with the schemes (uri, label) and concepts
+        (scheme, uri, label, notation), in a single transaction.
+
+        A scheme belongs to a single source: schemes with concepts take over those that other sources
+        only list by name (e.g. import_lod_schemes), but a list of names never replaces another source's
+        scheme, so it can never remove compiled concepts."""
+        compiled = set(scheme for scheme, _, _, _ in concepts)
+
+        with self._lock:
+            connection = self.connect(create=True)
+            with connection:
+                old = [uri for uri, in connection.execute("SELECT uri FROM schemes WHERE source = ?", (source,))]
+                connection.executemany("DELETE FROM concepts WHERE scheme = ?", ((uri,) for uri in old))
+                connection.execute("DELETE FROM schemes WHERE source = ?", (source,))
+
+                imported = time.time()
+                connection.executemany("DELETE FROM concepts WHERE scheme = ?", ((uri,) for uri in compiled))
+                connection.executemany("INSERT OR REPLACE INTO schemes VALUES (?, ?, ?, ?)",
+                                       ((uri, label, source, imported) for uri, label in schemes if uri in compiled))
+                connection.executemany("INSERT OR IGNORE INTO schemes VALUES (?, ?, ?, ?)",
+                                       ((uri, label, source, imported) for uri, label in schemes
+                                        if uri not in compiled))
+                connection.executemany("INSERT INTO concepts VALUES (?, ?, ?, ?)", concepts)
+
+        log.info("Imported {} schemes and {} concepts from {}".format(len(schemes), len(concepts), source))
+
+    def import_file(self, path, format='turtle'):
+        """Imports the SKOS schemes and collections in the RDF file, with their concepts"""
+        log.info("Importing vocabulary from {}...".format(path))
+        g = Graph()
+        g.parse(path, format=format)
+
+        schemes, concepts = compile_vocabulary(g)
+        self.replace(os.path.abspath(path), schemes, concepts)
+        return len(schemes), len(concepts)
+
+    def import_lod_schemes(self, endpoint_url='http://lod.openlinksw.com/sparql', timeout=600):
+        """Imports the list of schemes (without concepts) known to the LOD cloud cache"""
+        log.info("Importing schemes from {}...".format(endpoint_url))
+        sparql = SPARQLWrapper(endpoint_url)
+        sparql.setTimeout(timeout)
+        sparql.setReturnFormat(JSON)
+        sparql.setQuery(LOD_SCHEMES_QUERY)
+
+        schemes = {}
+        for r in sparql.query().convert()['results']['bindings']:
+            schemes.setdefault(r['scheme']['value'], r['label']['value'])
+
+        self.replace(endpoint_url, sorted(schemes.items()), [])
+        return len(schemes), 0
+
+
+def compile_vocabulary(g):
+    """Returns the schemes (uri, label) and concepts (scheme, uri, label, notation) in the graph.
+
+    The concepts of a scheme are those in it (skos:inScheme), those of a collection its
+    members, and the members of its member collections (skos:member+)."""
+    schemes = []
+    concepts = []
+
+    def label(uri):
+        for p in SCHEME_LABELS:
+            value = g.value(uri, p)
+            if value is not None:
+                return unicode(value)
+        return None
+
+    def rows(scheme, members):
+        for member in sorted(members):
+            notations = [unicode(n) for n in g.objects(member, SKOS['notation'])] or [None]
+            for pref_label in sorted(set(unicode(l) for l in g.objects(member, SKOS['prefLabel']))):
+                for notation in notations:
+                    concepts.append((unicode(scheme), unicode(member), pref_label, notation))
+
+    in_scheme = defaultdict(set)
+    for concept, scheme in g.subject_objects(SKOS['inScheme']):
+        in_scheme[scheme].add(concept)
+
+    scheme_uris = set(g.subjects(RDF.type, SKOS['ConceptScheme'])) | set(in_scheme)
+    for scheme in sorted(scheme_uris):
+        schemes.append((unicode(scheme), label(scheme)))
+        rows(scheme, in_scheme[scheme])
+
+    for collection in sorted(set(g.subjects(SKOS['member'], None))):
+        members = set()
+        pending = [collection]
+        while pending:
+            for member in g.objects(pending.pop(), SKOS['member']):
+                if member not in members:
+                    members.add(member)
+                    pending.append(member)
+
+        if collection not in scheme_uris:
+            schemes.append((unicode(collection), label(collection)))
+        rows(collection, members - in_scheme.get(collection, set()))
+
+    return schemes, concepts
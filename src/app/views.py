@@ -1,16 +1,16 @@
 # -*- coding: utf-8 -*-
-from flask import render_template, request, jsonify
+from flask import render_template, request, jsonify, Response
 from flask_swagger import swagger
-from werkzeug.exceptions import HTTPException
-from rdflib import ConjunctiveGraph
+from werkzeug.exceptions import HTTPException, NotFound
 import traceback
+from itertools import chain
 import logging
 import json
 import os
 import requests
+import gevent
 import gevent.subprocess as sp
 
-import iribaker
 
 import config
 
@@ -18,9 +18,12 @@ import config
 import converter
 
 import util.sparql_client as sc
+import util.bulk_loader as bl
 import util.gitlab_client as gc
 import util.dataverse_client as dc
 import util.csdh_client as cc
+import util.catalog as catalog
+import util.iri as ib
 
 from app import app, socketio
 
@@ -131,6 +134,17 @@ def message(json):
     log.debug('SocketIO message:\n' + str(json))
 
 
+@app.before_first_request
+def prefetch():
+    """
+    Builds the catalog if it does not exist yet, and loads the concepts of the schemes in CONCEPT_PREFETCH,
+    in the background
+    """
+    gevent.spawn(catalog.ensure)
+
+    cc.prefetch_concepts()
+
+
 @app.errorhandler(Exception)
 def error_response(ex):
     """
@@ -321,6 +335,72 @@ def get_community_dimensions():
     return jsonify(dimensions_response)
 
 
+@app.route('/community/dimensions/search')
+def search_community_dimensions():
+    """
+    Search the community-defined dimensions
+    Finds the LSD and datalegend dimensions whose label or URI contains the query string. Dimensions whose label
+    starts with the query come first, then datalegend dimensions before LSD dimensions, which are ranked by their
+    number of uses in the LOD cloud.
+    ---
+    tags:
+        - Community
+    parameters:
+        - name: q
+          in: query
+          description: The (partial) label or URI to search for
+          required: true
+          type: string
+        - name: offset
+          in: query
+          description: The number of matches to skip
+          required: false
+          type: integer
+          default: 0
+        - name: limit
+          in: query
+          description: The maximum number of matches to return
+          required: false
+          type: integer
+          default: 20
+    responses:
+        '200':
+            description: Matching community dimensions retrieved
+            schema:
+                type: object
+                properties:
+                    dimensions:
+                        description: An array of matching dimensions, as in /community/dimensions
+                        type: array
+                        items:
+                            type: object
+                    total:
+                        description: The total number of matching dimensions
+                        type: integer
+                        format: int32
+                    offset:
+                        type: integer
+                        format: int32
+                    limit:
+                        type: integer
+                        format: int32
+                required:
+                    - dimensions
+                    - total
+    default:
+        description: Unexpected error
+        schema:
+          $ref: "#/definitions/Message"
+    """
+    query = request.args.get('q', '')
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(max(0, request.args.get('limit', 20, type=int)), 1000)
+
+    total, dimensions = cc.search_dimensions(query, offset=offset, limit=limit)
+
+    return jsonify({'dimensions': dimensions, 'total': total, 'offset': offset, 'limit': limit})
+
+
 @app.route('/community/schemes')
 def get_community_schemes():
     """
@@ -359,7 +439,7 @@ def get_community_schemes():
             schema:
               $ref: "#/definitions/Message"
     """
-    schemes_response = {'schemes': cc.get_schemes() + cc.get_csdh_schemes()}
+    schemes_response = {'schemes': cc.get_all_schemes()}
     return jsonify(schemes_response)
 
 
@@ -431,6 +511,66 @@ def get_community_definition():
         raise(Exception("No `uri` parameter given"))
 
 
+@app.route('/community/definitions', methods=['POST'])
+def get_community_definitions():
+    """
+    Get the definitions of many variables at once
+    Does the same as /community/definition for every variable URI in the list, but with a few combined queries
+    ---
+    tags:
+        - Community
+    parameters:
+        - name: uris
+          in: body
+          description: The URIs of the variables
+          required: true
+          schema:
+              type: object
+              properties:
+                  uris:
+                      type: array
+                      items:
+                          type: string
+              required:
+                  - uris
+    responses:
+        '200':
+            description: Variable definitions retrieved
+            schema:
+                type: object
+                properties:
+                    definitions:
+                        description:
+                            An object that maps the URI of every variable that was found to its definition
+                            (as returned by /community/definition)
+                        type: object
+                    missing:
+                        description: The URIs of the variables that could not be found online, nor in the datalegend
+                        type: array
+                        items:
+                            type: string
+                required:
+                    - definitions
+                    - missing
+        default:
+            description: Unexpected error
+            schema:
+              $ref: "#/definitions/Message"
+    """
+    req_json = request.get_json(force=True)
+    uris = req_json.get('uris') if isinstance(req_json, dict) else None
+
+    if not isinstance(uris, list) or not all(isinstance(uri, basestring) for uri in uris):
+        raise(Exception("No `uris` list of strings given"))
+    if len(uris) > config.DEFINITIONS_MAX:
+        raise(Exception("At most {} variables can be defined at once".format(config.DEFINITIONS_MAX)))
+
+    definitions = cc.get_definitions(uris)
+    missing = sorted(set(uri for uri in uris if uri not in definitions))
+
+    return jsonify({'definitions': definitions, 'missing': missing})
+
+
 @app.route('/community/concepts', methods=['GET'])
 def codelist():
     """
@@ -473,6 +613,9 @@ def codelist():
                                     required:
                                         - label
                                         - uri
+                    error:
+                        description: Set if not all concepts could be retrieved after the response started (the list of concepts is incomplete then)
+                        type: string
                 required:
                     - concepts
         default:
@@ -486,16 +629,49 @@ def codelist():
     if uri:
         log.debug("Querying for SKOS concepts in Scheme or Collection <{}>".format(uri))
 
-        codelist = cc.get_concepts(uri)
+        concepts = cc.iter_concepts(uri)
 
-        if codelist == []:
+        # Fail before the response starts, rather than streaming an empty list
+        first = next(concepts, None)
+        if first is None:
             raise(Exception("Could not retrieve anything from LOD or datalegend"))
         else:
-            return jsonify({'concepts': codelist})
+            return Response(stream_json('concepts', chain([first], concepts)), mimetype='application/json')
     else:
         raise(Exception("Missing required parameter: `uri`"))
 
 
+def stream_json(key, items, chunk_size=64 * 1024):
+    """Generates the JSON of an object with the list of items under `key`, in chunks of about `chunk_size` bytes.
+
+    The response has started once the first chunk is sent, so if the items fail after that, the list ends
+    where they failed, and the object gets an `error` member with the message (rather than being cut off)."""
+    chunk = ['{{"{}": ['.format(key)]
+    size = 0
+    separator = ''
+    error = None
+    try:
+        for item in items:
+            part = separator + json.dumps(item)
+            chunk.append(part)
+            size += len(part)
+            separator = ', '
+
+            if size >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+    except Exception as e:
+        log.error(e)
+        error = str(e)
+
+    chunk.append(']')
+    if error is not None:
+        chunk.append(', "error": {}'.format(json.dumps(error)))
+    chunk.append('}')
+    yield ''.join(chunk)
+
+
 @app.route('/dataset/save', methods=['POST'])
 def dataset_save():
     """
@@ -533,11 +709,13 @@ def dataset_save():
     return jsonify({'code': 200, 'message': 'Success'})
 
 
-@app.route('/dataset/delete', methods=['GET'])
+@app.route('/dataset/delete', methods=['GET', 'POST'])
 def dataset_delete():
     """
-    Remove a dataset from the datalegend
-    Note that this requires one to specify the Nanopublication URI, not the dataset URI
+    Remove one or more datasets from the datalegend
+    Note that this requires one to specify the Nanopublication URI, not the dataset URI.
+    Takes a single URI as query parameter (GET), or a JSON object with a list of URIs (POST).
+    The datasets are removed in the background: the response identifies the job (see /jobs/{id}).
     **WARNING**: There is no authentication/authorization in place!
     ---
     tags:
@@ -546,26 +724,139 @@ def dataset_delete():
         - name: uri
           in: query
           description: The nanpublication URI of the dataset that is to be removed
-          required: true
+          required: false
           type: string
+        - name: body
+          in: body
+          description: The nanopublication URIs of the datasets that are to be removed
+          required: false
+          schema:
+            type: object
+            properties:
+                uris:
+                    type: array
+                    items:
+                        type: string
     responses:
         '200':
-            description: The dataset was succesfully removed from the SDH
+            description: The removal of the datasets from the SDH was started
             schema:
-                $ref: "#/definitions/Message"
+              type: object
+              properties:
+                  code:
+                      type: integer
+                  message:
+                      type: string
+                  job:
+                      $ref: "#/definitions/Job"
+        default:
+            description: Unexpected error
+            schema:
+              $ref: "#/definitions/Message"
+    """
+    if request.method == 'POST':
+        req_json = request.get_json(force=True)
+        uris = req_json.get('uris') if isinstance(req_json, dict) else None
+
+        if not isinstance(uris, list) or not uris:
+            raise(Exception("No `uris` list given"))
+    else:
+        uri = request.args.get('uri', None)
+
+        if not uri:
+            raise Exception('Must specify a Nanopublication URI!')
+
+        uris = [uri]
+
+    job = cc.delete_datasets(uris)
+
+    return jsonify({'code': 200, 'message': "Deleting {} nanopublication(s)".format(len(uris)), 'job': job.as_dict()})
+
+
+@app.route('/jobs', methods=['GET'])
+def job_list():
+    """
+    List the background jobs
+    Lists the queued, running and recently finished jobs, oldest first
+    ---
+    tags:
+        - Base
+    responses:
+        '200':
+            description: Job list retrieved
+            schema:
+              type: object
+              properties:
+                  jobs:
+                      type: array
+                      items:
+                          $ref: "#/definitions/Job"
         default:
             description: Unexpected error
             schema:
               $ref: "#/definitions/Message"
     """
-    uri = request.args.get('uri', None)
+    return jsonify({'jobs': [job.as_dict() for job in cc.jobs.list()]})
 
-    if not uri:
-        raise Exception('Must specify a Nanopublication URI!')
 
-    message = cc.delete_dataset(uri)
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Get the status of a background job
+    ---
+    tags:
+        - Base
+    parameters:
+        - name: job_id
+          in: path
+          description: The id of the job
+          required: true
+          type: string
+    responses:
+        '200':
+            description: Job status retrieved
+            schema:
+              id: Job
+              type: object
+              properties:
+                id:
+                  type: string
+                description:
+                  type: string
+                status:
+                  description: One of queued, running, done or failed
+                  type: string
+                created:
+                  type: number
+                started:
+                  type: number
+                finished:
+                  type: number
+                done:
+                  description: The number of steps done
+                  type: integer
+                total:
+                  description: The number of steps, once known
+                  type: integer
+                message:
+                  description: The step in progress
+                  type: string
+                error:
+                  description: Why the job failed
+                  type: string
+                result:
+                  type: object
+        '404':
+            description: No such job (it may have been forgotten)
+            schema:
+              $ref: "#/definitions/Message"
+    """
+    job = cc.jobs.get(job_id)
 
-    return jsonify({'code': 200, 'message': message})
+    if job is None:
+        raise NotFound("No job with id {}".format(job_id))
+
+    return jsonify(job.as_dict())
 
 
 @app.route('/dataset/list', methods=['GET'])
@@ -575,6 +866,23 @@ def dataset_list():
     ---
     tags:
         - Dataset
+    parameters:
+        - name: owner
+          in: query
+          description: Only list the datasets of this owner (the IRI of the owner)
+          required: false
+          type: string
+        - name: offset
+          in: query
+          description: The number of datasets to skip (datasets are ordered by name)
+          required: false
+          type: integer
+          default: 0
+        - name: limit
+          in: query
+          description: The maximum number of datasets to list
+          required: false
+          type: integer
     responses:
         '200':
             description: Dataset list retrieved
@@ -613,7 +921,13 @@ def dataset_list():
               $ref: "#/definitions/Message"
     """
 
-    dataset_list = cc.get_datasets()
+    owner = request.args.get('owner', None)
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', None, type=int)
+    if limit is not None:
+        limit = max(0, limit)
+
+    dataset_list = cc.get_datasets(offset=offset, limit=limit, owner=owner)
 
     return jsonify({'datasets': dataset_list})
 
@@ -641,9 +955,14 @@ def dataset_submit():
                 user:
                     description: The Google user profile of the person uploading the dataset
                     type: object
+                diff:
+                    description: If the same version of the dataset file was submitted before, only publish the
+                                 triples removed from and added to its data structure definition
+                    type: boolean
     responses:
         '200':
-            description: The dataset was converted succesfully
+            description: The dataset was converted succesfully (or, with `diff`, the changes to its data structure
+                         definition were published)
             schema:
                 $ref: "#/definitions/Message"
         default:
@@ -662,6 +981,17 @@ def dataset_submit():
     source_filename = gc.get_local_file_path(dataset['file'])
     log.debug("Converter will be reading from {}".format(source_filename))
 
+    # If this version of the source file was submitted before, the observations are the same, and only the
+    # changes to the data structure definition (e.g. to the value mappings) need to be published
+    if req_json.get('diff', config.SUBMIT_DIFF):
+        source_path = dataset.get('path', source_filename)
+        delta = cc.publish_data_structure_delta(user, dataset['name'], dataset['uri'], dataset['variables'],
+                                                source_path, gc.blob_hash(source_path))
+        if delta is not None:
+            return jsonify({'code': 200,
+                            'message': 'Succesfully submitted the changes to the data structure definition',
+                            'delta': delta})
+
     outfile = dataset['file'] + ".nq"
     target_filename = gc.get_local_file_path(outfile)
     log.debug("Converter will be writing to {}".format(target_filename))
@@ -686,18 +1016,23 @@ def dataset_submit():
     file_info = gc.add_file(outfile, data)
     log.debug("Added to gitlab: {} ({})".format(file_info['url'], file_info['commit_id']))
 
-    log.debug("Parsing dataset... ")
-    g = ConjunctiveGraph()
-    # TODO: This is really inefficient... why are we posting each graph separately?
-    g.parse(data=data, format="nquads")
-    log.debug("DataSet parsed")
+    log.debug("Loading dataset into the datalegend... ")
+    reports = bl.bulk_load_file(target_filename, format='nq')
+    failed = [r for r in reports if 'error' in r]
+    if failed:
+        raise(Exception("Could not load {} of {} chunks into the datalegend".format(len(failed), len(reports))))
+    log.debug("... done")
 
-    for graph in g.contexts():
-        log.debug(g)
-        graph_uri = graph.identifier
-        log.debug("Posting {} ...".format(graph_uri))
-        sc.post_data(graph.serialize(format='turtle'), graph_uri=graph_uri)
-        log.debug("... done")
+    log.debug("Adding dataset to the catalog... ")
+    with open(target_filename, 'r') as nquads_file:
+        catalog.add_nanopublications(catalog.nanopublication_uris(nquads_file))
+
+    # The dataset may (re)define variables and code lists, or add concepts to existing ones
+    cc.definition_cache.clear()
+    cc.scheme_catalog.refresh()
+    with open(target_filename, 'r') as nquads_file:
+        codelists = cc.codelist_uris(nquads_file)
+    cc.invalidate_concepts(catalog.update_membership(codelists))
 
     return jsonify({'code': 200,
                     'message': 'Succesfully submitted converted data to datalegend',
@@ -991,11 +1326,14 @@ def web_definition():
     return jsonify(dataset_definition)
 
 
-@app.route('/iri', methods=['GET'])
+@app.route('/iri', methods=['GET', 'POST'])
 def iri():
     """
-    Bake an IRI using iribaker
+    Bake IRIs using iribaker
     Checks an IRI for compliance with RFC and converts invalid characters to underscores, if possible.
+    POST a JSON list of strings (or an object with an `iris` list) to bake many IRIs at once; the
+    results are then returned in order as the `iris` list, and the `iri` of a string that cannot be
+    converted is null.
     **NB**: No roundtripping, this procedure may result in identity smushing: two input-IRI's may be
     mapped to the same output-IRI.
     ---
@@ -1006,12 +1344,20 @@ def iri():
       parameters:
         - name: iri
           in: query
-          description: The IRI to be checked for compliance
-          required: true
+          description: The IRI to be checked for compliance (GET)
+          required: false
           type: string
+        - name: iris
+          in: body
+          description: The IRIs to be checked for compliance (POST)
+          required: false
+          schema:
+            type: array
+            items:
+                type: string
       responses:
         '200':
-          description: IRI converted
+          description: IRI converted (for POST, every result is in the `iris` list)
           schema:
             description: A converted IRI result
             type: object
@@ -1038,15 +1384,77 @@ def iri():
                 type: string
     """
 
+    if request.method == 'POST':
+        req_json = request.get_json(force=True)
+        sources = req_json.get('iris') if isinstance(req_json, dict) else req_json
+
+        if not isinstance(sources, list) or not all(isinstance(s, basestring) for s in sources):
+            raise(Exception("No list of IRIs given"))
+        if len(sources) > config.IRI_BATCH_MAX:
+            raise(Exception("At most {} IRIs can be converted at once".format(config.IRI_BATCH_MAX)))
+
+        iris = ib.to_iris(sources, strict=False)
+        return jsonify({'iris': [{'iri': i, 'source': s} for i, s in zip(iris, sources)]})
+
     unsafe_iri = request.args.get('iri', None)
 
     if unsafe_iri is not None:
-        response = {'iri': iribaker.to_iri(unsafe_iri), 'source': unsafe_iri}
+        response = {'iri': ib.to_iri(unsafe_iri), 'source': unsafe_iri}
         return jsonify(response)
     else:
         raise(Exception("The IRI {} could not be converted to a compliant IRI".format(unsafe_iri)))
 
 
+@app.route('/sparql/stats', methods=['GET'])
+def sparql_stats():
+    """
+    Get statistics on the calls made to the SPARQL endpoints
+    Lists the number of calls, errors, time spent, bytes sent and received and results returned,
+    per kind of call (query, update or crud), endpoint and calling function, and the most recent slow queries.
+    ---
+      tags:
+        - Base
+      parameters:
+        - name: reset
+          in: query
+          description: Clear the statistics after retrieving them
+          required: false
+          type: boolean
+      responses:
+        '200':
+          description: Statistics retrieved
+          schema:
+            type: object
+            properties:
+                since:
+                    description: The time (in seconds since the epoch) from which calls were counted
+                    type: number
+                slow_threshold:
+                    description: The duration (in seconds) above which a call is considered slow
+                    type: number
+                calls:
+                    description: The aggregated statistics, slowest total time first
+                    type: array
+                    items:
+                        type: object
+                slow:
+                    description: The most recent slow calls, with their normalized query text
+                    type: array
+                    items:
+                        type: object
+        default:
+          description: Unexpected error
+          schema:
+            $ref: "#/definitions/Message"
+    """
+    stats = sc.stats.stats()
+
+    if request.args.get('reset', 'false').lower() == 'true':
+        sc.stats.reset()
+
+    return jsonify(stats)
+
+
 @app.after_request
 def after_request(response):
     """
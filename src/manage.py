@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Maintenance commands for the datalegend API, run from the `src` directory::
+
+    python manage.py rebuild-catalog
+    python manage.py import-vocabulary metadata/hisco.ttl
+    python manage.py import-lod-schemes
+"""
+import argparse
+
+
+def rebuild_catalog(args):
+    import app.util.catalog as catalog
+    catalog.rebuild()
+
+
+def import_vocabulary(args):
+    import app.util.csdh_client as cc
+    for path in args.files:
+        schemes, concepts = cc.vocabulary_store.import_file(path, format=args.format)
+        print("{}: {} schemes, {} concepts".format(path, schemes, concepts))
+
+
+def import_lod_schemes(args):
+    import app.util.csdh_client as cc
+    schemes, _ = cc.vocabulary_store.import_lod_schemes(args.endpoint)
+    print("{}: {} schemes".format(args.endpoint, schemes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance commands for the datalegend API')
+    subparsers = parser.add_subparsers()
+
+    rebuild_parser = subparsers.add_parser('rebuild-catalog',
+                                           help='Rebuild the catalog and membership graphs from the store')
+    rebuild_parser.set_defaults(command=rebuild_catalog)
+
+    vocabulary_parser = subparsers.add_parser('import-vocabulary',
+                                              help='Import (or re-import) the SKOS schemes and collections in RDF '
+                                                   'files into the vocabulary store')
+    vocabulary_parser.add_argument('files', nargs='+', help='The RDF files')
+    vocabulary_parser.add_argument('--format', default='turtle', help='The RDF format of the files (rdflib name)')
+    vocabulary_parser.set_defaults(command=import_vocabulary)
+
+    lod_parser = subparsers.add_parser('import-lod-schemes',
+                                       help='Import (or re-import) the list of schemes in the LOD cloud cache '
+                                            'into the vocabulary store')
+    lod_parser.add_argument('--endpoint', default='http://lod.openlinksw.com/sparql', help='The SPARQL endpoint')
+    lod_parser.set_defaults(command=import_lod_schemes)
+
+    args = parser.parse_args()
+    args.command(args)
+
+
+if __name__ == "__main__":
+    main()
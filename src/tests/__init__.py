@@ -74,5 +74,1160 @@ class TestLoad(unittest.TestCase):
 
         assert True
 
+
+class TestSparqlCache(unittest.TestCase):
+
+    def test_cache_size_limit(self):
+        """
+        Tests that the least recently used entries are evicted when the cache is full
+        """
+        from app.util.cache import Cache
+
+        cache = Cache(ttl=60, max_size=10)
+        cache.put('a', 1, size=4)
+        cache.put('b', 2, size=4)
+        cache.get('a')
+        cache.put('c', 3, size=4)
+
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+        assert cache.size == 8
+
+    def test_cache_invalidation(self):
+        """
+        Tests that entries are dropped when a graph they depend on is written to
+        """
+        from app.util.cache import Cache
+
+        cache = Cache(ttl=60, max_size=10)
+        cache.put('g1', 1, tags=['http://example.com/g1'])
+        cache.put('g2', 2, tags=['http://example.com/g2'])
+        cache.put('all', 3, tags=None)
+
+        cache.invalidate(['http://example.com/g1'])
+
+        assert cache.get('g1') is None
+        assert cache.get('g2') == 2
+        assert cache.get('all') is None
+
+    def test_invalidation_during_query(self):
+        """
+        Tests that results are not cached when a write invalidated the cache while the query ran
+        """
+        import app.util.sparql_client as sc
+
+        class Response(object):
+            status_code = 200
+            content = '{"results": {"bindings": [{"s": {"type": "uri", "value": "http://example.com/old"}}]}}'
+
+        class Session(object):
+            def get(self, *args, **kwargs):
+                # A write finishes while the query runs
+                sc.result_cache.invalidate(['http://example.com/g'])
+                return Response()
+
+        query = "SELECT ?s FROM <http://example.com/g> WHERE { ?s ?p ?o }"
+        original, sc.session = sc.session, Session()
+        try:
+            assert len(sc.sparql(query, endpoint_url='http://example.com/sparql', cache=True)) == 1
+        finally:
+            sc.session = original
+
+        assert ('http://example.com/sparql', sc.normalize_query(query)) not in sc.result_cache
+
+    def test_query_graphs(self):
+        import app.util.sparql_client as sc
+
+        assert sc.query_graphs("SELECT * WHERE { ?s ?p ?o }") is None
+        assert sc.query_graphs("SELECT * FROM <http://example.com/g> WHERE { ?s ?p ?o }") == {'http://example.com/g'}
+        assert sc.update_graphs("INSERT DATA { GRAPH <http://example.com/g> { <a> <b> <c> } }") == {'http://example.com/g'}
+        assert sc.update_graphs("CLEAR GRAPH <http://example.com/g>") == {'http://example.com/g'}
+        assert sc.update_graphs("INSERT DATA { <a> <b> <c> }") is None
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+
+    def test_serve_stale(self):
+        """
+        Tests that stale values are served while they are rebuilt, and that failed rebuilds keep them
+        """
+        from app.util.cache import StaleWhileRevalidate
+
+        loads = []
+
+        def load(key):
+            loads.append(key)
+            if len(loads) > 2:
+                raise Exception("Service unavailable")
+            return len(loads)
+
+        cache = StaleWhileRevalidate(load, max_age=0)
+
+        assert cache.get('a') == 1
+        assert cache.get('a') == 1
+        cache.refresh('a').join()
+        assert cache.get('a') == 2
+
+        cache.refresh('a').join()
+        assert cache.get('a') == 2 and len(loads) == 3
+
+        cache.invalidate(['a'])
+        assert 'a' not in cache
+
+
+class TestConceptCache(unittest.TestCase):
+
+    def test_codelist_uris(self):
+        """
+        Tests that the code lists a dataset adds members to are found in its N-Quads
+        """
+        import app.util.csdh_client as cc
+
+        lines = ['<http://example.com/codelist/SEX> <http://www.w3.org/2004/02/skos/core#member> '
+                 '<http://example.com/code/SEX/m> <http://example.com/assertion> .',
+                 '<http://example.com/code/SEX/m> <http://www.w3.org/2004/02/skos/core#inScheme> '
+                 '<http://example.com/scheme/sex> <http://example.com/assertion> .',
+                 '<http://example.com/code/SEX/m> <http://www.w3.org/2004/02/skos/core#prefLabel> '
+                 '"m" <http://example.com/assertion> .']
+
+        assert cc.codelist_uris(lines) == {'http://example.com/codelist/SEX', 'http://example.com/scheme/sex'}
+
+    def test_iter_concepts(self):
+        """
+        Tests that concepts are streamed as they load, and only cached once all of them were loaded
+        """
+        import json
+        import app.util.csdh_client as cc
+        from app.views import stream_json
+
+        uri = 'http://example.com/scheme/streamed'
+        concepts = [{'uri': 'http://example.com/{}'.format(i), 'label': u'caf\xe9 {}'.format(i)} for i in range(5)]
+
+        original, cc.iter_load_concepts = cc.iter_load_concepts, lambda uri: iter(concepts)
+        try:
+            streamed = cc.iter_concepts(uri)
+            assert next(streamed) == concepts[0] and uri not in cc.concept_cache
+
+            assert json.loads(''.join(stream_json('concepts', streamed, chunk_size=10))) == {'concepts': concepts[1:]}
+            assert cc.concept_cache.get(uri) == concepts
+            assert list(cc.iter_concepts(uri)) == concepts
+        finally:
+            cc.iter_load_concepts = original
+            cc.concept_cache.invalidate([uri])
+
+    def test_count_requests(self):
+        """
+        Tests that only requests for schemes with concepts are counted, and that the counts stay bounded
+        """
+        import app.util.csdh_client as cc
+
+        loaded = {'http://example.com/empty': [], 'http://example.com/full': [{'uri': 'http://example.com/1',
+                                                                               'label': 'One'}]}
+        original = cc.iter_load_concepts, cc.config.CONCEPT_REQUESTS_SIZE, cc.concept_requests.copy()
+        cc.iter_load_concepts = lambda uri: iter(loaded[uri])
+        cc.config.CONCEPT_REQUESTS_SIZE = 4
+        cc.concept_requests.clear()
+        try:
+            for uri in ['http://example.com/empty', 'http://example.com/full', 'http://example.com/full']:
+                list(cc.iter_concepts(uri))
+            assert cc.concept_requests == {'http://example.com/full': 2}
+
+            for i in range(4):
+                cc.count_request('http://example.com/{}'.format(i))
+            assert len(cc.concept_requests) <= 4
+            assert cc.concept_requests['http://example.com/full'] == 1
+        finally:
+            cc.iter_load_concepts, cc.config.CONCEPT_REQUESTS_SIZE = original[:2]
+            cc.concept_requests.clear()
+            cc.concept_requests.update(original[2])
+            cc.concept_cache.invalidate(loaded.keys())
+
+    def test_stream_errors(self):
+        """
+        Tests that a failure after the response started still gives valid JSON, with an error, and that a
+        slow LOD cloud does not fail the concepts of the SDH
+        """
+        import json
+        import gevent
+        import app.util.csdh_client as cc
+        from app.views import stream_json
+
+        def failing():
+            yield {'uri': 'http://example.com/1', 'label': 'One'}
+            raise Exception("Could not retrieve the concepts of <http://example.com/scheme> from the SDH")
+
+        streamed = json.loads(''.join(stream_json('concepts', failing(), chunk_size=1)))
+        assert streamed['concepts'] == [{'uri': 'http://example.com/1', 'label': 'One'}]
+        assert 'from the SDH' in streamed['error']
+
+        sdh = [{'uri': {'type': 'uri', 'value': 'http://example.com/1'}, 'label': {'type': 'literal', 'value': 'One'}}]
+
+        class SPARQLWrapper(object):
+            # The LOD cloud does not answer in time
+            def __init__(self, *args):
+                pass
+
+            def __getattr__(self, name):
+                return lambda *args: gevent.sleep(10)
+
+        original = cc.sc.iter_sparql, cc.SPARQLWrapper, cc.config.FAN_OUT_TIMEOUT
+        cc.sc.iter_sparql, cc.SPARQLWrapper, cc.config.FAN_OUT_TIMEOUT = lambda query: iter(sdh), SPARQLWrapper, 0.1
+        try:
+            concepts = list(cc.iter_load_concepts('http://example.com/scheme/slow'))
+        finally:
+            cc.sc.iter_sparql, cc.SPARQLWrapper, cc.config.FAN_OUT_TIMEOUT = original
+
+        assert concepts == [{'uri': 'http://example.com/1', 'label': 'One'}]
+
+
+class TestCatalog(unittest.TestCase):
+
+    def test_nanopublication_uris(self):
+        """
+        Tests that the nanopublications in a converted dataset are found in its N-Quads
+        """
+        import app.util.catalog as catalog
+
+        lines = ['<http://example.com/np> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> '
+                 '<http://www.nanopub.org/nschema#Nanopublication> <http://example.com/np> .',
+                 '<http://example.com/np> <http://www.nanopub.org/nschema#hasAssertion> '
+                 '<http://example.com/assertion> <http://example.com/np> .']
+
+        assert catalog.nanopublication_uris(lines) == {'http://example.com/np'}
+
+    def test_datasets_limit(self):
+        """
+        Tests that a negative limit does not make an invalid query
+        """
+        import app.util.csdh_client as cc
+
+        queries = []
+
+        def sparql(query, cache=False):
+            queries.append(query)
+            return []
+
+        original, cc.sc.sparql = cc.sc.sparql, sparql
+        try:
+            cc.get_datasets(limit=-1)
+        finally:
+            cc.sc.sparql = original
+
+        assert 'LIMIT 0' in queries[0]
+
+    def test_update_membership(self):
+        """
+        Tests that the collections containing the updated collections are recomputed and returned too
+        """
+        import app.util.catalog as catalog
+
+        updates = []
+        original = catalog.sc.sparql, catalog.update
+        catalog.sc.sparql = lambda query: [{'c': {'type': 'uri', 'value': 'http://example.com/A'}}]
+        catalog.update = updates.append
+        try:
+            collections = catalog.update_membership(['http://example.com/B'])
+        finally:
+            catalog.sc.sparql, catalog.update = original
+
+        assert collections == {'http://example.com/A', 'http://example.com/B'}
+        assert all('<http://example.com/A> <http://example.com/B>' in u for u in updates)
+
+
+class TestSparqlStreaming(unittest.TestCase):
+
+    def test_iter_bindings(self):
+        """
+        Tests incremental parsing of SPARQL JSON results that arrive in small chunks
+        """
+        import json
+        import app.util.sparql_client as sc
+
+        bindings = [{'uri': {'type': 'uri', 'value': 'http://example.com/{}'.format(i)},
+                     'label': {'type': 'literal', 'value': u'caf\xe9 ] {}'.format(i)}} for i in range(100)]
+        content = json.dumps({'head': {'vars': ['uri', 'label']}, 'results': {'bindings': bindings}})
+
+        class Response(object):
+            def iter_content(self, chunk_size):
+                for i in range(0, len(content), 7):
+                    yield content[i:i + 7]
+
+        assert list(sc.iter_bindings(Response())) == bindings
+        assert sc.dictize(bindings)[3] == {'uri': 'http://example.com/3', 'label': u'caf\xe9 ] 3'}
+
+
+class TestSparqlExists(unittest.TestCase):
+
+    def test_exists_batches(self):
+        """
+        Tests that existence checks are combined into VALUES queries of at most `batch_size` URIs
+        """
+        import app.util.sparql_client as sc
+
+        queries = []
+
+        def sparql(query, endpoint_url=None):
+            queries.append(query)
+            return [{'uri': {'type': 'uri', 'value': 'http://example.com/3'}}]
+
+        original, sc.sparql = sc.sparql, sparql
+        try:
+            uris = ['http://example.com/{}'.format(i) for i in range(5)] + ['not a <uri>']
+            found = sc.exists(uris, "GRAPH ?uri { ?s ?p ?o }", batch_size=2)
+        finally:
+            sc.sparql = original
+
+        assert found == {'http://example.com/3'}
+        assert len(queries) == 3
+        assert all('VALUES ?uri' in q for q in queries)
+
+
+class TestClearGraph(unittest.TestCase):
+
+    def test_count_error(self):
+        """
+        Tests that a graph is not cleared when its triples cannot be counted
+        """
+        import app.util.csdh_client as cc
+
+        updates = []
+        original = cc.sc.sparql, cc.sc.execute_updates
+        cc.sc.sparql = lambda query: 'Virtuoso 37000 Error SP030: SPARQL compiler'
+        cc.sc.execute_updates = updates.extend
+        try:
+            with self.assertRaises(Exception) as raised:
+                cc.clear_graph('http://example.com/graph')
+        finally:
+            cc.sc.sparql, cc.sc.execute_updates = original
+
+        assert 'http://example.com/graph' in str(raised.exception)
+        assert updates == []
+
+
+class TestCrawler(unittest.TestCase):
+
+    class Session(object):
+        """Serves a small Turtle document for every URI, after `latency` seconds, and fails for the `broken` ones"""
+
+        def __init__(self, latency=0.05, broken=()):
+            import collections
+
+            self.latency = latency
+            self.broken = set(broken)
+            self.calls = collections.Counter()
+            self.running = collections.Counter()
+            self.peak = collections.Counter()
+
+        def get(self, uri, headers=None, timeout=None):
+            import gevent
+            from urlparse import urlparse
+
+            host = urlparse(uri).netloc
+            self.calls[uri] += 1
+            self.running[host] += 1
+            self.peak[host] = max(self.peak[host], self.running[host])
+            try:
+                gevent.sleep(self.latency)
+            finally:
+                self.running[host] -= 1
+
+            if uri in self.broken:
+                raise Exception("Not found")
+
+            class Response(object):
+                content = '<{}> <http://www.w3.org/2000/01/rdf-schema#label> "x" .'.format(uri)
+                headers = {'Content-Type': 'text/turtle'}
+
+                def raise_for_status(self):
+                    pass
+
+            return Response()
+
+    def crawler(self, session, **kwargs):
+        from app.util.crawler import Crawler
+
+        return Crawler(session, known=lambda docs: set(), store=lambda graph, doc: None, **kwargs)
+
+    def test_per_host_limit(self):
+        """
+        Tests that at most `per_host` documents are fetched from a host at the same time
+        """
+        session = self.Session()
+        crawler = self.crawler(session, concurrency=8, per_host=2)
+
+        uris = ['http://a.example.com/{}'.format(i) for i in range(6)] + ['http://b.example.com/{}'.format(i)
+                                                                       for i in range(3)]
+        resolved, visited = crawler.crawl(uris, depth=1)
+
+        assert resolved == set(uris)
+        assert session.peak['a.example.com'] == 2 and session.peak['b.example.com'] == 2
+
+        # Once the hosts are idle, they are forgotten
+        crawler.crawl([], depth=1)
+        assert crawler.hosts == {}
+
+    def test_budget(self):
+        """
+        Tests that a crawl stops when its time budget is spent
+        """
+        import time
+
+        crawler = self.crawler(self.Session(latency=5), budget=0.2)
+
+        started = time.time()
+        resolved, visited = crawler.crawl(['http://slow.example.com/1'], depth=2)
+
+        assert time.time() - started < 1
+        assert resolved == set() and visited == {'http://slow.example.com/1'}
+
+    def test_failure_ttl(self):
+        """
+        Tests that failed documents are not fetched again until their failure expires, and are then forgotten
+        """
+        import gevent
+
+        uri = 'http://broken.example.com/1'
+        session = self.Session(latency=0, broken=[uri])
+        crawler = self.crawler(session, failure_ttl=0.1)
+
+        assert crawler.crawl([uri], depth=1)[0] == set()
+        crawler.crawl([uri], depth=1)
+        assert session.calls[uri] == 1 and uri in crawler.failures
+
+        gevent.sleep(0.2)
+        crawler.prune()
+        assert crawler.failures == {}
+
+        crawler.crawl([uri], depth=1)
+        assert session.calls[uri] == 2
+
+
+class TestBulkLoader(unittest.TestCase):
+
+    def test_nquads_chunks(self):
+        """
+        Tests that N-Quads are split into bounded N-Triples chunks per graph
+        """
+        import app.util.bulk_loader as bl
+
+        lines = ['<http://example.com/s> <http://example.com/p> "a \\" <b> ." <http://example.com/g1> .',
+                 '<http://example.com/s> <http://example.com/p> <http://example.com/o> <http://example.com/g2> .',
+                 '<http://example.com/s> <http://example.com/p> "b"@en <http://example.com/g1> .',
+                 '<http://example.com/s> <http://example.com/p> <http://example.com/o> .',
+                 '<http://example.com/s> <http://example.com/p> "c"^^<http://example.com/t> <http://example.com/g1> .']
+
+        chunks = list(bl.chunks(lines, format='nq', max_triples=2))
+
+        assert [(c.graph_uri, len(c.lines)) for c in chunks] == [('http://example.com/g1', 2),
+                                                                 ('http://example.com/g2', 1),
+                                                                 (None, 1),
+                                                                 ('http://example.com/g1', 1)]
+        assert chunks[0].lines[0] == '<http://example.com/s> <http://example.com/p> "a \\" <b> ." .\n'
+
+    def test_skolemize(self):
+        """
+        Tests that a blank node gets the same IRI in every chunk, and that literals and IRIs are left alone
+        """
+        import app.util.bulk_loader as bl
+
+        lines = ['_:b1 <http://example.com/p> "_:b2 \\" _:b3" <http://example.com/g> .',
+                 '<http://example.com/_:s> <http://example.com/p> _:b1 <http://example.com/g> .',
+                 '_:b1 <http://example.com/p> _:b2.']
+
+        chunks = list(bl.chunks(lines, format='nq', max_triples=1, skolem_base='http://example.com/genid/'))
+
+        assert [c.lines[0] for c in chunks] == [
+            '<http://example.com/genid/b1> <http://example.com/p> "_:b2 \\" _:b3" .\n',
+            '<http://example.com/_:s> <http://example.com/p> <http://example.com/genid/b1> .\n',
+            '<http://example.com/genid/b1> <http://example.com/p> <http://example.com/genid/b2>.\n']
+
+
+class TestMakeUpdate(unittest.TestCase):
+
+    def test_make_update_batches(self):
+        """
+        Tests that make_update splits a Dataset into INSERT DATA updates of bounded size
+        """
+        from rdflib import Dataset, URIRef, Literal
+        import app.util.sparql_client as sc
+
+        ds = Dataset()
+        g = ds.graph(URIRef('http://example.com/g'))
+        for i in range(5):
+            g.add((URIRef('http://example.com/s'), URIRef('http://example.com/p'), Literal(u'caf\xe9 {}'.format(i))))
+        ds.add((URIRef('http://example.com/s'), URIRef('http://example.com/p'), URIRef('http://example.com/o')))
+
+        updates = list(sc.make_update(ds, max_triples=2))
+
+        assert len(updates) == 3
+        assert all(u.startswith('INSERT DATA {') for u in updates)
+
+        # The updates should add up to the same triples
+        result = Dataset()
+        for u in updates:
+            result.update(u)
+        assert len(result.graph(URIRef('http://example.com/g'))) == 5
+        assert len(list(result.quads((None, None, None, None)))) == 6
+
+    def test_blank_node_batches(self):
+        """
+        Tests that a blank node whose statements are split over several updates remains a single node
+        """
+        from rdflib import ConjunctiveGraph, URIRef, BNode, Literal
+        import app.util.sparql_client as sc
+
+        node = BNode()
+        p = URIRef('http://example.com/p')
+        quads = [(URIRef('http://example.com/s'), p, node, None)] + [(node, p, Literal(i), None) for i in range(3)]
+
+        updates = list(sc.make_quad_update(quads, max_triples=2))
+        assert len(updates) == 2
+
+        # Also when the updates are joined into a single request, as execute_updates does
+        for requests in [updates, [" ;\n".join(updates)]]:
+            result = ConjunctiveGraph()
+            for u in requests:
+                result.update(u)
+
+            objects = list(result.objects(URIRef('http://example.com/s'), p))
+            assert len(objects) == 1 and not isinstance(objects[0], BNode)
+            assert len(list(result.objects(objects[0], p))) == 3
+
+
+class TestResultTable(unittest.TestCase):
+
+    def test_decode(self):
+        """
+        Tests decoding of SPARQL bindings into typed columns
+        """
+        import numpy as np
+        from flask import json
+        import app.util.result_table as rt
+
+        xsd = 'http://www.w3.org/2001/XMLSchema#'
+        bindings = [
+            {'label': {'type': 'literal', 'value': 'one', 'xml:lang': 'en'},
+             'count': {'type': 'typed-literal', 'datatype': xsd + 'integer', 'value': '1'},
+             'date': {'type': 'literal', 'datatype': xsd + 'dateTime', 'value': '2015-01-01T12:00:00+01:00'}},
+            {'label': {'type': 'literal', 'value': 'one'},
+             'count': {'type': 'typed-literal', 'datatype': xsd + 'integer', 'value': '2'}}
+        ]
+
+        table = rt.decode(bindings)
+
+        assert len(table) == 2
+        assert table['count'].dtype == np.int64
+        assert list(table['count']) == [1, 2]
+        assert str(table['date'][0]) == '2015-01-01T11:00:00.000000'
+        assert table['label'][0] is table['label'][1]
+        assert table.langs['label'] == ['en', None]
+
+        rows = list(table.rows())
+        assert rows[0]['label'] == 'one'
+        assert 'date' not in rows[1]
+        assert rows[1].as_dict() == {'label': 'one', 'count': 2}
+        assert json.dumps(table.dicts())
+
+
+class TestFanOut(unittest.TestCase):
+
+    def test_fan_out_deadline(self):
+        """
+        Tests that concurrent calls are bounded by the deadline, and that failures yield the default
+        """
+        import gevent
+        from app.util.parallel import fan_out
+
+        def slow():
+            gevent.sleep(5)
+            return 'slow'
+
+        def fail():
+            raise Exception('Failed')
+
+        start = datetime.now()
+        results = fan_out([lambda: 'fast', slow, fail], timeout=0.5, default=[])
+
+        assert results == ['fast', [], []]
+        assert (datetime.now() - start).total_seconds() < 2
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def test_bounded_workers(self):
+        """
+        Tests that at most `workers` jobs run at the same time, and that failures are recorded
+        """
+        import gevent
+        from app.util.jobs import JobQueue
+
+        queue = JobQueue(workers=2, history=2)
+        running = []
+        peak = []
+
+        def work(job, n):
+            running.append(n)
+            peak.append(len(running))
+            gevent.sleep(0.05)
+            running.remove(n)
+            if n == 3:
+                raise Exception('Failed')
+            return n
+
+        jobs = [queue.submit('Job {}'.format(n), work, n) for n in range(4)]
+        assert [job.status for job in jobs] == ['queued'] * 4
+
+        queue.join(timeout=5)
+
+        assert max(peak) == 2
+        assert [job.status for job in jobs] == ['done', 'done', 'done', 'failed']
+        assert jobs[2].result == 2 and jobs[3].error == 'Failed'
+
+        queue.submit('Job 4', work, 4)
+        assert queue.get(jobs[0].id) is None and len(queue.list()) == 2
+
+
+class TestDimensionCatalog(unittest.TestCase):
+
+    def test_load_and_reload(self):
+        """
+        Tests that the catalog is compacted and sorted, and reloaded when the file changes
+        """
+        import os
+        import json
+        import tempfile
+        from app.util.dimension_catalog import DimensionCatalog
+
+        path = tempfile.mktemp(suffix='.json')
+        with open(path, 'w') as f:
+            json.dump([{'id': 0, 'uri': 'http://example.com/a', 'label': 'a', 'refs': 30, 'view': '<a/>'},
+                       {'id': 1, 'uri': 'http://example.com/b', 'label': 'b', 'refs': 1, 'view': '<a/>'},
+                       {'id': 2, 'uri': 'http://example.com/c', 'label': 'c', 'refs': 5, 'view': '<a/>'}], f)
+
+        catalog = DimensionCatalog(path, 'http://127.0.0.1:1/', refresh_interval=3600)
+        catalog.checked = float('inf')
+
+        assert catalog.get() == [{'id': 2, 'uri': 'http://example.com/c', 'label': 'c', 'refs': 5},
+                                 {'id': 0, 'uri': 'http://example.com/a', 'label': 'a', 'refs': 30}]
+
+        with open(path, 'w') as f:
+            json.dump([{'id': 3, 'uri': 'http://example.com/d', 'label': 'd', 'refs': 2}], f)
+        os.utime(path, (0, 0))
+
+        assert [d['uri'] for d in catalog.get()] == ['http://example.com/d']
+        os.remove(path)
+
+
+class TestVocabularyStore(unittest.TestCase):
+
+    def test_import(self):
+        """
+        Tests that schemes and (nested) collections are compiled into the store, and replaced on import
+        """
+        import os
+        import tempfile
+        from app.util.vocabulary import VocabularyStore
+
+        vocabulary = """
+            @prefix skos: <http://www.w3.org/2004/02/skos/core#> .
+            @prefix dct: <http://purl.org/dc/terms/> .
+            @prefix h: <http://example.com/hisco/> .
+
+            h:scheme a skos:ConceptScheme ; dct:title "HISCO" .
+            h:1 skos:inScheme h:scheme ; skos:prefLabel "Farmer" ; skos:notation "61110" .
+            h:2 skos:inScheme h:scheme ; skos:prefLabel "Fisherman" .
+            h:major skos:prefLabel "Major group" ; skos:member h:minor .
+            h:minor skos:prefLabel "Minor group" ; skos:member h:1 .
+        """
+        path = tempfile.mktemp(suffix='.ttl')
+        with open(path, 'w') as f:
+            f.write(vocabulary)
+
+        store = VocabularyStore(tempfile.mktemp(suffix='.db'))
+        assert store.schemes() == [] and not store.has_concepts('http://example.com/hisco/scheme')
+
+        store.import_file(path)
+        store.import_file(path)
+
+        assert [s['label'] for s in store.schemes()] == ['HISCO', 'Major group', 'Minor group']
+        assert store.concepts('http://example.com/hisco/major') == [
+            {'uri': 'http://example.com/hisco/1', 'label': 'Farmer', 'notation': '61110'},
+            {'uri': 'http://example.com/hisco/minor', 'label': 'Minor group'}]
+        assert len(store.find_concepts(label='f', scheme='http://example.com/hisco/scheme')) == 2
+        assert [c['scheme'] for c in store.find_concepts(notation='61110')] == [
+            'http://example.com/hisco/scheme', 'http://example.com/hisco/major', 'http://example.com/hisco/minor']
+
+        os.remove(path)
+        os.remove(store.path)
+
+    def test_sources(self):
+        """
+        Tests that importing a list of scheme names (e.g. import_lod_schemes) keeps the compiled concepts
+        of the same schemes, before or after it
+        """
+        import os
+        import tempfile
+        from app.util.vocabulary import VocabularyStore
+
+        path = tempfile.mktemp(suffix='.ttl')
+        with open(path, 'w') as f:
+            f.write("""
+                @prefix skos: <http://www.w3.org/2004/02/skos/core#> .
+                @prefix dct: <http://purl.org/dc/terms/> .
+
+                <http://h/scheme> a skos:ConceptScheme ; dct:title "HISCO" .
+                <http://h/1> skos:inScheme <http://h/scheme> ; skos:prefLabel "Farmer" .
+            """)
+
+        lod = [('http://h/scheme', 'HISCO (LOD)'), ('http://example.com/other', 'Other')]
+        concept = {'uri': 'http://h/1', 'label': 'Farmer'}
+        store = VocabularyStore(tempfile.mktemp(suffix='.db'))
+        try:
+            store.import_file(path)
+            store.replace('http://lod', lod, [])
+            assert store.concepts('http://h/scheme') == [concept]
+            assert [s['label'] for s in store.schemes()] == ['HISCO', 'Other']
+
+            os.remove(store.path)
+            store = VocabularyStore(tempfile.mktemp(suffix='.db'))
+            store.replace('http://lod', lod, [])
+            store.import_file(path)
+            store.replace('http://lod', lod, [])
+            assert store.concepts('http://h/scheme') == [concept]
+            assert [s['label'] for s in store.schemes()] == ['HISCO', 'Other']
+        finally:
+            os.remove(path)
+            os.remove(store.path)
+
+    def test_merge(self):
+        """
+        Tests that the imported schemes and concepts are merged with the cached copy of the other schemes
+        (without rebuilding it), and with the concepts that datasets in the SDH added to the scheme
+        """
+        import os
+        import json
+        import tempfile
+        import app.util.csdh_client as cc
+        from app.util.vocabulary import VocabularyStore
+
+        store = VocabularyStore(tempfile.mktemp(suffix='.db'))
+        store.replace('test', [('http://example.com/scheme', 'Scheme')],
+                      [('http://example.com/scheme', 'http://example.com/1', 'Farmer', '61110')])
+
+        sdh = [{'uri': {'type': 'uri', 'value': 'http://example.com/1'},
+                'label': {'type': 'literal', 'value': 'Farmer'},
+                'notation': {'type': 'literal', 'value': '61110'}},
+               {'uri': {'type': 'uri', 'value': 'http://example.com/2'},
+                'label': {'type': 'literal', 'value': 'Fisherman'}}]
+
+        schemes_file = tempfile.mktemp(suffix='.json')
+        with open(schemes_file, 'w') as f:
+            json.dump([{'uri': 'http://example.com/scheme', 'label': 'Scheme'},
+                       {'uri': 'http://example.com/other', 'label': 'Other'}], f)
+
+        def build_schemes():
+            raise Exception("The schemes should not be rebuilt")
+
+        original = cc.vocabulary_store, cc.sc.iter_sparql, cc.build_schemes, cc.config.SCHEMES_FILE
+        cc.vocabulary_store, cc.sc.iter_sparql = store, lambda query: iter(sdh)
+        cc.build_schemes, cc.config.SCHEMES_FILE = build_schemes, schemes_file
+        try:
+            concepts = cc.load_concepts('http://example.com/scheme')
+            schemes = cc.get_schemes()
+        finally:
+            cc.vocabulary_store, cc.sc.iter_sparql, cc.build_schemes, cc.config.SCHEMES_FILE = original
+            os.remove(store.path)
+            os.remove(schemes_file)
+
+        assert [c['uri'] for c in concepts] == ['http://example.com/1', 'http://example.com/2']
+        assert [s['uri'] for s in schemes] == ['http://example.com/scheme', 'http://example.com/other']
+
+
+class TestDimensionIndex(unittest.TestCase):
+
+    def test_search(self):
+        """
+        Tests that label prefix matches come first, and that short and long queries find the same dimensions
+        """
+        from app.util.dimension_index import DimensionIndex
+
+        index = DimensionIndex([{'uri': 'http://example.com/occupation', 'label': 'Occupation', 'refs': 30},
+                                {'uri': 'http://example.com/sex', 'label': 'Sex', 'refs': 20},
+                                {'uri': 'http://example.com/hisco', 'label': 'Occupation (HISCO)', 'refs': 10}])
+
+        prefix, other = index.search('Occ')
+        assert list(prefix) == [0, 2] and list(other) == []
+
+        prefix, other = index.search('cupation')
+        assert list(prefix) == [] and list(other) == [0, 2]
+
+        prefix, other = index.search('example.com/s')
+        assert [index[i]['label'] for i in other] == ['Sex']
+
+
+class TestIri(unittest.TestCase):
+
+    def test_to_iris(self):
+        """
+        Tests that baked IRIs are remembered, and that a batch is converted in order
+        """
+        import iribaker
+        import app.util.iri as ib
+
+        source = u'http://example.com/value/occupation/a b'
+        assert ib.to_iri(source) == iribaker.to_iri(source)
+        assert ib.memo.get(source) == ib.to_iri(source)
+
+        sources = [u'http://example.com/x y', source, u'no scheme']
+        iris = ib.to_iris(sources, strict=False)
+        assert iris[:2] == [iribaker.to_iri(sources[0]), iribaker.to_iri(source)]
+        assert iris[2] is None
+
+    def test_memo_size(self):
+        """
+        Tests that the least recently used IRIs are forgotten first
+        """
+        import app.util.iri as ib
+
+        original, ib.memo = ib.memo, ib.Memo(2)
+        try:
+            for name in 'abcad':
+                ib.to_iri(u'http://example.com/' + name)
+
+            assert u'http://example.com/a' in ib.memo and u'http://example.com/d' in ib.memo
+            assert u'http://example.com/b' not in ib.memo and len(ib.memo) <= 4
+        finally:
+            ib.memo = original
+
+
+def dsd_variables(values=3):
+    """Variables (as sent by QBer) of a small dataset, with a coded, an identifier and an other variable"""
+    base = 'http://data.socialhistory.org/resource/test/'
+
+    def variable(name, category, type, mapped=False):
+        codes = [{'original': {'uri': base + 'code/{}/{}'.format(name, i), 'label': u'V\u00e4lue "{}"'.format(i)},
+                  'uri': 'http://example.com/code/{}'.format(i) if mapped and i % 2 else base + 'code/{}/{}'.format(name, i),
+                  'label': 'Mapped {}'.format(i)} for i in range(values)]
+
+        return {'original': {'uri': base + 'variable/' + name, 'label': name},
+                'uri': 'http://example.com/variable/' + name if mapped else base + 'variable/' + name,
+                'type': 'http://purl.org/linked-data/cube#' + type, 'category': category,
+                'description': 'The {}\nvariable'.format(name),
+                'codelist': {'original': {'uri': base + 'codelist/' + name, 'label': 'Codes of ' + name},
+                             'uri': 'http://example.com/codelist/' + name if mapped else base + 'codelist/' + name},
+                'values': codes}
+
+    return {'sex': variable('sex', 'coded', 'DimensionProperty', mapped=True),
+            'id': variable('id', 'identifier', 'DimensionProperty'),
+            'age': variable('age', 'other', 'MeasureProperty')}
+
+
+class TestDataStructureDefinition(unittest.TestCase):
+
+    def test_streaming_writers(self):
+        """
+        Tests that the N-Quads and TriG writers, and serializeTrig, produce exactly the statements of the
+        rdflib graph store
+        """
+        from StringIO import StringIO
+        from rdflib import ConjunctiveGraph, URIRef
+        from rdflib.graph import DATASET_DEFAULT_GRAPH_ID
+        from app.datacube import converter
+
+        arguments = ({'email': 'test@example.com', 'name': 'Test', 'id': '1'}, 'test',
+                     'http://data.socialhistory.org/resource/test', dsd_variables(), 'test.csv', 'abcdef1234')
+        timestamp = datetime(2016, 1, 1, 12, 0)
+
+        def graph_name(graph):
+            # Datasets give graph names and conjunctive graphs give graphs, the default graph differs per parser
+            name = getattr(graph, 'identifier', graph)
+            return name if isinstance(name, URIRef) and name != DATASET_DEFAULT_GRAPH_ID else None
+
+        def quads(store):
+            return set((s, p, o, graph_name(g)) for s, p, o, g in store.quads((None, None, None)))
+
+        expected = quads(converter.data_structure_definition(*arguments, timestamp=timestamp))
+        assert len(expected) > 50
+
+        for format in ('nquads', 'trig'):
+            out = StringIO()
+            converter.write_data_structure_definition(out, *arguments, timestamp=timestamp, format=format)
+
+            store = ConjunctiveGraph()
+            store.parse(data=out.getvalue(), format=format)
+
+            assert quads(store) == expected
+
+        store = ConjunctiveGraph()
+        trig = converter.serializeTrig(converter.data_structure_definition(*arguments, timestamp=timestamp))
+        store.parse(data=trig, format='trig')
+
+        assert quads(store) == expected
+
+    def test_parallel(self):
+        """
+        Tests that generating the variables in worker processes gives the same statements, in the same order
+        """
+        from app.datacube import converter
+
+        variables = {}
+        for i in range(4):
+            for name, variable in dsd_variables().items():
+                variables['{}{}'.format(name, i)] = variable
+
+        arguments = ({'email': 'test@example.com', 'name': 'Test', 'id': '1'}, 'test',
+                     'http://data.socialhistory.org/resource/test', variables, 'test.csv', 'abcdef1234')
+        timestamp = datetime(2016, 1, 1, 12, 0)
+
+        serial = list(converter.data_structure_quads(*arguments, timestamp=timestamp))
+        assert list(converter.data_structure_quads(*arguments, timestamp=timestamp, processes=3)) == serial
+
+    def test_parallel_patched(self):
+        """
+        Tests that worker processes are refused (rather than hanging) in a process patched by gevent
+        """
+        import os
+        import sys
+        import time
+        import subprocess
+
+        script = """
+from gevent import monkey
+monkey.patch_all()
+
+from app.datacube import converter
+from tests import dsd_variables
+
+arguments = ({'email': 'test@example.com', 'name': 'Test', 'id': '1'}, 'test',
+             'http://data.socialhistory.org/resource/test', dsd_variables(), 'test.csv', 'abcdef1234')
+try:
+    list(converter.data_structure_quads(*arguments, processes=3))
+except Exception as e:
+    print(e)
+"""
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE, stderr=devnull)
+
+        deadline = time.time() + 60
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if process.poll() is None:
+            process.kill()
+            self.fail("Generating the variables in worker processes hangs in a patched process")
+
+        assert 'patched by gevent' in process.stdout.read()
+
+    def test_delta(self):
+        """
+        Tests that only the changed triples of the assertion graph are removed and added, and that the
+        revision is recorded in the earlier provenance graph
+        """
+        import copy
+        import app.util.sparql_client as sc
+        from app.datacube import converter
+
+        base = 'http://data.socialhistory.org/resource/test'
+        profile = {'email': 'test@example.com', 'name': 'Test', 'id': '1'}
+        variables = dsd_variables()
+        store = converter.data_structure_definition(profile, 'test', base, variables, 'test.csv', 'abcdef1234')
+
+        assertion, = store.subjects(converter.RDF.type, converter.NP['Assertion'])
+        provenance, = store.subjects(converter.RDF.type, converter.NP['Provenance'])
+
+        # The converter adds the observations to the same assertion graph
+        observation = converter.URIRef(base + '/observation/1')
+        observation_triples = {(observation, converter.RDF.type, converter.QB['Observation']),
+                               (observation, converter.QB['dataSet'], converter.URIRef(base)),
+                               (observation, converter.URIRef(base + '/variable/sex'),
+                                converter.URIRef(base + '/code/sex/1')),
+                               (observation, converter.RDFS.label, converter.Literal('Observation 1'))}
+        previous = {'assertion': assertion, 'provenance': provenance,
+                    'triples': set(store.graph(assertion)) | observation_triples}
+
+        assert converter.data_structure_delta(previous, profile, 'test', base, variables, 'abcdef1234') == ([], [])
+
+        changed = copy.deepcopy(variables)
+        coded = [v for _, v in sorted(changed.items()) if v['category'] == 'coded'][0]
+        coded['values'][1]['uri'] = 'http://example.com/mapped'
+        removed, added = converter.data_structure_delta(previous, profile, 'test', base, changed, 'abcdef1234')
+
+        value_uri = converter.URIRef(coded['values'][1]['original']['uri'])
+        assert set(p for s, p, o, g in removed) == {converter.SKOS['exactMatch']}
+        assert set(p for s, p, o, g in added if g == assertion) == {converter.SKOS['exactMatch']}
+        assert all(s == value_uri for s, p, o, g in removed + added if g == assertion)
+        assert (assertion, converter.QBRV['revision']) in set((s, p) for s, p, o, g in added if g == provenance)
+
+        del changed['age']
+        removed, added = converter.data_structure_delta(previous, profile, 'test', base, changed, 'abcdef1234')
+
+        age_uri = converter.URIRef(variables['age']['original']['uri'])
+        assert (age_uri, converter.RDF.type, converter.QB['MeasureProperty'], assertion) in removed
+        assert not any(s == observation for s, p, o, g in removed)
+
+        binding = {'type': 'typed-literal', 'value': u'V\xe4lue', 'datatype': str(converter.XSD.string)}
+        assert sc.term(binding) == converter.Literal(u'V\xe4lue')
+
+
+class TestLocalEndpoint(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from tests.local_endpoint import LocalEndpoint
+
+        cls.endpoint = LocalEndpoint()
+        cls.endpoint.load('tests/fixtures/csdh.trig')
+        cls.endpoint.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.endpoint.stop()
+
+    def test_iter_sparql_pages(self):
+        """
+        Tests that paged iteration returns the same results as a single query
+        """
+        import app.util.sparql_client as sc
+
+        query = "SELECT ?s ?p ?o WHERE { ?s ?p ?o } ORDER BY ?s ?p ?o"
+        paged = list(sc.iter_sparql(query, endpoint_url=self.endpoint.query_url, page_size=10))
+
+        assert paged == sc.sparql(query, endpoint_url=self.endpoint.query_url)
+
+    def test_known_graphs(self):
+        import app.util.sparql_client as sc
+
+        graphs = ['http://purl.org/linked-data/sdmx/2009/code', 'http://example.com/unknown']
+
+        assert sc.known_graphs(graphs, endpoint_url=self.endpoint.query_url) == {graphs[0]}
+
+    def test_post_data_invalidates_cache(self):
+        """
+        Tests that cached results are dropped when data is added
+        """
+        import app.util.sparql_client as sc
+
+        query = "SELECT ?label WHERE { <http://example.com/cached> <http://www.w3.org/2000/01/rdf-schema#label> ?label }"
+
+        assert sc.sparql(query, endpoint_url=self.endpoint.query_url, cache=True) == []
+
+        sc.post_data('<http://example.com/cached> <http://www.w3.org/2000/01/rdf-schema#label> "cached" .',
+                     graph_uri='http://example.com/graph', endpoint_url=self.endpoint.crud_url,
+                     content_type='application/n-triples')
+
+        assert len(sc.sparql(query, endpoint_url=self.endpoint.query_url, cache=True)) == 1
+
+    def test_membership(self):
+        """
+        Tests that the membership graph holds the transitive members of nested collections
+        """
+        import app.util.sparql_client as sc
+        import app.util.catalog as catalog
+
+        membership = 'http://example.com/membership'
+        sc.post_data('<http://example.com/A> <http://www.w3.org/2004/02/skos/core#member> <http://example.com/B> .\n'
+                     '<http://example.com/B> <http://www.w3.org/2004/02/skos/core#member> <http://example.com/c> .',
+                     graph_uri='http://example.com/collections', endpoint_url=self.endpoint.crud_url,
+                     content_type='application/n-triples')
+
+        collections = 'VALUES ?c { <http://example.com/A> <http://example.com/B> }'
+        sc.execute_updates([catalog.ADD_MEMBERS_TEMPLATE.format(MEMBERSHIP=membership, COLLECTIONS=collections)],
+                           endpoint_url=self.endpoint.update_url)
+
+        query = catalog.ANCESTORS_QUERY.format(MEMBERSHIP=membership, URIS='<http://example.com/c>')
+        ancestors = sc.dictize(sc.sparql(query, endpoint_url=self.endpoint.query_url))
+
+        assert set(a['c'] for a in ancestors) == {'http://example.com/A', 'http://example.com/B'}
+
+    def test_catalog_templates(self):
+        """
+        Tests that the catalog lists what a nanopublication defines, until the nanopublication is removed
+        """
+        import app.util.sparql_client as sc
+        import app.util.catalog as catalog
+
+        catalog_graph = 'http://example.com/catalog'
+        sc.execute_updates(["""
+            PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+            PREFIX qb: <http://purl.org/linked-data/cube#>
+            PREFIX np: <http://www.nanopub.org/nschema#>
+            PREFIX prov: <http://www.w3.org/ns/prov#>
+            INSERT DATA {
+                GRAPH <http://example.com/np> {
+                    <http://example.com/np> a np:Nanopublication ;
+                        np:hasAssertion <http://example.com/np/assertion> ;
+                        np:hasPublicationInfo <http://example.com/np/pubinfo> .
+                }
+                GRAPH <http://example.com/np/assertion> {
+                    <http://example.com/dataset> a qb:DataSet ; rdfs:label "Dataset" .
+                    <http://example.com/dimension> a qb:DimensionProperty ; rdfs:label "Dimension" .
+                    <http://example.com/code> skos:inScheme <http://example.com/scheme> .
+                    <http://example.com/scheme> rdfs:label "Scheme" .
+                }
+                GRAPH <http://example.com/np/pubinfo> {
+                    <http://example.com/np> prov:wasAttributedTo <http://example.com/owner> .
+                }
+            }"""], endpoint_url=self.endpoint.update_url)
+
+        sources = catalog.NANOPUBLICATION_SOURCES.format(URIS='<http://example.com/np>')
+        sc.execute_updates([catalog.DEFINITIONS_TEMPLATE.format(CATALOG=catalog_graph, SOURCES=sources),
+                            catalog.DATASETS_TEMPLATE.format(CATALOG=catalog_graph, SOURCES=sources)],
+                           endpoint_url=self.endpoint.update_url)
+
+        query = """
+            SELECT ?uri ?type WHERE {{ GRAPH <{}> {{ ?uri a ?type }} }}
+        """.format(catalog_graph)
+        listed = set((r['uri'], r['type'].rsplit('/', 1)[-1])
+                     for r in sc.dictize(sc.sparql(query, endpoint_url=self.endpoint.query_url)))
+
+        assert listed == {('http://example.com/dataset', 'cube#DataSet'),
+                          ('http://example.com/dimension', 'cube#DimensionProperty'),
+                          ('http://example.com/scheme', 'CodeList')}
+
+        sc.execute_updates([catalog.REMOVE_TEMPLATE.format(CATALOG=catalog_graph, URIS='<http://example.com/np>')],
+                           endpoint_url=self.endpoint.update_url)
+
+        assert sc.sparql(query, endpoint_url=self.endpoint.query_url) == []
+
+    def test_definition_queries(self):
+        """
+        Tests that the combined definition and codelist queries return a row per variable
+        """
+        import app.util.sparql_client as sc
+        import app.util.csdh_client as cc
+
+        uris = ['http://data.socialhistory.org/resource/canada_1901/variable/SEX',
+                'http://purl.org/linked-data/sdmx/2009/dimension#sex']
+
+        definitions = sc.dictize(sc.sparql(cc.definition_query(uris), endpoint_url=self.endpoint.query_url))
+        codelists = sc.dictize(sc.sparql(cc.codelist_query(uris), endpoint_url=self.endpoint.query_url))
+
+        assert set(d['uri'] for d in definitions) == set(uris)
+        assert set(c['variable'] for c in codelists) == set(uris)
+
+    def test_stats(self):
+        """
+        Tests that calls are recorded, attributed to their caller, and logged when slow
+        """
+        import app.util.sparql_client as sc
+
+        sc.stats.reset()
+        sc.stats.slow_threshold = 0
+
+        query = "SELECT ?s WHERE {   ?s ?p ?o }   LIMIT 5"
+        sc.sparql(query, endpoint_url=self.endpoint.query_url)
+
+        stats = sc.stats.stats()
+        sc.stats.slow_threshold = 1.0
+
+        call = stats['calls'][0]
+        assert (call['kind'], call['calls'], call['rows']) == ('query', 1, 5)
+        assert call['caller'] == '__init__.test_stats'
+        assert call['bytes_in'] > 0
+        assert stats['slow'][0]['query'] == sc.normalize_query(query)
+
+
 if __name__ == '__main__':
     unittest.main()
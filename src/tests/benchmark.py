@@ -0,0 +1,177 @@
+"""
+Benchmarks the csdh_client functions against the local SPARQL endpoint (tests/local_endpoint.py).
+
+Run from the `src` directory (with `app/config.py` copied from the template, so that the
+endpoint URLs are read from the environment)::
+
+    python -m tests.benchmark -n 20 --scale 50 --json /tmp/benchmark.json
+
+For every function it reports the number of calls, the mean, median, 95th percentile and
+maximum latency (in milliseconds), and the throughput (calls per second).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+from rdflib import URIRef, Literal, RDF, RDFS, Namespace
+
+from local_endpoint import LocalEndpoint
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'csdh.trig')
+
+QB = Namespace('http://purl.org/linked-data/cube#')
+SKOS = Namespace('http://www.w3.org/2004/02/skos/core#')
+PROV = Namespace('http://www.w3.org/ns/prov#')
+NP = Namespace('http://www.nanopub.org/nschema#')
+
+SDMX_SEX = 'http://purl.org/linked-data/sdmx/2009/dimension#sex'
+SDMX_SEX_CODES = 'http://purl.org/linked-data/sdmx/2009/code#sex'
+CANADA = 'http://data.socialhistory.org/resource/canada_1901/'
+
+
+def seed(endpoint, scale, variables=10, values=100):
+    """Adds `scale` synthetic nanopublications, each with a number of coded variables, to the store"""
+    store = endpoint.store
+    owner = URIRef('http://data.socialhistory.org/resource/person/bench@example.com')
+
+    for d in range(scale):
+        base = 'http://data.socialhistory.org/resource/bench_{}/'.format(d)
+        dataset_uri = URIRef(base[:-1])
+        nanopublication = URIRef(base + 'nanopublication/00000000/2016-01-01T12:00')
+        assertion = store.get_context(URIRef(base + 'assertion/00000000/2016-01-01T12:00'))
+        pubinfo = store.get_context(URIRef(base + 'pubinfo/00000000/2016-01-01T12:00'))
+        provenance = store.get_context(URIRef(base + 'provenance/00000000/2016-01-01T12:00'))
+        head = store.get_context(nanopublication)
+
+        head.add((nanopublication, RDF.type, NP['Nanopublication']))
+        head.add((nanopublication, NP['hasAssertion'], assertion.identifier))
+        head.add((nanopublication, NP['hasPublicationInfo'], pubinfo.identifier))
+        head.add((nanopublication, NP['hasProvenance'], provenance.identifier))
+        head.add((assertion.identifier, RDF.type, NP['Assertion']))
+        head.add((pubinfo.identifier, RDF.type, NP['PublicationInfo']))
+        head.add((provenance.identifier, RDF.type, NP['Provenance']))
+        pubinfo.add((nanopublication, PROV['wasAttributedTo'], owner))
+        provenance.add((assertion.identifier, PROV['wasAttributedTo'], owner))
+
+        assertion.add((dataset_uri, RDF.type, QB['DataSet']))
+        assertion.add((dataset_uri, RDFS.label, Literal('bench_{}'.format(d))))
+
+        for v in range(variables):
+            variable_uri = URIRef(base + 'variable/V{}'.format(v))
+            codelist_uri = URIRef(base + 'codelist/V{}'.format(v))
+
+            assertion.add((variable_uri, RDF.type, QB['DimensionProperty']))
+            assertion.add((variable_uri, RDF.type, QB['CodedProperty']))
+            assertion.add((variable_uri, RDFS.label, Literal('V{}'.format(v))))
+            assertion.add((variable_uri, QB['codeList'], codelist_uri))
+            assertion.add((codelist_uri, RDF.type, SKOS['Collection']))
+            assertion.add((codelist_uri, RDFS.label, Literal('Codelist for V{}'.format(v))))
+
+            for i in range(values):
+                value_uri = URIRef(base + 'code/V{}/{}'.format(v, i))
+                assertion.add((value_uri, RDF.type, SKOS['Concept']))
+                assertion.add((value_uri, SKOS['prefLabel'], Literal(str(i))))
+                assertion.add((codelist_uri, SKOS['member'], value_uri))
+
+
+def cases(cc):
+    return [
+        ('get_definition (known variable)', lambda: cc.get_definition(SDMX_SEX)),
+        ('get_definition (dataset variable)', lambda: cc.get_definition(CANADA + 'variable/SEX')),
+        ('get_definitions (10 variables)', lambda: cc.get_definitions(
+            [SDMX_SEX] + [CANADA + 'variable/' + v for v in ['SEX', 'AGE', 'OCCUPATION']] +
+            ['http://data.socialhistory.org/resource/bench_0/variable/V{}'.format(v) for v in range(6)])),
+        ('get_dimensions', cc.get_dimensions),
+        ('get_lsd_dimensions', cc.get_lsd_dimensions),
+        ('get_csdh_dimensions', cc.get_csdh_dimensions),
+        ('get_schemes', cc.get_schemes),
+        ('get_csdh_schemes', cc.get_csdh_schemes),
+        ('get_all_schemes', cc.get_all_schemes),
+        ('get_concepts (scheme)', lambda: cc.get_concepts(SDMX_SEX_CODES)),
+        ('get_concepts (nested collection)', lambda: cc.get_concepts(CANADA + 'codelist/OCCUPATION')),
+        ('get_datasets', cc.get_datasets),
+    ]
+
+
+def measure(function, n, before=None):
+    timings = []
+    for _ in range(n):
+        if before is not None:
+            before()
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+
+    timings.sort()
+    total = sum(timings)
+    return {
+        'calls': n,
+        'mean_ms': 1000 * total / n,
+        'median_ms': 1000 * timings[n // 2],
+        'p95_ms': 1000 * timings[min(n - 1, int(0.95 * n))],
+        'max_ms': 1000 * timings[-1],
+        'throughput': n / total if total > 0 else float('inf')
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark csdh_client against a local SPARQL endpoint')
+    parser.add_argument('-n', type=int, default=10, help='Number of calls per function')
+    parser.add_argument('--scale', type=int, default=0, help='Number of synthetic datasets to add')
+    parser.add_argument('-k', type=str, default=None, help='Only run functions whose name contains this string')
+    parser.add_argument('--cold', action='store_true', help='Clear the SPARQL result cache before every call')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    endpoint = LocalEndpoint()
+    endpoint.load(FIXTURES)
+    seed(endpoint, args.scale)
+    endpoint.start()
+
+    # The configuration reads the endpoint URLs from the environment, so set them before importing the app
+    os.environ['ENDPOINT_URL'] = endpoint.query_url
+    os.environ['UPDATE_URL'] = endpoint.update_url
+    os.environ['CRUD_URL'] = endpoint.crud_url
+
+    import app.config as config
+    import app.util.sparql_client as sc
+    import app.util.csdh_client as cc
+    import app.util.catalog as catalog
+
+    if config.ENDPOINT_URL != endpoint.query_url:
+        sys.exit("app/config.py does not read ENDPOINT_URL from the environment")
+
+    # The listings read the catalog graph
+    catalog.rebuild()
+
+    def before():
+        sc.result_cache.clear()
+        cc.definition_cache.clear()
+
+    before = before if args.cold else None
+
+    results = {}
+    for name, function in cases(cc):
+        if args.k and args.k not in name:
+            continue
+
+        results[name] = measure(function, args.n, before=before)
+
+    endpoint.stop()
+
+    print "\n{} triples in the store\n".format(len(endpoint))
+    print "{:<36} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}".format('function', 'calls', 'mean ms', 'median ms',
+                                                                   'p95 ms', 'max ms', 'calls/s')
+    for name, r in sorted(results.items()):
+        print "{:<36} {calls:>6} {mean_ms:>10.1f} {median_ms:>10.1f} {p95_ms:>10.1f} {max_ms:>10.1f} {throughput:>10.1f}"\
+            .format(name, **r)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'triples': len(endpoint), 'scale': args.scale, 'cold': args.cold, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
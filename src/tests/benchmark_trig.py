@@ -0,0 +1,96 @@
+"""
+Benchmarks the TriG serialization of data structure definitions: the rdflib-based serializeTrig
+that was replaced (serialize every graph as Turtle, then reindent it), the current serializeTrig
+(writer.TrigWriter over the graph store), and streaming straight from the statement generator
+(write_data_structure_definition), optionally with worker processes generating the variables.
+
+Run from the `src` directory::
+
+    python -m tests.benchmark_trig -n 5 --values 10000 --variables 3
+    python -m tests.benchmark_trig -n 5 --values 100 --variables 300 --processes 4
+
+Reports the same statistics as tests/benchmark.py, and the size of the output.
+"""
+import json
+import string
+import argparse
+from cStringIO import StringIO
+from datetime import datetime
+
+from rdflib import URIRef
+
+from benchmark import measure
+
+
+def rdflib_trig(rdf_dataset):
+    """The serializeTrig this benchmark compares against"""
+    def reindent(s, numSpaces):
+        s = s.split('\n')
+        s = [(numSpaces * ' ') + string.lstrip(line) for line in s]
+        s = "\n".join(s)
+        return s
+
+    turtles = []
+    for c in rdf_dataset.contexts():
+        if c.identifier != URIRef('urn:x-rdflib:default'):
+            turtle = "<{id}> {{\n".format(id=c.identifier)
+            turtle += reindent(c.serialize(format='turtle'), 4)
+            turtle += "}\n\n"
+        else:
+            turtle = c.serialize(format='turtle')
+            turtle += "\n\n"
+
+        turtles.append(turtle)
+
+    return "\n".join(turtles)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the TriG serialization of data structure definitions')
+    parser.add_argument('-n', type=int, default=5, help='Number of serializations per function')
+    parser.add_argument('--values', type=int, default=10000, help='Number of values per variable')
+    parser.add_argument('--variables', type=int, default=3, help='Number of variables (multiples of 3)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Also stream with this many worker processes generating the variables')
+    args = parser.parse_args()
+
+    from tests import dsd_variables
+    from app.datacube import converter
+
+    # Copies of the variables, with their own URIs
+    variables = {}
+    for i in range(max(1, args.variables // 3)):
+        for name, variable in dsd_variables(args.values).items():
+            copy = json.dumps(variable).replace('/{}'.format(name), '/{}{}'.format(name, i))
+            variables['{}{}'.format(name, i)] = json.loads(copy)
+
+    arguments = ({'email': 'bench@example.com', 'name': 'Bench', 'id': '1'}, 'bench',
+                 'http://data.socialhistory.org/resource/bench', variables, 'bench.csv', 'abcdef1234')
+    timestamp = datetime(2016, 1, 1, 12, 0)
+    rdf_dataset = converter.data_structure_definition(*arguments, timestamp=timestamp)
+
+    def stream(processes=1):
+        out = StringIO()
+        converter.write_data_structure_definition(out, *arguments, timestamp=timestamp, format='trig',
+                                                  processes=processes)
+        return out.getvalue()
+
+    cases = [
+        ('rdflib serializeTrig (replaced)', lambda: rdflib_trig(rdf_dataset)),
+        ('serializeTrig', lambda: converter.serializeTrig(rdf_dataset)),
+        ('write_data_structure_definition', stream),
+    ]
+    if args.processes > 1:
+        cases.append(('... with {} processes'.format(args.processes), lambda: stream(args.processes)))
+
+    print "\n{} statements in the graph store\n".format(len(rdf_dataset))
+    print "{:<36} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}".format('function', 'calls', 'mean ms', 'median ms',
+                                                                   'p95 ms', 'max ms', 'MB')
+    for name, function in cases:
+        r = measure(function, args.n)
+        print "{:<36} {calls:>6} {mean_ms:>10.1f} {median_ms:>10.1f} {p95_ms:>10.1f} {max_ms:>10.1f} {mb:>10.1f}"\
+            .format(name, mb=len(function()) / 1e6, **r)
+
+
+if __name__ == '__main__':
+    main()
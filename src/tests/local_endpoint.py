@@ -0,0 +1,160 @@
+"""
+A local, in-memory stand-in for the Virtuoso/Stardog endpoint used by the datalegend API.
+
+It implements the parts of the SPARQL protocols that sparql_client uses:
+
+* ``GET|POST /sparql?query=...``  -- SPARQL 1.1 Query (SELECT and ASK as SPARQL JSON results,
+  CONSTRUCT and DESCRIBE as N-Triples)
+* ``POST /sparql`` with an ``application/sparql-update`` body (or an ``update`` form field)
+  -- SPARQL 1.1 Update
+* ``POST /sparql-graph-crud?graph-uri=...`` -- adds the RDF in the body (optionally gzipped)
+  to the named graph (Virtuoso's graph CRUD endpoint)
+
+The store is an rdflib ConjunctiveGraph, so (as in Virtuoso) the default graph is the union of
+all named graphs. Virtuoso-specific ``DEFINE`` pragmas are ignored. Queries with ``FROM`` clauses
+are evaluated against (a copy of) the union of those graphs.
+
+Usage::
+
+    endpoint = LocalEndpoint()
+    endpoint.load('tests/fixtures/csdh.trig')
+    endpoint.start()
+    ...  # point ENDPOINT_URL/UPDATE_URL/CRUD_URL at endpoint.query_url etc.
+    endpoint.stop()
+"""
+import re
+import zlib
+import threading
+
+from rdflib import ConjunctiveGraph, Graph, URIRef
+from werkzeug.serving import make_server, WSGIRequestHandler
+from werkzeug.wrappers import Request, Response
+
+DEFINE_PATTERN = re.compile(r'^\s*DEFINE\s+\S+\s+\S+\s*$', re.IGNORECASE | re.MULTILINE)
+FROM_PATTERN = re.compile(r'\bFROM\s+<([^>]*)>', re.IGNORECASE)
+
+FORMATS = {
+    'application/turtle': 'turtle',
+    'text/turtle': 'turtle',
+    'application/x-turtle': 'turtle',
+    'application/n-triples': 'nt',
+    'text/plain': 'nt',
+    'application/rdf+xml': 'xml',
+    'application/n-quads': 'nquads'
+}
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    # Keep connections open, like the real endpoints do
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class LocalEndpoint(object):
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.store = ConjunctiveGraph()
+        self.lock = threading.RLock()
+        self.server = make_server(host, port, self.wsgi_app, threaded=True,
+                                  request_handler=KeepAliveRequestHandler)
+        # Do not wait for idle keep-alive connections on exit
+        self.server.daemon_threads = True
+        self.thread = None
+
+        self.base_url = 'http://{}:{}'.format(host, self.server.server_port)
+        self.query_url = self.base_url + '/sparql'
+        self.update_url = self.base_url + '/sparql'
+        self.crud_url = self.base_url + '/sparql-graph-crud'
+
+    def load(self, source, format='trig'):
+        """Loads a fixture file (TriG by default) into the store"""
+        with self.lock:
+            self.store.parse(source, format=format)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __len__(self):
+        return len(self.store)
+
+    def wsgi_app(self, environ, start_response):
+        request = Request(environ)
+
+        try:
+            if request.path == '/sparql':
+                response = self.sparql(request)
+            elif request.path == '/sparql-graph-crud':
+                response = self.crud(request)
+            else:
+                response = Response('Not found', status=404)
+        except Exception as e:
+            response = Response('Error: {}'.format(e), status=400, mimetype='text/plain')
+
+        return response(environ, start_response)
+
+    def sparql(self, request):
+        query = request.values.get('query')
+        if query is not None:
+            return self.query(query)
+
+        update = request.form.get('update')
+        if update is None and request.mimetype == 'application/sparql-update':
+            update = request.get_data().decode('utf-8')
+
+        if update is None:
+            return Response('No query or update given', status=400)
+
+        with self.lock:
+            self.store.update(DEFINE_PATTERN.sub('', update))
+
+        return Response('{"results": "ok"}', mimetype='application/json')
+
+    def query(self, query):
+        query = DEFINE_PATTERN.sub('', query)
+
+        with self.lock:
+            graphs = FROM_PATTERN.findall(query)
+            if graphs:
+                # rdflib would try to load the FROM graphs from the Web
+                default = Graph()
+                for graph_uri in graphs:
+                    default += self.store.get_context(URIRef(graph_uri))
+                result = default.query(FROM_PATTERN.sub('', query))
+            else:
+                result = self.store.query(query)
+
+            if result.type in ('SELECT', 'ASK'):
+                return Response(result.serialize(format='json'), mimetype='application/sparql-results+json')
+            else:
+                return Response(result.graph.serialize(format='nt'), mimetype='application/n-triples')
+
+    def crud(self, request):
+        if request.method != 'POST':
+            return Response('Only POST is supported', status=405)
+
+        graph_uri = request.args.get('graph-uri')
+        format = FORMATS.get(request.mimetype, 'turtle')
+
+        with self.lock:
+            if graph_uri is None:
+                graph = self.store.default_context
+            else:
+                graph = self.store.get_context(URIRef(graph_uri))
+
+            data = request.get_data()
+            if request.headers.get('Content-Encoding') == 'gzip':
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+            graph.parse(data=data, format=format)
+
+        return Response('', status=201)